@@ -648,6 +648,19 @@ PROJECTION_CONTOUR_MIDA=8
 PROJECTION_BORDER_SIZE=1.0
 PROJECTION_MIP_SIZE=2
 
+#------------ Slice cache ------------------
+# Memory (in MB) used to keep the slices already rendered, shared by the
+# three orientations. It can be changed by the 'slice_cache_size' config.
+SLICE_CACHE_SIZE = 256
+# Number of slices read ahead in the scroll direction.
+SLICE_PREFETCH_SIZE = 2
+
+#------------ Edition history ------------------
+# Memory (in MB) used by the undo history of each mask, above it the oldest
+# states are moved to disk. It can be changed by the 'undo_history_size'
+# config.
+UNDO_HISTORY_SIZE = 256
+
 # ------------- Boolean operations ------------------
 BOOLEAN_UNION = 1
 BOOLEAN_DIFF = 2
@@ -825,6 +838,9 @@ SEED_RADIUS = 1.5
 # Increased the default sleep parameter from 0.1 to 0.15 to decrease CPU load during navigation.
 SLEEP_NAVIGATION = 0.2
 SLEEP_COORDINATES = 0.1
+# Maximum time, in seconds, the navigation threads wait for new data before
+# checking if the navigation was stopped.
+NAVIGATION_WAIT_TIMEOUT = 0.1
 
 BRAIN_OPACITY = 0.6
 N_CPU = psutil.cpu_count()
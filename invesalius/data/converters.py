@@ -37,20 +37,33 @@ def to_vtk(
     orientation="AXIAL",
     origin=(0, 0, 0),
     padding=(0, 0, 0),
+    components=1,
 ):
+    """
+    Converts n_array to a vtkImageData placed at slice_number in the given
+    orientation. If components > 1 the last axis of n_array are the
+    components of each voxel (e.g. RGB colours).
+    """
     if orientation == "SAGITTAL":
         orientation = "SAGITAL"
 
+    if components > 1:
+        shape = n_array.shape[:-1]
+        v_image = numpy_support.numpy_to_vtk(
+            np.ascontiguousarray(n_array).reshape(-1, components)
+        )
+    else:
+        shape = n_array.shape
+        v_image = numpy_support.numpy_to_vtk(n_array.flat)
+
     try:
-        dz, dy, dx = n_array.shape
+        dz, dy, dx = shape
     except ValueError:
-        dy, dx = n_array.shape
+        dy, dx = shape
         dz = 1
 
     px, py, pz = padding
 
-    v_image = numpy_support.numpy_to_vtk(n_array.flat)
-
     if orientation == "AXIAL":
         extent = (
             0 - px,
@@ -90,7 +103,7 @@ def to_vtk(
     # AllocateScalars
     #  image.SetNumberOfScalarComponents(1)
     #  image.SetScalarType(numpy_support.get_vtk_array_type(n_array.dtype))
-    image.AllocateScalars(numpy_support.get_vtk_array_type(n_array.dtype), 1)
+    image.AllocateScalars(numpy_support.get_vtk_array_type(n_array.dtype), components)
     image.SetExtent(extent)
     image.GetPointData().SetScalars(v_image)
 
@@ -153,6 +166,77 @@ def np_rgba_to_vtk(n_array, spacing=(1.0, 1.0, 1.0)):
     return image
 
 
+def polydata_to_np(polydata):
+    """
+    Returns the points, the polygons and the point and cell normals (None if
+    polydata doesn't have them) of polydata as numpy arrays. The polygons
+    are given in the vtkCellArray legacy layout (n, id_0, ..., id_n-1, ...).
+    """
+    if polydata.GetNumberOfPoints():
+        points = numpy_support.vtk_to_numpy(polydata.GetPoints().GetData())
+    else:
+        points = np.empty((0, 3), dtype=np.float32)
+    polys = numpy_support.vtk_to_numpy(polydata.GetPolys().GetData())
+
+    point_normals = polydata.GetPointData().GetNormals()
+    if point_normals is not None:
+        point_normals = numpy_support.vtk_to_numpy(point_normals)
+
+    cell_normals = polydata.GetCellData().GetNormals()
+    if cell_normals is not None:
+        cell_normals = numpy_support.vtk_to_numpy(cell_normals)
+
+    return (
+        np.array(points),
+        np.array(polys, dtype=np.int64),
+        None if point_normals is None else np.array(point_normals),
+        None if cell_normals is None else np.array(cell_normals),
+    )
+
+
+def np_to_polydata(points, polys, point_normals=None, cell_normals=None):
+    """
+    Creates a vtkPolyData from the arrays given by polydata_to_np. polys may
+    also be a (n, 3) array of triangles.
+    """
+    if polys.ndim == 2:
+        triangles = polys
+        polys = np.empty((triangles.shape[0], 4), dtype=np.int64)
+        polys[:, 0] = 3
+        polys[:, 1:] = triangles
+    polys = np.ascontiguousarray(polys.ravel(), dtype=numpy_support.ID_TYPE_CODE)
+
+    v_points = vtkPoints()
+    v_points.SetData(
+        numpy_support.numpy_to_vtk(np.ascontiguousarray(points), deep=True)
+    )
+
+    v_polys = vtkCellArray()
+    v_polys.ImportLegacyFormat(
+        numpy_support.numpy_to_vtkIdTypeArray(polys, deep=True)
+    )
+
+    polydata = vtkPolyData()
+    polydata.SetPoints(v_points)
+    polydata.SetPolys(v_polys)
+
+    if point_normals is not None:
+        v_normals = numpy_support.numpy_to_vtk(
+            np.ascontiguousarray(point_normals), deep=True
+        )
+        v_normals.SetName("Normals")
+        polydata.GetPointData().SetNormals(v_normals)
+
+    if cell_normals is not None:
+        v_normals = numpy_support.numpy_to_vtk(
+            np.ascontiguousarray(cell_normals), deep=True
+        )
+        v_normals.SetName("Normals")
+        polydata.GetCellData().SetNormals(v_normals)
+
+    return polydata
+
+
 # Based on http://gdcm.sourceforge.net/html/ConvertNumpy_8py-example.html
 def gdcm_to_numpy(image, apply_intercep_scale=True):
     map_gdcm_np = {
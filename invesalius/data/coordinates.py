@@ -20,21 +20,29 @@
 from math import sin, cos
 import numpy as np
 import threading
-import wx
 
 import invesalius.data.transformations as tr
 import invesalius.constants as const
 
-from time import sleep
+from time import perf_counter, sleep
 from random import uniform
+from invesalius.navigation.pipeline import FrameDispatcher, LatestValueChannel
 from invesalius.pubsub import pub as Publisher
 
+# Time, in seconds, the debug trackers take to give the coordinates,
+# simulating the time taken by a real device.
+DEBUG_TRACKER_DELAY = 0.15
+
 class TrackerCoordinates():
-    def __init__(self):
+    def __init__(self, ui_dispatcher=None):
         self.coord = None
         self.markers_flag = [False, False, False]
         self.previous_markers_flag = self.markers_flag
         self.nav_status = False
+        # Channel with the latest coordinates, waited on by the navigation.
+        self.channel = LatestValueChannel('coordinates')
+        # The coordinates are shown in the GUI at most once for each frame.
+        self.ui_dispatcher = ui_dispatcher if ui_dispatcher is not None else FrameDispatcher()
         self.__bind_events()
 
     def __bind_events(self):
@@ -43,27 +51,45 @@ class TrackerCoordinates():
     def OnUpdateNavigationStatus(self, nav_status, vis_status):
         self.nav_status = nav_status
 
-    def SetCoordinates(self, coord, markers_flag):
+    def SetCoordinates(self, coord, markers_flag, timestamp=None):
         self.coord = coord
         self.markers_flag = markers_flag
+        self.channel.put((coord, markers_flag), timestamp=timestamp)
         if not self.nav_status:
-            wx.CallAfter(Publisher.sendMessage, 'Update tracker coordinates',
-                         coord=self.coord.tolist(), markers_flag=self.markers_flag)
+            self.ui_dispatcher.update('Update tracker coordinates',
+                                      coord=self.coord.tolist(), markers_flag=self.markers_flag)
             if self.previous_markers_flag != self.markers_flag:
-                wx.CallAfter(Publisher.sendMessage, 'Sensors ID', markers_flag=self.markers_flag)
-                wx.CallAfter(Publisher.sendMessage, 'Render volume viewer')
+                self.ui_dispatcher.update('Sensors ID', markers_flag=self.markers_flag)
+                self.ui_dispatcher.update('Render volume viewer')
                 self.previous_markers_flag = self.markers_flag
+            self.ui_dispatcher.flush()
 
     def GetCoordinates(self):
         if self.nav_status:
-            wx.CallAfter(Publisher.sendMessage, 'Update tracker coordinates',
-                         coord=self.coord.tolist(), markers_flag=self.markers_flag)
-            if self.previous_markers_flag != self.markers_flag:
-                wx.CallAfter(Publisher.sendMessage, 'Sensors ID', markers_flag=self.markers_flag)
-                self.previous_markers_flag = self.markers_flag
+            self.__publish_coordinates(self.coord, self.markers_flag)
 
         return self.coord, self.markers_flag
 
+    def WaitCoordinates(self, timeout=None):
+        """
+        Waits up to timeout seconds for coordinates newer than the ones
+        already returned, returning them with the timestamp of when they were
+        read. Raises queue.Empty if there are none.
+        """
+        (coord, markers_flag), timestamp = self.channel.wait(timeout)
+        if self.nav_status:
+            self.__publish_coordinates(coord, markers_flag)
+
+        return coord, markers_flag, timestamp
+
+    def __publish_coordinates(self, coord, markers_flag):
+        self.ui_dispatcher.update('Update tracker coordinates',
+                                  coord=coord.tolist(), markers_flag=markers_flag)
+        if self.previous_markers_flag != markers_flag:
+            self.ui_dispatcher.update('Sensors ID', markers_flag=markers_flag)
+            self.previous_markers_flag = markers_flag
+        self.ui_dispatcher.flush()
+
 
 def GetCoordinatesForThread(tracker_connection, tracker_id, ref_mode):
     """
@@ -395,7 +421,7 @@ def DebugCoordRandom(tracker_connection, tracker_id, ref_mode):
     coord4 = np.array([uniform(*dx), uniform(*dx), uniform(*dx),
                        uniform(*dt), uniform(*dt), uniform(*dt)])
 
-    sleep(0.15)
+    sleep(DEBUG_TRACKER_DELAY)
 
     # coord1 = np.array([uniform(1, 200), uniform(1, 200), uniform(1, 200),
     #                    uniform(-180.0, 180.0), uniform(-180.0, 180.0), uniform(-180.0, 180.0)])
@@ -575,16 +601,20 @@ def offset_coordinate(p_old, norm_vec, offset):
     return p_offset
 
 class ReceiveCoordinates(threading.Thread):
-    def __init__(self, tracker_connection, tracker_id, TrackerCoordinates, event):
+    def __init__(self, tracker_connection, tracker_id, TrackerCoordinates, event, period=const.SLEEP_COORDINATES):
         threading.Thread.__init__(self, name='ReceiveCoordinates')
 
         self.tracker_connection = tracker_connection
         self.tracker_id = tracker_id
         self.event = event
         self.TrackerCoordinates = TrackerCoordinates
+        self.period = period
 
     def run(self):
         while not self.event.is_set():
+            start = perf_counter()
             coord_raw, markers_flag = GetCoordinatesForThread(self.tracker_connection, self.tracker_id, const.DEFAULT_REF_MODE)
-            self.TrackerCoordinates.SetCoordinates(coord_raw, markers_flag)
-            sleep(const.SLEEP_COORDINATES)
+            self.TrackerCoordinates.SetCoordinates(coord_raw, markers_flag, timestamp=perf_counter())
+            # Sleeps only what is left of the sampling period, the time spent
+            # reading the tracker is part of it.
+            sleep(max(self.period - (perf_counter() - start), 0))
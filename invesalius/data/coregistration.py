@@ -20,12 +20,13 @@
 import numpy as np
 import queue
 import threading
-from time import sleep
+from time import perf_counter
 
 import invesalius.constants as const
 import invesalius.data.transformations as tr
 import invesalius.data.bases as bases
 import invesalius.data.coordinates as dco
+from invesalius.navigation.pipeline import StageStats
 
 
 # TODO: Replace the use of degrees by radians in every part of the navigation pipeline
@@ -270,6 +271,274 @@ def ComputeRelativeDistanceToTarget(target_coord=None, img_coord=None, m_target=
     return distance
 
 
+def euler_matrices(angles, axes='sxyz'):
+    """Vectorized tr.euler_matrix, returns the homogeneous rotation matrices of many Euler angles.
+
+    :param angles: N x 3 array of Euler angles in radians
+    :type angles: numpy.ndarray
+    :param axes: One of the 24 axis sequences of transformations.py
+    :type axes: str
+    :return: N x 4 x 4 numpy double array
+    :rtype: numpy.ndarray
+    """
+    firstaxis, parity, repetition, frame = tr._AXES2TUPLE[axes]
+    i = firstaxis
+    j = tr._NEXT_AXIS[i + parity]
+    k = tr._NEXT_AXIS[i - parity + 1]
+
+    angles = np.asarray(angles, dtype=np.float64)
+    ai, aj, ak = angles[:, 0], angles[:, 1], angles[:, 2]
+    if frame:
+        ai, ak = ak, ai
+    if parity:
+        ai, aj, ak = -ai, -aj, -ak
+
+    si, sj, sk = np.sin(ai), np.sin(aj), np.sin(ak)
+    ci, cj, ck = np.cos(ai), np.cos(aj), np.cos(ak)
+    cc, cs = ci * ck, ci * sk
+    sc, ss = si * ck, si * sk
+
+    M = np.zeros((len(angles), 4, 4))
+    M[:, 3, 3] = 1.0
+    if repetition:
+        M[:, i, i] = cj
+        M[:, i, j] = sj * si
+        M[:, i, k] = sj * ci
+        M[:, j, i] = sj * sk
+        M[:, j, j] = -cj * ss + cc
+        M[:, j, k] = -cj * cs - sc
+        M[:, k, i] = -sj * ck
+        M[:, k, j] = cj * sc + cs
+        M[:, k, k] = cj * cc - ss
+    else:
+        M[:, i, i] = cj * ck
+        M[:, i, j] = sj * sc - cs
+        M[:, i, k] = sj * cc + ss
+        M[:, j, i] = cj * sk
+        M[:, j, j] = sj * ss + cc
+        M[:, j, k] = sj * cs - sc
+        M[:, k, i] = -sj
+        M[:, k, j] = cj * si
+        M[:, k, k] = cj * ci
+    return M
+
+
+def euler_from_matrices(matrices, axes='sxyz'):
+    """Vectorized tr.euler_from_matrix, returns the Euler angles of many rotation matrices.
+
+    :param matrices: N x 4 x 4 (or N x 3 x 3) array of rotation matrices
+    :type matrices: numpy.ndarray
+    :param axes: One of the 24 axis sequences of transformations.py
+    :type axes: str
+    :return: N x 3 array of Euler angles in radians
+    :rtype: numpy.ndarray
+    """
+    firstaxis, parity, repetition, frame = tr._AXES2TUPLE[axes]
+    i = firstaxis
+    j = tr._NEXT_AXIS[i + parity]
+    k = tr._NEXT_AXIS[i - parity + 1]
+
+    M = np.asarray(matrices, dtype=np.float64)[:, :3, :3]
+    if repetition:
+        sy = np.sqrt(M[:, i, j] * M[:, i, j] + M[:, i, k] * M[:, i, k])
+        regular = sy > tr._EPS
+        ax = np.where(regular, np.arctan2(M[:, i, j], M[:, i, k]), np.arctan2(-M[:, j, k], M[:, j, j]))
+        ay = np.arctan2(sy, M[:, i, i])
+        az = np.where(regular, np.arctan2(M[:, j, i], -M[:, k, i]), 0.0)
+    else:
+        cy = np.sqrt(M[:, i, i] * M[:, i, i] + M[:, j, i] * M[:, j, i])
+        regular = cy > tr._EPS
+        ax = np.where(regular, np.arctan2(M[:, k, j], M[:, k, k]), np.arctan2(-M[:, j, k], M[:, j, j]))
+        ay = np.arctan2(-M[:, k, i], cy)
+        az = np.where(regular, np.arctan2(M[:, j, i], M[:, i, i]), 0.0)
+
+    if parity:
+        ax, ay, az = -ax, -ay, -az
+    if frame:
+        ax, az = az, ax
+    return np.stack((ax, ay, az), axis=1)
+
+
+def coordinates_to_transformation_matrices(coords, axes='sxyz'):
+    """Vectorized dco.coordinates_to_transformation_matrix.
+
+    :param coords: N x 6 array of positions and Euler angles in degrees
+    :type coords: numpy.ndarray
+    :param axes: One of the 24 axis sequences of transformations.py
+    :type axes: str
+    :return: N x 4 x 4 numpy double array
+    :rtype: numpy.ndarray
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    m = euler_matrices(np.radians(coords[:, 3:6]), axes)
+    m[:, :3, 3] = coords[:, :3]
+    return m
+
+
+def invert_rigid(matrices):
+    """Inverts N x 4 x 4 rigid transformations (rotation and translation), cheaper than np.linalg.inv.
+
+    :param matrices: N x 4 x 4 array of rigid transformations
+    :type matrices: numpy.ndarray
+    :return: N x 4 x 4 numpy double array
+    :rtype: numpy.ndarray
+    """
+    r_t = np.swapaxes(matrices[:, :3, :3], 1, 2)
+    inv = np.zeros_like(matrices)
+    inv[:, :3, :3] = r_t
+    inv[:, :3, 3] = -np.einsum('nij,nj->ni', r_t, matrices[:, :3, 3])
+    inv[:, 3, 3] = 1.0
+    return inv
+
+
+class Coregistration:
+    """Co-registration from tracker to image space with the transformations that are constant during the navigation
+    (the fiducials registration and the object registration, and their inverses) computed once.
+
+    It gives the same results as corregistrate_object_dynamic (when coreg_data has the object registration) and
+    corregistrate_dynamic (when it doesn't), for one coordinate with corregistrate or for a N x n_markers x 6 array
+    of them (a whole recording or a burst of tracker samples) with corregistrate_batch, using (N, 4, 4) arrays.
+
+    :param coreg_data: [m_change, obj_ref_mode] followed, when tracking an object, by the object registration data
+     (t_obj_raw, s0_raw, r_s0_raw, s0_dyn, m_obj_raw, r_obj_img)
+    :type coreg_data: list
+    :param ref_mode_id: Dynamic (1) or static (0) reference
+    :type ref_mode_id: int
+    """
+
+    def __init__(self, coreg_data, ref_mode_id):
+        self.m_change = np.asarray(coreg_data[0], dtype=np.float64)
+        self.obj_ref_mode = coreg_data[1]
+        self.ref_mode_id = ref_mode_id
+        self.track_object = len(coreg_data) > 2
+
+        if self.track_object:
+            t_obj_raw, s0_raw, r_s0_raw, s0_dyn, m_obj_raw, r_obj_img = coreg_data[2:]
+            self.t_obj_raw = np.asarray(t_obj_raw, dtype=np.float64)
+            self.s0_raw = np.asarray(s0_raw, dtype=np.float64)
+            self.inv_s0_raw = np.linalg.inv(self.s0_raw)
+            self.inv_r_s0_raw = np.linalg.inv(r_s0_raw)
+            self.m_obj_raw = np.asarray(m_obj_raw, dtype=np.float64)
+            # r_obj = r_obj_img @ inv(m_obj_raw) @ inv(s0_dyn) @ m_probe_ref @ m_obj_raw
+            self.m_obj_left = r_obj_img @ np.linalg.inv(m_obj_raw) @ np.linalg.inv(s0_dyn)
+
+    def _probe_matrices(self, coords_raw):
+        coords_probe = coords_raw[:, self.obj_ref_mode]
+        if not self.track_object:
+            return coordinates_to_transformation_matrices(coords_probe, axes='rzyx')
+
+        # object_marker_to_center
+        r_probe = euler_matrices(np.radians(coords_probe[:, 3:6]), axes='rzyx')
+        t_offset = np.zeros_like(r_probe)
+        t_offset[:] = np.identity(4)
+        t_offset[:, :, 3] = (self.inv_r_s0_raw @ r_probe @ self.t_obj_raw[:, 3])
+        t_probe_raw = np.zeros_like(r_probe)
+        t_probe_raw[:] = np.identity(4)
+        t_probe_raw[:, :3, 3] = coords_probe[:, :3]
+        t_probe = self.s0_raw @ t_offset @ self.inv_s0_raw @ t_probe_raw
+        return t_probe @ r_probe
+
+    def corregistrate_batch(self, coords_raw, icp=None):
+        """Co-registers many tracker coordinates.
+
+        :param coords_raw: N x n_markers x 6 array of coordinates returned by the tracking device
+        :type coords_raw: numpy.ndarray
+        :param icp: [use_icp, m_icp], ICP is not applied if None
+        :type icp: list
+        :return: N x 6 array of coordinates (positions and Euler angles in degrees) and N x 4 x 4 array of
+         transformations in image space
+        :rtype: (numpy.ndarray, numpy.ndarray)
+        """
+        coords_raw = np.asarray(coords_raw, dtype=np.float64)
+        m_probe = self._probe_matrices(coords_raw)
+
+        # transform object center to reference marker if specified as dynamic reference
+        if self.ref_mode_id:
+            m_ref = coordinates_to_transformation_matrices(coords_raw[:, 1], axes='rzyx')
+            m_probe_ref = invert_rigid(m_ref) @ m_probe
+        else:
+            m_probe_ref = m_probe
+
+        # invert y coordinate
+        m_probe_ref[:, 2, -1] = -m_probe_ref[:, 2, -1]
+
+        # corregistrate from tracker to image space
+        m_img = self.m_change @ m_probe_ref
+        if self.track_object:
+            r_obj = self.m_obj_left @ m_probe_ref @ self.m_obj_raw
+            m_img[:, :3, :3] = r_obj[:, :3, :3]
+
+        if icp is not None and icp[0]:
+            # bases.transform_icp
+            coord_img = np.ones((len(m_img), 4))
+            coord_img[:, :3] = m_img[:, :3, 3]
+            coord_img[:, 1] = -coord_img[:, 1]
+            coord_img = coord_img @ np.asarray(icp[1]).T
+            m_img[:, :3, 3] = coord_img[:, :3]
+            m_img[:, 1, 3] = -m_img[:, 1, 3]
+
+        # compute rotation angles
+        coords = np.empty((len(m_img), 6))
+        coords[:, :3] = m_img[:, :3, 3]
+        coords[:, 3:] = np.degrees(euler_from_matrices(m_img, axes='sxyz'))
+        return coords, m_img
+
+    def corregistrate(self, coord_raw, icp=None):
+        """Co-registers one tracker coordinate.
+
+        :param coord_raw: n_markers x 6 array of coordinates returned by the tracking device
+        :type coord_raw: numpy.ndarray
+        :param icp: [use_icp, m_icp], ICP is not applied if None
+        :type icp: list
+        :return: tuple with the coordinate (position and Euler angles in degrees) and the 4 x 4 transformation in
+         image space
+        :rtype: (tuple, numpy.ndarray)
+        """
+        coord_raw = np.asarray(coord_raw, dtype=np.float64)
+        coord_probe = coord_raw[self.obj_ref_mode]
+        a, b, g = np.radians(coord_probe[3:])
+        r_probe = tr.euler_matrix(a, b, g, 'rzyx')
+        if self.track_object:
+            # object_marker_to_center
+            t_offset = np.identity(4)
+            t_offset[:, 3] = self.inv_r_s0_raw @ (r_probe @ self.t_obj_raw[:, 3])
+            t_probe_raw = np.identity(4)
+            t_probe_raw[:3, 3] = coord_probe[:3]
+            m_probe = self.s0_raw @ t_offset @ self.inv_s0_raw @ t_probe_raw @ r_probe
+        else:
+            m_probe = r_probe
+            m_probe[:3, 3] = coord_probe[:3]
+
+        # transform object center to reference marker if specified as dynamic reference
+        if self.ref_mode_id:
+            a, b, g = np.radians(coord_raw[1, 3:])
+            m_ref = tr.euler_matrix(a, b, g, 'rzyx')
+            m_ref[:3, 3] = coord_raw[1, :3]
+            m_probe_ref = invert_rigid(m_ref[np.newaxis])[0] @ m_probe
+        else:
+            m_probe_ref = m_probe
+
+        # invert y coordinate
+        m_probe_ref[2, -1] = -m_probe_ref[2, -1]
+
+        # corregistrate from tracker to image space
+        m_img = self.m_change @ m_probe_ref
+        if self.track_object:
+            r_obj = self.m_obj_left @ m_probe_ref @ self.m_obj_raw
+            m_img[:3, :3] = r_obj[:3, :3]
+        if icp is not None:
+            m_img = apply_icp(m_img, icp)
+
+        # compute rotation angles
+        angles = tr.euler_from_matrix(m_img, axes='sxyz')
+
+        # create output coordinate list
+        coord = m_img[0, -1], m_img[1, -1], m_img[2, -1], \
+                np.degrees(angles[0]), np.degrees(angles[1]), np.degrees(angles[2])
+
+        return coord, m_img
+
+
 class CoordinateCorregistrate(threading.Thread):
     def __init__(self, ref_mode_id, tracker, coreg_data, view_tracts, queues, event, sle, tracker_id, target, icp,e_field_loaded):
         threading.Thread.__init__(self, name='CoordCoregObject')
@@ -291,6 +560,11 @@ class CoordinateCorregistrate(threading.Thread):
         self.tracker_id = tracker_id
         self.target = target
         self.target_flag = False
+        self.stats = StageStats(self.name)
+        # The constant transformations are computed once for the whole navigation.
+        self.coregistration = Coregistration(coreg_data, ref_mode_id)
+        # NavigationRecorder, set by the navigation while recording.
+        self.recorder = None
 
         if self.target is not None:
             self.target = np.array(self.target)
@@ -302,60 +576,68 @@ class CoordinateCorregistrate(threading.Thread):
             self.target[1] = -self.target[1]
 
     def run(self):
-        coreg_data = self.coreg_data
         view_obj = 1
 
         # print('CoordCoreg: event {}'.format(self.event.is_set()))
         while not self.event.is_set():
             try:
-                if not self.icp_queue.empty():
-                    self.use_icp, self.m_icp = self.icp_queue.get_nowait()
-
-                if not self.object_at_target_queue.empty():
-                    self.target_flag = self.object_at_target_queue.get_nowait()
-
-                # print(f"Set the coordinate")
-                coord_raw, markers_flag = self.tracker.TrackerCoordinates.GetCoordinates()
-                coord, m_img = corregistrate_object_dynamic(coreg_data, coord_raw, self.ref_mode_id, [self.use_icp, self.m_icp])
-
-                # XXX: This is not the best place to do the logic related to approaching the target when the
-                #      debug tracker is in use. However, the trackers (including the debug trackers) operate in
-                #      the tracker space where it is hard to make the tracker approach the target in the image space.
-                #      Ideally, the transformation from the tracker space to the image space (the function
-                #      corregistrate_object_dynamic above) would be encapsulated in a class together with the
-                #      tracker, and then the whole class would be mocked when using the debug tracker. However,
-                #      those abstractions do not currently exist and doing them would need a larger refactoring.
-                #
-                if self.tracker_id == const.DEBUGTRACKAPPROACH and self.target is not None:
-
-                    if self.last_coord is None:
-                        self.last_coord = np.array(coord)
-                    else:
-                        coord = self.last_coord + (self.target - self.last_coord) * 0.05
-                        self.last_coord = coord
-
-                    angles = [np.radians(coord[3]), np.radians(coord[4]), np.radians(coord[5])]
-                    translate = coord[0:3]
-                    m_img = tr.compose_matrix(angles=angles, translate=translate)
-
-                m_img_flip = m_img.copy()
-                m_img_flip[1, -1] = -m_img_flip[1, -1]
-                # self.pipeline.set_message(m_img_flip)
-
-                self.coord_queue.put_nowait([coord, markers_flag, m_img, view_obj])
-                # print('CoordCoreg: put {}'.format(count))
-                # count += 1
-
-                if self.view_tracts:
-                    self.coord_tracts_queue.put_nowait(m_img_flip)
-                if self.e_field_loaded:
-                    self.efield_queue.put_nowait([m_img, coord])
-                if not self.icp_queue.empty():
-                    self.icp_queue.task_done()
-            except queue.Full:
+                # Wakes as soon as the tracker gives new coordinates.
+                coord_raw, markers_flag, timestamp = self.tracker.TrackerCoordinates.WaitCoordinates(
+                    const.NAVIGATION_WAIT_TIMEOUT)
+            except queue.Empty:
+                continue
+            start = perf_counter()
+
+            try:
+                self.use_icp, self.m_icp = self.icp_queue.get_nowait()
+            except queue.Empty:
                 pass
-            # The sleep has to be in both threads
-            sleep(self.sle)
+
+            try:
+                self.target_flag = self.object_at_target_queue.get_nowait()
+            except queue.Empty:
+                pass
+
+            coord, m_img = self.coregistration.corregistrate(coord_raw, [self.use_icp, self.m_icp])
+
+            # XXX: This is not the best place to do the logic related to approaching the target when the
+            #      debug tracker is in use. However, the trackers (including the debug trackers) operate in
+            #      the tracker space where it is hard to make the tracker approach the target in the image space.
+            #      Ideally, the transformation from the tracker space to the image space (the function
+            #      corregistrate above) would be encapsulated in a class together with the
+            #      tracker, and then the whole class would be mocked when using the debug tracker. However,
+            #      those abstractions do not currently exist and doing them would need a larger refactoring.
+            #
+            if self.tracker_id == const.DEBUGTRACKAPPROACH and self.target is not None:
+
+                if self.last_coord is None:
+                    self.last_coord = np.array(coord)
+                else:
+                    coord = self.last_coord + (self.target - self.last_coord) * 0.05
+                    self.last_coord = coord
+
+                angles = [np.radians(coord[3]), np.radians(coord[4]), np.radians(coord[5])]
+                translate = coord[0:3]
+                m_img = tr.compose_matrix(angles=angles, translate=translate)
+
+            recorder = self.recorder
+            if recorder is not None:
+                recorder.add(timestamp, coord_raw, markers_flag, coord)
+
+            m_img_flip = m_img.copy()
+            m_img_flip[1, -1] = -m_img_flip[1, -1]
+            # self.pipeline.set_message(m_img_flip)
+
+            # The coordinates keep the timestamp of the tracker sample, so the next stages measure the latency
+            # since it was read.
+            self.coord_queue.put_nowait([coord, markers_flag, m_img, view_obj], timestamp=timestamp)
+
+            if self.view_tracts:
+                self.coord_tracts_queue.put_nowait(m_img_flip, timestamp=timestamp)
+            if self.e_field_loaded:
+                self.efield_queue.put_nowait([m_img, coord], timestamp=timestamp)
+
+            self.stats.add(start, timestamp)
 
 
 class CoordinateCorregistrateNoObject(threading.Thread):
@@ -374,38 +656,45 @@ class CoordinateCorregistrateNoObject(threading.Thread):
         self.m_icp = icp.m_icp
         self.efield_queue = queues[3]
         self.e_field_loaded = e_field_loaded
+        self.stats = StageStats(self.name)
+        self.coregistration = Coregistration(coreg_data, ref_mode_id)
+        self.recorder = None
 
     def run(self):
-        coreg_data = self.coreg_data
         view_obj = 0
 
         # print('CoordCoreg: event {}'.format(self.event.is_set()))
         while not self.event.is_set():
             try:
-                if self.icp_queue.empty():
-                    None
-                else:
-                    self.use_icp, self.m_icp = self.icp_queue.get_nowait()
-                # print(f"Set the coordinate")
-                #print(self.icp, self.m_icp)
-                coord_raw, markers_flag = self.tracker.TrackerCoordinates.GetCoordinates()
-                coord, m_img = corregistrate_dynamic(coreg_data, coord_raw, self.ref_mode_id, [self.use_icp, self.m_icp])
-                # print("Coord: ", coord)
-                m_img_flip = m_img.copy()
-                m_img_flip[1, -1] = -m_img_flip[1, -1]
-
-                self.coord_queue.put_nowait([coord, markers_flag, m_img, view_obj])
-
-                if self.view_tracts:
-                    self.coord_tracts_queue.put_nowait(m_img_flip)
-                if self.e_field_loaded:
-                    self.efield_queue.put_nowait([m_img, coord])
-                if not self.icp_queue.empty():
-                    self.icp_queue.task_done()
-            except queue.Full:
+                # Wakes as soon as the tracker gives new coordinates.
+                coord_raw, markers_flag, timestamp = self.tracker.TrackerCoordinates.WaitCoordinates(
+                    const.NAVIGATION_WAIT_TIMEOUT)
+            except queue.Empty:
+                continue
+            start = perf_counter()
+
+            try:
+                self.use_icp, self.m_icp = self.icp_queue.get_nowait()
+            except queue.Empty:
                 pass
-            # The sleep has to be in both threads
-            sleep(self.sle)
+
+            coord, m_img = self.coregistration.corregistrate(coord_raw, [self.use_icp, self.m_icp])
+            # print("Coord: ", coord)
+            recorder = self.recorder
+            if recorder is not None:
+                recorder.add(timestamp, coord_raw, markers_flag, coord)
+
+            m_img_flip = m_img.copy()
+            m_img_flip[1, -1] = -m_img_flip[1, -1]
+
+            self.coord_queue.put_nowait([coord, markers_flag, m_img, view_obj], timestamp=timestamp)
+
+            if self.view_tracts:
+                self.coord_tracts_queue.put_nowait(m_img_flip, timestamp=timestamp)
+            if self.e_field_loaded:
+                self.efield_queue.put_nowait([m_img, coord], timestamp=timestamp)
+
+            self.stats.add(start, timestamp)
 
 
 # class CoregistrationStatic(threading.Thread):
@@ -6,6 +6,9 @@ import numpy as np
 from vtkmodules.vtkCommonCore import (
     vtkIdList)
 
+import invesalius.constants as const
+from invesalius.navigation.pipeline import StageStats
+
 def Get_coil_position(m_img):
     # coil position cp : the center point at the bottom of the coil casing,
     # corresponds to the origin of the coil template.
@@ -46,6 +49,7 @@ class Visualize_E_field_Thread(threading.Thread):
         self.neuronavigation_api = neuronavigation_api
         self.ID_list = vtkIdList()
         self.coord_old = []
+        self.stats = StageStats(self.name)
         if isinstance(debug_efield_enorm, np.ndarray):
             self.enorm_debug = debug_efield_enorm
             self.debug = True
@@ -54,33 +58,26 @@ class Visualize_E_field_Thread(threading.Thread):
 
     def run(self):
         while not self.event.is_set():
+            try:
+                # The IDs are sent by the volume viewer for each new coil position.
+                self.ID_list = self.e_field_IDs_queue.get(timeout=const.NAVIGATION_WAIT_TIMEOUT)
+            except queue.Empty:
+                continue
 
-            if not self.e_field_IDs_queue.empty():
-                try:
-                    self.ID_list = self.e_field_IDs_queue.get_nowait()
-                    self.e_field_IDs_queue.task_done()
-                except queue.Full:
-                    self.e_field_IDs_queue.task_done()
-
-                if not self.efield_queue.empty():
-                    try:
-                        [m_img, coord] = self.efield_queue.get_nowait()
-                        self.efield_queue.task_done()
-                    except queue.Full:
-                        self.efield_queue.task_done()
-
-                    if self.ID_list.GetNumberOfIds() != 0:
-                        if np.all(self.coord_old != coord):
-                            [T_rot, cp] = Get_coil_position(m_img)
-                            if self.debug:
-                                enorm = self.enorm_debug
-                            else:
-                                enorm = self.neuronavigation_api.update_efield(position=cp, orientation=coord[3:], T_rot=T_rot)
-                            try:
-                                self.e_field_norms_queue.put_nowait((enorm))
-                            except queue.Full:
-                                pass
+            try:
+                [m_img, coord], timestamp = self.efield_queue.wait(0)
+            except queue.Empty:
+                continue
+            start = time.perf_counter()
 
-                        self.coord_old = coord
+            if self.ID_list.GetNumberOfIds() != 0:
+                if np.all(self.coord_old != coord):
+                    [T_rot, cp] = Get_coil_position(m_img)
+                    if self.debug:
+                        enorm = self.enorm_debug
+                    else:
+                        enorm = self.neuronavigation_api.update_efield(position=cp, orientation=coord[3:], T_rot=T_rot)
+                    self.e_field_norms_queue.put_nowait((enorm), timestamp=timestamp)
+                    self.stats.add(start, timestamp)
 
-            time.sleep(self.sle)
+                self.coord_old = coord
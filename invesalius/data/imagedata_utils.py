@@ -20,6 +20,8 @@
 import math
 import sys
 import tempfile
+from concurrent import futures
+from multiprocessing import cpu_count
 
 import gdcm
 import imageio
@@ -308,6 +310,32 @@ def array2memmap(arr, filename=None):
     return matrix
 
 
+def _assemble_memmap(nslices, load_slice, update_progress=None, message=""):
+    """
+    Calls load_slice(n) for each slice n in a pool of threads. load_slice
+    must decode the slice, write it into its own region of the memmap and
+    return its (min, max). The progress is updated from the calling thread
+    as the slices are completed. Returns the scalar range of the volume.
+    """
+    min_scalar = None
+    max_scalar = None
+    with futures.ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+        fs = [executor.submit(load_slice, n) for n in range(nslices)]
+        try:
+            for cont, future in enumerate(futures.as_completed(fs)):
+                min_aux, max_aux = future.result()
+                if min_scalar is None or min_aux < min_scalar:
+                    min_scalar = min_aux
+                if max_scalar is None or max_aux > max_scalar:
+                    max_scalar = max_aux
+                if update_progress is not None:
+                    update_progress(cont, message)
+        finally:
+            for future in fs:
+                future.cancel()
+    return min_scalar, max_scalar
+
+
 def bitmap2memmap(files, slice_size, orientation, spacing, resolution_percentage):
     """
     From a list of dicom files it creates memmap file in the temp folder and
@@ -318,6 +346,8 @@ def bitmap2memmap(files, slice_size, orientation, spacing, resolution_percentage
         update_progress = vtk_utils.ShowProgress(
             len(files) - 1, dialog_type="ProgressDialog"
         )
+    else:
+        update_progress = None
 
     temp_file = tempfile.mktemp()
 
@@ -350,80 +380,65 @@ def bitmap2memmap(files, slice_size, orientation, spacing, resolution_percentage
                 math.ceil(slice_size[0] * resolution_percentage),
             )
 
-    if resolution_percentage == 1.0:
-        matrix = numpy.memmap(temp_file, mode="w+", dtype="int16", shape=shape)
-
-    cont = 0
-    max_scalar = None
-    min_scalar = None
-
-    xy_shape = None
-    first_resample_entry = False
+    def read_slice(n):
+        image_as_array = bitmap_reader.ReadBitmap(files[n])
+        if resolution_percentage == 1.0:
+            # No need to go through VTK, the array is used as is.
+            return image_as_array
 
-    for n, f in enumerate(files):
-        image_as_array = bitmap_reader.ReadBitmap(f)
         image = converters.to_vtk(
             image_as_array,
             spacing=spacing,
             slice_number=1,
             orientation=orientation.upper(),
         )
+        image = ResampleImage2D(
+            image,
+            px=None,
+            py=None,
+            resolution_percentage=resolution_percentage,
+            update_progress=None,
+        )
+        array = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())
+        array.shape = image.GetDimensions()[1], image.GetDimensions()[0]
+        return array
 
-        if resolution_percentage != 1.0:
-
-            image_resized = ResampleImage2D(
-                image,
-                px=None,
-                py=None,
-                resolution_percentage=resolution_percentage,
-                update_progress=None,
-            )
-
-            yx_shape = (
-                image_resized.GetDimensions()[1],
-                image_resized.GetDimensions()[0],
-            )
-
-            if not (first_resample_entry):
-                shape = shape[0], yx_shape[0], yx_shape[1]
-                matrix = numpy.memmap(temp_file, mode="w+", dtype="int16", shape=shape)
-                first_resample_entry = True
-
-            image = image_resized
-
-        min_aux, max_aux = image.GetScalarRange()
-        if min_scalar is None or min_aux < min_scalar:
-            min_scalar = min_aux
-
-        if max_scalar is None or max_aux > max_scalar:
-            max_scalar = max_aux
+    # The first slice gives the shape of the resampled slices.
+    first_slice = read_slice(0)
+    if resolution_percentage != 1.0:
+        shape = shape[0], first_slice.shape[0], first_slice.shape[1]
+    matrix = numpy.memmap(temp_file, mode="w+", dtype="int16", shape=shape)
 
-        array = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())
+    def load_slice(n):
+        if n == 0:
+            array = first_slice
+        else:
+            array = read_slice(n)
 
         if array.dtype == "uint16":
-            new_array = np.empty_like(array, dtype=np.int16)
-            new_array = array - 32768
-            array = new_array
+            array = array - 32768
+        # Same casting done when writing into the memmap, so the scalar range
+        # is the one of the written values.
+        array = array.astype("int16")
 
         if orientation == "CORONAL":
             array.shape = matrix.shape[0], matrix.shape[2]
-            matrix[:, n, :] = array[:, ::-1]
+            array = array[:, ::-1]
+            matrix[:, n, :] = array
         elif orientation == "SAGITTAL":
             array.shape = matrix.shape[0], matrix.shape[1]
             # TODO: Verify if it's necessary to add the slices swapped only in
             # sagittal rmi or only in # Rasiane's case or is necessary in all
             # sagittal cases.
-            matrix[:, :, n] = array[:, ::-1]
+            array = array[:, ::-1]
+            matrix[:, :, n] = array
         else:
             array.shape = matrix.shape[1], matrix.shape[2]
             matrix[n] = array
+        return array.min(), array.max()
 
-        if len(files) > 1:
-            update_progress(cont, message)
-        cont += 1
-
+    scalar_range = _assemble_memmap(len(files), load_slice, update_progress, message)
     matrix.flush()
-    scalar_range = min_scalar, max_scalar
 
     return matrix, scalar_range, temp_file
 
@@ -432,12 +447,18 @@ def dcm2memmap(files, slice_size, orientation, resolution_percentage):
     """
     From a list of dicom files it creates memmap file in the temp folder and
     returns it and its related filename.
+
+    The slices are decoded in a pool of threads, each one writing its slice
+    directly into the memmap.
     """
     if len(files) > 1:
         message = _("Generating multiplanar visualization...")
         update_progress = vtk_utils.ShowProgress(
             len(files) - 1, dialog_type="ProgressDialog"
         )
+    else:
+        message = ""
+        update_progress = None
 
     first_slice = read_dcm_slice_as_np2(files[0], resolution_percentage)
     slice_size = first_slice.shape[::-1]
@@ -452,8 +473,15 @@ def dcm2memmap(files, slice_size, orientation, resolution_percentage):
         shape = len(files), slice_size[1], slice_size[0]
 
     matrix = numpy.memmap(temp_file, mode="w+", dtype="int16", shape=shape)
-    for n, f in enumerate(files):
-        im_array = read_dcm_slice_as_np2(f, resolution_percentage)[::-1]
+
+    def load_slice(n):
+        if n == 0:
+            im_array = first_slice[::-1]
+        else:
+            im_array = read_dcm_slice_as_np2(files[n], resolution_percentage)[::-1]
+        # The range is of the values stored, uint16 values above 32767
+        # wrap when stored as int16.
+        im_array = im_array.astype(matrix.dtype, copy=False)
 
         if orientation == "CORONAL":
             matrix[:, shape[1] - n - 1, :] = im_array
@@ -464,11 +492,10 @@ def dcm2memmap(files, slice_size, orientation, resolution_percentage):
             matrix[:, :, n] = im_array
         else:
             matrix[n] = im_array
-        if len(files) > 1:
-            update_progress(n, message)
+        return im_array.min(), im_array.max()
 
+    scalar_range = _assemble_memmap(len(files), load_slice, update_progress, message)
     matrix.flush()
-    scalar_range = matrix.min(), matrix.max()
 
     return matrix, scalar_range, temp_file
 
@@ -24,6 +24,7 @@ import shutil
 import tempfile
 import time
 import weakref
+import zlib
 
 import invesalius.constants as const
 import invesalius.data.converters as converters
@@ -37,20 +38,93 @@ from vtkmodules.util import numpy_support
 
 
 class EditionHistoryNode(object):
-    def __init__(self, index, orientation, array, clean=False):
+    """
+    A state of the mask (a slice or the whole volume) kept by the edition
+    history. The array is kept run-length encoded and compressed. If
+    reference (the node of the previous state) is given only the voxels
+    where the array differs from it are kept. The data is moved to a
+    temporary file by spill.
+    """
+
+    def __init__(self, index, orientation, array, clean=False, reference=None, reference_array=None):
         self.index = index
         self.orientation = orientation
-        self.filename = tempfile.mktemp(suffix='.npy')
         self.clean = clean
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.filename = None
+
+        if reference is not None and (reference.shape, reference.dtype) == (self.shape, self.dtype):
+            if reference_array is None:
+                reference_array = reference.get_array()
+            self.reference = reference
+            self._data = self._encode_delta(array, reference_array)
+        else:
+            self.reference = None
+            self._data = self._encode_array(array)
+
+    @staticmethod
+    def _compress(array):
+        return np.frombuffer(zlib.compress(array.tobytes(), 1), dtype=np.uint8)
+
+    @staticmethod
+    def _decompress(data, dtype):
+        return np.frombuffer(zlib.decompress(data.tobytes()), dtype=dtype)
+
+    def _encode_array(self, array):
+        # The masks are made of long runs of the same value.
+        flat = array.ravel()
+        starts = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        starts = np.concatenate(([0], starts)).astype(np.int64)
+        return [self._compress(starts), self._compress(flat[starts])]
+
+    def _encode_delta(self, array, reference_array):
+        flat = array.ravel()
+        positions = np.flatnonzero(flat != reference_array.ravel()).astype(np.int64)
+        return [self._compress(positions), self._compress(flat[positions])]
+
+    def _load_data(self):
+        if self._data is not None:
+            return self._data
+        with np.load(self.filename) as f:
+            return [f['arr_%d' % i] for i in range(len(f.files))]
+
+    def get_array(self):
+        positions, values = self._load_data()
+        positions = self._decompress(positions, np.int64)
+        values = self._decompress(values, self.dtype)
+        if self.reference is None:
+            size = int(np.prod(self.shape))
+            lengths = np.diff(np.append(positions, size))
+            array = np.repeat(values, lengths)
+        else:
+            array = self.reference.get_array().ravel().copy()
+            array[positions] = values
+        return array.reshape(self.shape)
 
-        self._save_array(array)
+    @property
+    def nbytes(self):
+        """
+        Memory used by the encoded data, 0 if it was moved to disk.
+        """
+        if self._data is None:
+            return 0
+        return sum(i.nbytes for i in self._data)
 
-    def _save_array(self, array):
-        np.save(self.filename, array)
-        print("Saving history", self.index, self.orientation, self.filename, self.clean)
+    def spill(self):
+        """
+        Moves the encoded data to a temporary file.
+        """
+        if self._data is None:
+            return
+        fd, filename = tempfile.mkstemp(suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, *self._data)
+        self.filename = filename
+        self._data = None
 
     def commit_history(self, mvolume):
-        array = np.load(self.filename)
+        array = self.get_array()
         if self.orientation == 'AXIAL':
             mvolume[self.index+1,1:,1:] = array
             if self.clean:
@@ -64,30 +138,44 @@ class EditionHistoryNode(object):
             if self.clean:
                 mvolume[0, 0, self.index+1] = 1
         elif self.orientation == 'VOLUME':
-            mvolume[:] = array
+            if self.index == 0:
+                mvolume[:] = array
+            else:
+                # Only the region given by index (a tuple of slices) was
+                # changed.
+                mvolume[self.index] = array
 
         print("applying to", self.orientation, "at slice", self.index)
 
     def __del__(self):
-        print("Removing", self.filename)
-        os.remove(self.filename)
+        if self.filename is not None:
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
 
 
 class EditionHistory(object):
-    def __init__(self, size=50):
+    def __init__(self, size=50, memory_size=None):
         self.history = []
         self.index = -1
         self.size = size * 2
 
+        if memory_size is None:
+            session = ses.Session()
+            memory_size = session.GetConfig('undo_history_size', const.UNDO_HISTORY_SIZE)
+        self.memory_size = memory_size * 1024 * 1024
+
         Publisher.sendMessage("Enable undo", value=False)
         Publisher.sendMessage("Enable redo", value=False)
 
     def new_node(self, index, orientation, array, p_array, clean):
-        # Saving the previous state, used to undo/redo correctly.
+        # Saving the previous state, used to undo/redo correctly. The new
+        # state is kept as the difference from it.
         p_node = EditionHistoryNode(index, orientation, p_array, clean)
         self.add(p_node)
 
-        node = EditionHistoryNode(index, orientation, array, clean)
+        node = EditionHistoryNode(index, orientation, array, clean, p_node, p_array)
         self.add(node)
 
     def add(self, node):
@@ -99,6 +187,7 @@ class EditionHistory(object):
             self.history = self.history[:self.index + 1]
         self.history.append(node)
         self.index += 1
+        self._spill()
 
         print("INDEX", self.index, len(self.history), self.history)
         Publisher.sendMessage("Enable undo", value=True)
@@ -159,6 +248,18 @@ class EditionHistory(object):
             Publisher.sendMessage("Enable redo", value=False)
         print("AT", self.index, len(h), h[self.index].filename)
 
+    def _spill(self):
+        """
+        Moves the oldest states to disk while the history uses more memory
+        than memory_size.
+        """
+        nbytes = sum(node.nbytes for node in self.history)
+        for node in self.history:
+            if nbytes <= self.memory_size:
+                break
+            nbytes -= node.nbytes
+            node.spill()
+
     def _reload_slice(self, index):
         Publisher.sendMessage(('Set scroll position', self.history[index].orientation),
                               index=self.history[index].index)
@@ -204,6 +305,9 @@ class Mask():
         self.volume = None
         self.auto_update_mask = True
         self.modified_time = 0
+        # Increased every time the threshold changes and the slices must be
+        # thresholded again.
+        self.threshold_generation = 0
         self.__bind_events()
         self._modified_callbacks = []
 
@@ -400,6 +504,35 @@ class Mask():
                 callbacks.append(callback)
         self._modified_callbacks = callbacks
 
+    def invalidate_threshold(self):
+        """
+        Marks all the slices as not thresholded, so they're thresholded
+        again when accessed. Only the flags (the first plane of each
+        dimension) are reset, the voxels are not touched, the ones written
+        before are ignored using get_fresh_voxels.
+        """
+        self.threshold_generation += 1
+        self.matrix[0] = 0
+        self.matrix[:, 0, :] = 0
+        self.matrix[:, :, 0] = 0
+
+    def get_fresh_voxels(self, orientation):
+        """
+        Returns a boolean array, broadcastable to the slices of the given
+        orientation, which is True in the voxels written since the last
+        invalidate_threshold. Those are the voxels where at least one of the
+        slices of the other orientations crossing it was thresholded.
+        """
+        flags_z = self.matrix[1:, 0, 0] != 0
+        flags_y = self.matrix[0, 1:, 0] != 0
+        flags_x = self.matrix[0, 0, 1:] != 0
+        if orientation == "AXIAL":
+            return flags_y[:, np.newaxis] | flags_x[np.newaxis, :]
+        elif orientation == "CORONAL":
+            return flags_z[:, np.newaxis] | flags_x[np.newaxis, :]
+        else:
+            return flags_z[:, np.newaxis] | flags_y[np.newaxis, :]
+
     def clean(self):
         self.matrix[1:, 1:, 1:] = 0
         self.modified(all_volume=True)
@@ -17,55 +17,269 @@
 #    detalhes.
 #--------------------------------------------------------------------------
 
+import json
+import os
+import struct
 import threading
 import time
 
-import wx
-from numpy import array, savetxt, hstack,vstack, asarray
-import invesalius.gui.dialogs as dlg
+import numpy as np
+
 from invesalius.pubsub import pub as Publisher
+from invesalius.utils import debug
+
+# The recording file starts with RECORD_MAGIC, followed by the length (uint32,
+# little endian) of a JSON header and the header itself. The records come
+# next, one after the other, with the dtype given in the header. The file is
+# only appended to, so a recording interrupted by a crash keeps all the
+# records flushed until then.
+RECORD_MAGIC = b'INVNREC\x00'
+RECORD_VERSION = 1
+RECORD_EXTENSION = 'nrec'
+
+# Number of records of each chunk of the ring buffer, a chunk is written to
+# the file as soon as it's full.
+CHUNK_SIZE = 512
+
+# Number of chunks of the ring buffer. The records not written yet when the
+# buffer wraps around are lost (and counted in dropped).
+N_CHUNKS = 32
+
+# Maximum time, in seconds, the records stay in the buffer before being
+# written to the file.
+FLUSH_INTERVAL = 1.0
+
+
+def get_record_dtype(n_markers):
+    """
+    Returns the dtype of the records of a tracker giving the coordinates of
+    n_markers markers.
+    """
+    return np.dtype([
+        # Seconds since the start of the recording.
+        ('time', '<f8'),
+        ('coord_raw', '<f8', (n_markers, 6)),
+        ('markers_flag', '<i4', (3,)),
+        # The co-registered coordinates, x, y, z, a, b, g.
+        ('coord', '<f8', (6,)),
+        ('at_target', 'u1'),
+    ])
+
+
+def _dtype_from_descr(descr):
+    # The shapes of the fields are lists in the JSON header.
+    fields = []
+    for field in descr:
+        if len(field) > 2:
+            fields.append((field[0], field[1], tuple(field[2])))
+        else:
+            fields.append((field[0], field[1]))
+    return np.dtype(fields)
+
+
+def read_recording(filename):
+    """
+    Returns the records of the recording filename as a structured array
+    (see get_record_dtype) and its header. A partial record at the end of
+    the file (from a recording interrupted while writing) is ignored.
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(RECORD_MAGIC)) != RECORD_MAGIC:
+            raise ValueError("%s is not a navigation recording" % filename)
+        (header_size,) = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_size).decode('utf-8'))
+        if header['version'] > RECORD_VERSION:
+            raise ValueError("%s was recorded by a newer version" % filename)
+        dtype = _dtype_from_descr(header['dtype'])
+        count = (os.fstat(f.fileno()).st_size - f.tell()) // dtype.itemsize
+        records = np.fromfile(f, dtype=dtype, count=count)
+    return records, header
+
+
+def export_csv(filename, csv_filename, interval=None):
+    """
+    Saves the co-registered coordinates of the recording filename as a CSV
+    file. If interval is given only the last coordinates of each interval
+    seconds are saved, otherwise all of them. The last coordinates of the
+    recording are always saved.
+    """
+    records, header = read_recording(filename)
+    times = records['time']
+    if interval and len(records):
+        grid = np.arange(times[0], times[-1], interval)
+        if not len(grid) or grid[-1] < times[-1]:
+            grid = np.append(grid, times[-1])
+        records = records[np.searchsorted(times, grid, side='right') - 1]
+        times = grid
+    coord_list = np.hstack((times[:, np.newaxis], records['coord']))
+    np.savetxt(csv_filename, coord_list, delimiter=',', fmt='%.4f', header="time, x, y, z, a, b, g", comments="")
 
 
-class Record(threading.Thread):
+class NavigationRecorder(threading.Thread):
     """
-    Thread created to save obj coords with software during neuronavigation
+    Records the coordinates of the navigation to an append-only binary file
+    (see read_recording). For each tracker sample it keeps its time, the raw
+    coordinates and marker flags given by the tracker, the co-registered
+    coordinates and if the coil is at the target.
+
+    add is called by the co-registration for every sample and only copies
+    it into a preallocated ring buffer of n_chunks chunks of chunk_size
+    records. The thread writes the records to the file whenever a chunk is
+    full or every flush_interval seconds, so the cost of recording doesn't
+    grow with the length of the session and the navigation never waits for
+    the disk.
     """
 
-    def __init__(self, nav_id, timestamp):
-        threading.Thread.__init__(self)
-        self.nav_id = nav_id
-        self.coord = None
-        self.timestamp = timestamp
-        self.coord_list = array([])
+    def __init__(self, filename, chunk_size=CHUNK_SIZE, n_chunks=N_CHUNKS, flush_interval=FLUSH_INTERVAL):
+        threading.Thread.__init__(self, name='NavigationRecorder', daemon=True)
+        self.filename = str(filename)
+        self.chunk_size = chunk_size
+        self.size = chunk_size * n_chunks
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._buffer = None
+        self._file = None
+        self._start_time = time.time()
+        self._start = time.perf_counter()
+
+        # Total of records added, written to the file and overwritten in the
+        # buffer before being written.
+        self.added = 0
+        self.written = 0
+        self.dropped = 0
+
+        self.at_target = False
         self.__bind_events()
-        self._pause_ = False
-        self.start()
 
     def __bind_events(self):
-        # Publisher.subscribe(self.UpdateCurrentCoords, 'Co-registered points')
-        Publisher.subscribe(self.UpdateCurrentCoords, 'Set cross focal point')
+        Publisher.subscribe(self.CoilAtTarget, 'Coil at target')
+
+    def CoilAtTarget(self, state):
+        self.at_target = state
 
-    def UpdateCurrentCoords(self, position):
-        self.coord = asarray(position)
+    def add(self, timestamp, coord_raw, markers_flag, coord):
+        """
+        Adds a sample read at timestamp (time.perf_counter).
+        """
+        with self._lock:
+            if self._buffer is None:
+                n_markers = np.shape(coord_raw)[0]
+                self._buffer = np.zeros(self.size, dtype=get_record_dtype(n_markers))
+            self._buffer[self.added % self.size] = (
+                timestamp - self._start, coord_raw, markers_flag, coord, self.at_target
+            )
+            self.added += 1
+            full = self.added - self.written >= self.chunk_size
+        if full:
+            self._wake.set()
+
+    def _take(self):
+        """
+        Returns a copy of the records not written yet, from the oldest to
+        the newest, and marks them as written.
+        """
+        with self._lock:
+            if self._buffer is None or self.added == self.written:
+                return None
+            if self.added - self.written > self.size:
+                self.dropped += self.added - self.written - self.size
+                self.written = self.added - self.size
+            start = self.written % self.size
+            end = start + self.added - self.written
+            if end <= self.size:
+                records = self._buffer[start:end].copy()
+            else:
+                records = np.concatenate((self._buffer[start:], self._buffer[:end - self.size]))
+            self.written = self.added
+        return records
+
+    def _write_header(self, dtype):
+        header = json.dumps({
+            'version': RECORD_VERSION,
+            'dtype': dtype.descr,
+            'start_time': self._start_time,
+        }).encode('utf-8')
+        self._file.write(RECORD_MAGIC + struct.pack('<I', len(header)) + header)
+
+    def flush(self):
+        records = self._take()
+        if records is None:
+            return
+        if self._file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+            self._file = open(self.filename, 'wb')
+            self._write_header(records.dtype)
+        self._file.write(records.tobytes())
+        self._file.flush()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except OSError as err:
+                debug("Error writing the navigation recording %s: %s" % (self.filename, err))
+                return
 
     def stop(self):
-        self._pause_ = True
-        #save coords dialog
-        filename = dlg.ShowLoadSaveDialog(message=_(u"Save coords as..."),
-                                          wildcard=_("Coordinates files (*.csv)|*.csv"),
-                                          style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT,
-                                          default_filename="coords.csv", save_ext="csv")
-        if filename:
-            savetxt(filename, self.coord_list, delimiter=',', fmt='%.4f', header="time, x, y, z, a, b, g", comments="")
+        """
+        Stops the recording, writing the records left and closing the file.
+        """
+        self._stop_event.set()
+        self._wake.set()
+        if self.is_alive():
+            self.join()
+        try:
+            self.flush()
+        except OSError as err:
+            debug("Error writing the navigation recording %s: %s" % (self.filename, err))
+        finally:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        if self.dropped:
+            debug("Navigation recording %s: %d records dropped" % (self.filename, self.dropped))
+
+
+class ReplayCoordinates(threading.Thread):
+    """
+    Replays a navigation recording as if it came from the tracker, setting
+    its raw coordinates in TrackerCoordinates with the times they were
+    recorded, speed times faster (as fast as possible if speed is 0).
+
+    With lossless, each sample waits for the previous one to be taken by the
+    co-registration, so all of them go through the navigation pipeline
+    instead of only the latest.
+    """
+
+    def __init__(self, filename, TrackerCoordinates, event, speed=1.0, lossless=False):
+        threading.Thread.__init__(self, name='ReplayCoordinates')
+        self.records, self.header = read_recording(filename)
+        self.TrackerCoordinates = TrackerCoordinates
+        self.event = event
+        self.speed = speed
+        self.lossless = lossless
 
     def run(self):
-        initial_time = time.time()
-        while self.nav_id:
-            relative_time = asarray(time.time() - initial_time)
-            time.sleep(self.timestamp)
-            if self.coord_list.size == 0:
-                self.coord_list = hstack((relative_time, self.coord))
-            else:
-                self.coord_list = vstack((self.coord_list, hstack((relative_time, self.coord))))
-            if self._pause_:
+        if not len(self.records):
+            return
+        channel = self.TrackerCoordinates.channel
+        first = self.records['time'][0]
+        start = time.perf_counter()
+        for record in self.records:
+            if self.speed:
+                wait = start + (record['time'] - first) / self.speed - time.perf_counter()
+                if wait > 0 and self.event.wait(wait):
+                    return
+            if self.lossless:
+                while not channel.wait_empty(0.1):
+                    if self.event.is_set():
+                        return
+            if self.event.is_set():
                 return
+            self.TrackerCoordinates.SetCoordinates(record['coord_raw'].copy(), record['markers_flag'].tolist(),
+                                                   timestamp=time.perf_counter())
@@ -0,0 +1,189 @@
+# --------------------------------------------------------------------------
+# Software:     InVesalius - Software de Reconstrucao 3D de Imagens Medicas
+# Copyright:    (C) 2001  Centro de Pesquisas Renato Archer
+# Homepage:     http://www.softwarepublico.gov.br
+# Contact:      invesalius@cti.gov.br
+# License:      GNU - GPL 2 (LICENSE.txt/LICENCA.txt)
+# --------------------------------------------------------------------------
+#    Este programa e software livre; voce pode redistribui-lo e/ou
+#    modifica-lo sob os termos da Licenca Publica Geral GNU, conforme
+#    publicada pela Free Software Foundation; de acordo com a versao 2
+#    da Licenca.
+#
+#    Este programa eh distribuido na expectativa de ser util, mas SEM
+#    QUALQUER GARANTIA; sem mesmo a garantia implicita de
+#    COMERCIALIZACAO ou de ADEQUACAO A QUALQUER PROPOSITO EM
+#    PARTICULAR. Consulte a Licenca Publica Geral GNU para obter mais
+#    detalhes.
+# --------------------------------------------------------------------------
+import numpy as np
+
+import invesalius.constants as const
+
+
+class PlaneDeque(object):
+    """
+    Deque of planes (2D numpy arrays) which keeps the aggregate of all its
+    planes given by op (np.maximum, np.minimum). It's implemented with two
+    stacks, each item keeping the aggregate of itself and the items below
+    it, so pushing, popping (amortized) and getting the aggregate cost one
+    plane operation. If op is None no aggregate is kept.
+    """
+
+    def __init__(self, op=None):
+        self.op = op
+        # The last item of _front is the first plane and the last item of
+        # _back is the last plane.
+        self._front = []
+        self._back = []
+
+    def __len__(self):
+        return len(self._front) + len(self._back)
+
+    def _push(self, stack, plane):
+        if self.op is None or not stack:
+            agg = plane
+        else:
+            agg = self.op(plane, stack[-1][1])
+        stack.append((plane, agg))
+
+    def _refill(self, stack, planes):
+        del stack[:]
+        for plane in planes:
+            self._push(stack, plane)
+
+    def planes(self):
+        """
+        Returns the planes from the first to the last one.
+        """
+        return [p for p, _ in reversed(self._front)] + [p for p, _ in self._back]
+
+    def push_front(self, plane):
+        self._push(self._front, plane)
+
+    def push_back(self, plane):
+        self._push(self._back, plane)
+
+    def pop_front(self):
+        if not self._front:
+            # Moves half of the planes to the front stack.
+            planes = self.planes()
+            half = (len(planes) + 1) // 2
+            self._refill(self._front, planes[:half][::-1])
+            self._refill(self._back, planes[half:])
+        return self._front.pop()[0]
+
+    def pop_back(self):
+        if not self._back:
+            planes = self.planes()
+            half = len(planes) // 2
+            self._refill(self._front, planes[:half][::-1])
+            self._refill(self._back, planes[half:])
+        return self._back.pop()[0]
+
+    def aggregate(self):
+        if self._front and self._back:
+            return self.op(self._front[-1][1], self._back[-1][1])
+        elif self._front:
+            return self._front[-1][1]
+        else:
+            return self._back[-1][1]
+
+    def clear(self):
+        self._front = []
+        self._back = []
+
+
+class SlabProjection(object):
+    """
+    Keeps the planes of a thick slab [start, end) and the running state of
+    its projection, so moving the slab by a few slices only reads the
+    planes entering it. MaxIP and MinIP use a PlaneDeque, MeanIP a running
+    sum. The other projections (LMIP, MIDA and contour ones) depend on the
+    order of the planes, for them the planes already read are reused and
+    only stacked again.
+    """
+
+    def __init__(self, projection):
+        self.projection = projection
+        self.start = 0
+        self.end = 0
+        if projection == const.PROJECTION_MaxIP:
+            op = np.maximum
+        elif projection == const.PROJECTION_MinIP:
+            op = np.minimum
+        else:
+            op = None
+        self._planes = PlaneDeque(op)
+        self._sum = None
+
+    def _push_front(self, plane):
+        self._planes.push_front(plane)
+        if self.projection == const.PROJECTION_MeanIP:
+            if self._sum is None:
+                self._sum = plane.astype("float64")
+            else:
+                self._sum += plane
+
+    def _push_back(self, plane):
+        self._planes.push_back(plane)
+        if self.projection == const.PROJECTION_MeanIP:
+            if self._sum is None:
+                self._sum = plane.astype("float64")
+            else:
+                self._sum += plane
+
+    def _pop_front(self):
+        plane = self._planes.pop_front()
+        if self.projection == const.PROJECTION_MeanIP:
+            self._sum -= plane
+
+    def _pop_back(self):
+        plane = self._planes.pop_back()
+        if self.projection == const.PROJECTION_MeanIP:
+            self._sum -= plane
+
+    def move(self, start, end, read_plane):
+        """
+        Moves the slab to [start, end). read_plane(n) must return the plane
+        n as a 2D array. If the slab moved more than its own size it's read
+        again.
+        """
+        if (
+            not len(self._planes)
+            or abs(start - self.start) + abs(end - self.end) >= end - start
+        ):
+            self._planes.clear()
+            self._sum = None
+            self.start = self.end = start
+
+        # First the planes entering the slab, so it's never empty.
+        while self.end < end:
+            self._push_back(read_plane(self.end))
+            self.end += 1
+        while self.start > start:
+            self.start -= 1
+            self._push_front(read_plane(self.start))
+        while self.start < start:
+            self._pop_front()
+            self.start += 1
+        while self.end > end:
+            self._pop_back()
+            self.end -= 1
+
+    def get_projection(self):
+        """
+        Returns the MaxIP, MinIP or MeanIP of the slab.
+        """
+        if self.projection == const.PROJECTION_MeanIP:
+            return self._sum / len(self._planes)
+        return np.array(self._planes.aggregate())
+
+    def get_slab(self, axis, inverted=False):
+        """
+        Returns the slab as a 3D array, stacking the planes along axis.
+        """
+        planes = self._planes.planes()
+        if inverted:
+            planes = planes[::-1]
+        return np.stack(planes, axis)
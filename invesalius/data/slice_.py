@@ -16,8 +16,12 @@
 #    PARTICULAR. Consulte a Licenca Publica Geral GNU para obter mais
 #    detalhes.
 # --------------------------------------------------------------------------
+import collections
 import os
+from concurrent import futures
+from multiprocessing import cpu_count
 import tempfile
+import threading
 
 import numpy as np
 from scipy import ndimage
@@ -44,6 +48,8 @@ import invesalius.style as st
 import invesalius.utils as utils
 from invesalius.data import transformations
 from invesalius.data.mask import Mask
+from invesalius.data.slab_projection import SlabProjection
+from invesalius.data.slice_compositor import SliceCompositor
 from invesalius.project import Project
 from invesalius_cy import mips, transforms
 
@@ -51,11 +57,150 @@ OTHER = 0
 PLIST = 1
 WIDGET = 2
 
+# Values set in the mask by the edition tools, they are kept when the mask
+# is thresholded.
+EDITED_VALUES = np.zeros(256, dtype=bool)
+EDITED_VALUES[[1, 2, 253, 254]] = True
+
+# Number of voxels thresholded at once by each thread.
+THRESHOLD_BLOCK_VOXELS = 4 * 1024 * 1024
+
+
+def threshold_array(image, mask, thresh_min, thresh_max, fresh=None):
+    """
+    Returns an uint8 array with 255 where thresh_min <= image <= thresh_max
+    and 0 otherwise, keeping the values of mask set by the edition tools (1,
+    2, 253 and 254). If fresh is given the values are only kept where it's
+    True (see Mask.get_fresh_voxels). Only temporaries of the size of image
+    are created and numpy releases the GIL, so it can be used from many
+    threads.
+    """
+    m = np.greater_equal(image, thresh_min)
+    m &= np.less_equal(image, thresh_max)
+    out = m.view(np.uint8)
+    out *= 255
+    edited = np.take(EDITED_VALUES, mask)
+    if fresh is not None:
+        edited &= fresh
+    np.copyto(out, mask, where=edited)
+    return out
+
+
+
+class SliceCache(object):
+    """
+    LRU cache of the slices already shown in one orientation, so scrolling
+    back and forth doesn't slice the matrix and colour it again. It keeps
+    the image (numpy array and the coloured vtkImageData) and the mask
+    (numpy array and the coloured vtkImageData) of each slice, bounded by
+    max_size bytes.
+
+    It's accessed by the prefetch thread, so all the access is done holding
+    a lock. The generation is increased every time the images are discarded,
+    this way images computed before that are not added.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.generation = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _nbytes(self, data):
+        nbytes = 0
+        for d in data:
+            if d is None:
+                continue
+            elif isinstance(d, np.ndarray):
+                nbytes += d.nbytes
+            else:
+                nbytes += d.GetActualMemorySize() * 1024
+        return nbytes
+
+    def _get(self, key):
+        with self._lock:
+            try:
+                data, nbytes = self._entries[key]
+            except KeyError:
+                return None
+            self._entries.move_to_end(key)
+            return data
+
+    def _set(self, key, data, generation=None):
+        nbytes = self._nbytes(data)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if nbytes > self.max_size:
+                return
+            try:
+                self.size -= self._entries.pop(key)[1]
+            except KeyError:
+                pass
+            self._entries[key] = (data, nbytes)
+            self.size += nbytes
+            while self.size > self.max_size:
+                _, (_, old_nbytes) = self._entries.popitem(last=False)
+                self.size -= old_nbytes
+
+    def _discard(self, kind, keep_numpy=False):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == kind]:
+                data, nbytes = self._entries.pop(key)
+                self.size -= nbytes
+                if keep_numpy and data[0] is not None:
+                    data = (data[0], None)
+                    nbytes = self._nbytes(data)
+                    self._entries[key] = (data, nbytes)
+                    self.size += nbytes
+
+    def has_image(self, key):
+        with self._lock:
+            return ("image", key) in self._entries
+
+    def get_image(self, key):
+        """
+        Returns (n_image, vtk_image) or None. vtk_image may be None.
+        """
+        return self._get(("image", key))
+
+    def set_image(self, key, n_image, vtk_image=None, generation=None):
+        self._set(("image", key), (n_image, vtk_image), generation)
+
+    def get_mask(self, key):
+        """
+        Returns (n_mask, vtk_mask) or None. vtk_mask may be None.
+        """
+        return self._get(("mask", key))
+
+    def set_mask(self, key, n_mask, vtk_mask=None):
+        self._set(("mask", key), (n_mask, vtk_mask))
+
+    def discard_images(self):
+        with self._lock:
+            self.generation += 1
+        self._discard("image")
+
+    def discard_vtk_images(self):
+        self._discard("image", keep_numpy=True)
+
+    def discard_masks(self):
+        self._discard("mask")
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.size = 0
+
 
 class SliceBuffer(object):
     """
-    This class is used as buffer that mantains the vtkImageData and numpy array
-    from actual slices from each orientation.
+    This class is used as buffer that mantains the numpy arrays and the
+    coloured layers (the RGB image and the RGBA mask given by SliceCompositor)
+    from actual slices from each orientation. The slices shown before are kept
+    in its cache.
     """
 
     def __init__(self):
@@ -64,18 +209,30 @@ class SliceBuffer(object):
         self.mask = None
         self.vtk_image = None
         self.vtk_mask = None
+        # Running state of the thick slab projection (see SlabProjection).
+        self.slab = None
+
+        session = ses.Session()
+        cache_size = session.GetConfig("slice_cache_size", const.SLICE_CACHE_SIZE)
+        # The memory is shared by the three orientations.
+        self.cache = SliceCache(cache_size * 1024 * 1024 // 3)
 
     def discard_vtk_mask(self):
         self.vtk_mask = None
+        self.cache.discard_masks()
 
     def discard_vtk_image(self):
         self.vtk_image = None
+        self.cache.discard_vtk_images()
 
     def discard_mask(self):
         self.mask = None
+        self.cache.discard_masks()
 
     def discard_image(self):
         self.image = None
+        self.slab = None
+        self.cache.discard_images()
 
     def discard_buffer(self):
         self.index = -1
@@ -83,6 +240,88 @@ class SliceBuffer(object):
         self.mask = None
         self.vtk_image = None
         self.vtk_mask = None
+        self.slab = None
+        self.cache.clear()
+
+
+class SlicePrefetcher(threading.Thread):
+    """
+    Reads in background the slices next to the one being shown, in the
+    scroll direction, and keeps them in the cache of its orientation. Only
+    the last request is attended, older ones are dropped.
+    """
+
+    def __init__(self, slice_):
+        threading.Thread.__init__(self, name="SlicePrefetcher")
+        self.daemon = True
+        self.slice_ = slice_
+        self._request = None
+        self._condition = threading.Condition()
+        self._working = threading.Lock()
+
+    def request(self, buffer_, orientation, slice_numbers, params):
+        with self._condition:
+            self._request = (
+                buffer_,
+                orientation,
+                slice_numbers,
+                params,
+                buffer_.cache.generation,
+            )
+            self._condition.notify()
+
+    def cancel(self):
+        """
+        Drops the pending request and waits the slice being read, if any.
+        Must be called before closing the matrix.
+        """
+        with self._condition:
+            self._request = None
+        with self._working:
+            pass
+
+    def run(self):
+        while True:
+            with self._condition:
+                while self._request is None:
+                    self._condition.wait()
+                request = self._request
+                self._request = None
+                # Taken before releasing the condition, so cancel always
+                # waits for this request.
+                self._working.acquire()
+
+            try:
+                self._prefetch(*request)
+            finally:
+                self._working.release()
+
+    def _prefetch(self, buffer_, orientation, slice_numbers, params, generation):
+        number_slices, inverted, border_size = params
+        for slice_number in slice_numbers:
+            key = (slice_number,) + params
+            # A new request arrived, the old one is not useful anymore.
+            if (
+                self._request is not None
+                or generation != buffer_.cache.generation
+            ):
+                break
+            if buffer_.cache.has_image(key):
+                continue
+            try:
+                n_image = self.slice_._get_image_slice(
+                    orientation,
+                    slice_number,
+                    number_slices,
+                    inverted,
+                    border_size,
+                )
+            except Exception as err:
+                # The matrix may be replaced while reading it, the slices
+                # are just read again when shown.
+                utils.debug("Error prefetching slice: %s" % err)
+                break
+            buffer_.cache.set_image(key, n_image, generation=generation)
 
 
 # Only one slice will be initialized per time (despite several viewers
@@ -94,6 +333,7 @@ class Slice(metaclass=utils.Singleton):
         self.blend_filter = None
         self.histogram = None
         self._matrix = None
+        self._matrix_min = None
         self._affine = np.identity(4)
         self._n_tracts = 0
         self._tracker = None
@@ -134,6 +374,11 @@ class Slice(metaclass=utils.Singleton):
         self.__bind_events()
         self.opacity = 0.8
 
+        self._prefetcher = SlicePrefetcher(self)
+        self._prefetcher.start()
+
+        self.compositor = SliceCompositor(self)
+
     @property
     def matrix(self):
         return self._matrix
@@ -141,7 +386,10 @@ class Slice(metaclass=utils.Singleton):
     @matrix.setter
     def matrix(self, value):
         self._matrix = value
+        for buffer_ in self.buffer_slices.values():
+            buffer_.discard_buffer()
         i, e = value.min(), value.max()
+        self._matrix_min = i
         r = int(e) - int(i)
         self.histogram = np.histogram(self._matrix, r, (i, e))[0]
         self.center = [
@@ -331,9 +579,14 @@ class Slice(metaclass=utils.Singleton):
         self.CloseProject()
 
     def CloseProject(self):
+        self._prefetcher.cancel()
+        for buffer_ in self.buffer_slices.values():
+            buffer_.discard_buffer()
+
         f = self._matrix.filename
         self._matrix._mmap.close()
         self._matrix = None
+        self._matrix_min = None
         os.remove(f)
         self.current_mask = None
 
@@ -393,7 +646,12 @@ class Slice(metaclass=utils.Singleton):
         proj = Project()
         index = proj.mask_dict.get_key(self.current_mask)
         self.num_gradient += 1
-        self.current_mask.matrix[:] = 0
+        if self.current_mask.volume is not None:
+            # The 3D preview shows the voxels of the mask directly.
+            self.current_mask.matrix[:] = 0
+        else:
+            # The slices are thresholded again only when accessed.
+            self.current_mask.invalidate_threshold()
         self.current_mask.clear_history()
 
         if self.current_mask.auto_update_mask and self.current_mask.volume is not None:
@@ -625,80 +883,100 @@ class Slice(metaclass=utils.Singleton):
     def GetSlices(
         self, orientation, slice_number, number_slices, inverted=False, border_size=1.0
     ):
+        buffer_ = self.buffer_slices[orientation]
+        key = self._get_cache_key(slice_number, number_slices, inverted, border_size)
         if (
-            self.buffer_slices[orientation].index == slice_number
+            buffer_.index == slice_number
             and self._type_projection == const.PROJECTION_NORMAL
         ):
-            if self.buffer_slices[orientation].vtk_image:
-                image = self.buffer_slices[orientation].vtk_image
+            if buffer_.vtk_image is not None:
+                image = buffer_.vtk_image
             else:
                 n_image = self.get_image_slice(
                     orientation, slice_number, number_slices, inverted, border_size
                 )
-                image = converters.to_vtk(
-                    n_image, self.spacing, slice_number, orientation
+                image = self.compositor.colour_image(
+                    n_image, slice_number, orientation
                 )
-                ww_wl_image = self.do_ww_wl(image)
-                image = self.do_colour_image(ww_wl_image)
+                buffer_.cache.set_image(key, n_image, image)
             if self.current_mask and self.current_mask.is_shown:
-                if self.buffer_slices[orientation].vtk_mask:
+                if buffer_.vtk_mask is not None:
                     # Prints that during navigation causes delay in update
                     # print "Getting from buffer"
-                    mask = self.buffer_slices[orientation].vtk_mask
+                    mask = buffer_.vtk_mask
                 else:
                     # Prints that during navigation causes delay in update
                     # print "Do not getting from buffer"
                     n_mask = self.get_mask_slice(orientation, slice_number)
-                    mask = converters.to_vtk(
-                        n_mask, self.spacing, slice_number, orientation
+                    mask = self.compositor.colour_mask(n_mask)
+                    buffer_.mask = n_mask
+                    buffer_.cache.set_mask(
+                        self._get_mask_cache_key(slice_number), n_mask, mask
                     )
-                    mask = self.do_colour_mask(mask, self.opacity)
-                    self.buffer_slices[orientation].mask = n_mask
-                final_image = self.do_blend(image, mask)
-                self.buffer_slices[orientation].vtk_mask = mask
+                final_image = self.compositor.blend(image, mask)
+                buffer_.vtk_mask = mask
             else:
                 final_image = image
-            self.buffer_slices[orientation].vtk_image = image
+            buffer_.vtk_image = image
         else:
-            n_image = self.get_image_slice(
-                orientation, slice_number, number_slices, inverted, border_size
-            )
-            image = converters.to_vtk(n_image, self.spacing, slice_number, orientation)
-            ww_wl_image = self.do_ww_wl(image)
-            image = self.do_colour_image(ww_wl_image)
+            cached = buffer_.cache.get_image(key)
+            if cached is not None and cached[1] is not None:
+                n_image, image = cached
+                buffer_.image = n_image
+            else:
+                n_image = self.get_image_slice(
+                    orientation, slice_number, number_slices, inverted, border_size
+                )
+                image = self.compositor.colour_image(
+                    n_image, slice_number, orientation
+                )
+                buffer_.cache.set_image(key, n_image, image)
 
             if self.current_mask and self.current_mask.is_shown:
-                n_mask = self.get_mask_slice(orientation, slice_number)
-                mask = converters.to_vtk(
-                    n_mask, self.spacing, slice_number, orientation
-                )
-                mask = self.do_colour_mask(mask, self.opacity)
-                final_image = self.do_blend(image, mask)
+                mask_key = self._get_mask_cache_key(slice_number)
+                cached = buffer_.cache.get_mask(mask_key)
+                if cached is not None and cached[1] is not None:
+                    n_mask, mask = cached
+                else:
+                    n_mask = self.get_mask_slice(orientation, slice_number)
+                    mask = self.compositor.colour_mask(n_mask)
+                    buffer_.cache.set_mask(mask_key, n_mask, mask)
+                final_image = self.compositor.blend(image, mask)
             else:
                 n_mask = None
                 final_image = image
                 mask = None
 
-            self.buffer_slices[orientation].index = slice_number
-            self.buffer_slices[orientation].mask = n_mask
-            self.buffer_slices[orientation].vtk_image = image
-            self.buffer_slices[orientation].vtk_mask = mask
+            last_index = buffer_.index
+            buffer_.index = slice_number
+            buffer_.mask = n_mask
+            buffer_.vtk_image = image
+            buffer_.vtk_mask = mask
+
+            # Thick slab projections are updated incrementally from the
+            # previous slab, it's cheaper than projecting it in background.
+            if (
+                last_index != -1
+                and last_index != slice_number
+                and self._type_projection == const.PROJECTION_NORMAL
+            ):
+                self._prefetch_slices(
+                    orientation, slice_number, slice_number - last_index, key[1:]
+                )
 
         if self.to_show_aux == "watershed" and self.current_mask is not None and self.current_mask.is_shown:
             m = self.get_aux_slice("watershed", orientation, slice_number)
-            tmp_vimage = converters.to_vtk(m, self.spacing, slice_number, orientation)
-            cimage = self.do_custom_colour(
-                tmp_vimage,
+            cimage = self.compositor.colour_custom(
+                m,
                 {
                     0: (0.0, 0.0, 0.0, 0.0),
                     1: (0.0, 1.0, 0.0, 1.0),
                     2: (1.0, 0.0, 0.0, 1.0),
                 },
             )
-            final_image = self.do_blend(final_image, cimage)
+            final_image = self.compositor.blend(final_image, cimage)
         elif self.to_show_aux and self.current_mask:
             m = self.get_aux_slice(self.to_show_aux, orientation, slice_number)
-            tmp_vimage = converters.to_vtk(m, self.spacing, slice_number, orientation)
             try:
                 colour_table =  self.aux_matrices_colours[self.to_show_aux]
             except KeyError:
@@ -708,12 +986,31 @@ class Slice(metaclass=utils.Singleton):
                     254: (1.0, 0.0, 0.0, 1.0),
                     255: (1.0, 0.0, 0.0, 1.0),
                 }
-            aux_image = self.do_custom_colour(
-                tmp_vimage,
-                colour_table
+            aux_image = self.compositor.colour_custom(m, colour_table)
+            final_image = self.compositor.blend(final_image, aux_image)
+        return converters.to_vtk(
+            final_image, self.spacing, slice_number, orientation, components=3
+        )
+
+    def _prefetch_slices(self, orientation, slice_number, direction, params):
+        """
+        Asks the prefetch thread to read the next slices in the scroll
+        direction.
+        """
+        step = 1 if direction > 0 else -1
+        nslices = self.GetNumberOfSlices(orientation)
+        slice_numbers = [
+            n
+            for n in (
+                slice_number + step * i
+                for i in range(1, const.SLICE_PREFETCH_SIZE + 1)
+            )
+            if 0 <= n < nslices
+        ]
+        if slice_numbers:
+            self._prefetcher.request(
+                self.buffer_slices[orientation], orientation, slice_numbers, params
             )
-            final_image = self.do_blend(final_image, aux_image)
-        return final_image
 
     def get_image_slice(
         self,
@@ -723,297 +1020,409 @@ class Slice(metaclass=utils.Singleton):
         inverted=False,
         border_size=1.0,
     ):
-        dz, dy, dx = self.matrix.shape
-        if (
-            self.buffer_slices[orientation].index == slice_number
-            and self.buffer_slices[orientation].image is not None
+        buffer_ = self.buffer_slices[orientation]
+        if buffer_.index == slice_number and buffer_.image is not None:
+            n_image = buffer_.image
+        else:
+            key = self._get_cache_key(
+                slice_number, number_slices, inverted, border_size
+            )
+            cached = buffer_.cache.get_image(key)
+            if cached is not None:
+                n_image = cached[0]
+            elif (
+                self._type_projection != const.PROJECTION_NORMAL
+                and number_slices > 1
+            ):
+                n_image = self._get_slab_projection(
+                    orientation, slice_number, number_slices, inverted, border_size
+                )
+                buffer_.cache.set_image(key, n_image)
+            else:
+                n_image = self._get_image_slice(
+                    orientation, slice_number, number_slices, inverted, border_size
+                )
+                buffer_.cache.set_image(key, n_image)
+            buffer_.image = n_image
+        return n_image
+
+    def _get_view_matrix(self):
+        """
+        Returns the matrix used to reslice the volume when it's rotated
+        (q_orientation), or None if it's not rotated.
+        """
+        if not np.any(self.q_orientation[1::]):
+            return None
+        cx, cy, cz = self.center
+        T0 = transformations.translation_matrix((-cz, -cy, -cx))
+        #  Rx = transformations.rotation_matrix(rx, (0, 0, 1))
+        #  Ry = transformations.rotation_matrix(ry, (0, 1, 0))
+        #  Rz = transformations.rotation_matrix(rz, (1, 0, 0))
+        #  #  R = transformations.euler_matrix(rz, ry, rx, 'rzyx')
+        #  R = transformations.concatenate_matrices(Rx, Ry, Rz)
+        R = transformations.quaternion_matrix(self.q_orientation)
+        T1 = transformations.translation_matrix((cz, cy, cx))
+        return transformations.concatenate_matrices(T1, R.T, T0)
+
+    def _get_matrix_min(self):
+        if self._matrix_min is None:
+            self._matrix_min = self.matrix.min()
+        return self._matrix_min
+
+    def _read_slab(self, orientation, slice_number, number_slices, M=None):
+        """
+        Returns the slices [slice_number, slice_number + number_slices) of
+        the matrix in the given orientation as a 3D array. If M is given
+        the slices are resliced with it, in this case only the requested
+        slices are computed and the matrix is not read to fill them.
+        """
+        axis = {"AXIAL": 0, "CORONAL": 1, "SAGITAL": 2}[orientation]
+        index = [slice(None)] * 3
+        index[axis] = slice(slice_number, slice_number + number_slices)
+        index = tuple(index)
+        if M is None:
+            return np.array(self.matrix[index])
+
+        shape = list(self.matrix.shape)
+        shape[axis] = min(slice_number + number_slices, shape[axis]) - slice_number
+        tmp_array = np.empty(shape, dtype=self.matrix.dtype)
+        transforms.apply_view_matrix_transform(
+            self.matrix,
+            self.spacing,
+            M,
+            slice_number,
+            orientation,
+            self.interp_method,
+            self._get_matrix_min(),
+            tmp_array,
+        )
+        return tmp_array
+
+    def _get_slab_projection(
+        self,
+        orientation,
+        slice_number,
+        number_slices,
+        inverted=False,
+        border_size=1.0,
+    ):
+        """
+        Projects the slab [slice_number, slice_number + number_slices) reusing
+        the slab projected before in the same orientation, only the planes
+        entering the slab are read from the matrix (and resliced if the
+        volume is rotated).
+        """
+        buffer_ = self.buffer_slices[orientation]
+        axis = {"AXIAL": 0, "CORONAL": 1, "SAGITAL": 2}[orientation]
+        nslices = self.matrix.shape[axis]
+        end = min(slice_number + number_slices, nslices)
+
+        M = self._get_view_matrix()
+
+        def read_plane(n):
+            return self._read_slab(orientation, n, 1, M).squeeze(axis)
+
+        slab = buffer_.slab
+        if slab is None or slab.projection != self._type_projection:
+            slab = SlabProjection(self._type_projection)
+            buffer_.slab = slab
+        slab.move(slice_number, end, read_plane)
+
+        if self._type_projection in (
+            const.PROJECTION_MaxIP,
+            const.PROJECTION_MinIP,
+            const.PROJECTION_MeanIP,
         ):
-            n_image = self.buffer_slices[orientation].image
+            return slab.get_projection()
+
+        tmp_array = slab.get_slab(axis, inverted)
+        shape = tuple(s for i, s in enumerate(tmp_array.shape) if i != axis)
+        n_image = np.empty(shape=shape, dtype=tmp_array.dtype)
+        if self._type_projection == const.PROJECTION_LMIP:
+            mips.lmip(tmp_array, axis, self.window_level, self.window_level, n_image)
+        elif self._type_projection == const.PROJECTION_MIDA:
+            mips.mida(tmp_array, axis, self.window_level, self.window_level, n_image)
+        elif self._type_projection in (
+            const.PROJECTION_CONTOUR_MIP,
+            const.PROJECTION_CONTOUR_LMIP,
+            const.PROJECTION_CONTOUR_MIDA,
+        ):
+            tmip = {
+                const.PROJECTION_CONTOUR_MIP: 0,
+                const.PROJECTION_CONTOUR_LMIP: 1,
+                const.PROJECTION_CONTOUR_MIDA: 2,
+            }[self._type_projection]
+            mips.fast_countour_mip(
+                tmp_array,
+                border_size,
+                axis,
+                self.window_level,
+                self.window_level,
+                tmip,
+                n_image,
+            )
         else:
-            if self._type_projection == const.PROJECTION_NORMAL:
-                number_slices = 1
-
-            if np.any(self.q_orientation[1::]):
-                cx, cy, cz = self.center
-                T0 = transformations.translation_matrix((-cz, -cy, -cx))
-                #  Rx = transformations.rotation_matrix(rx, (0, 0, 1))
-                #  Ry = transformations.rotation_matrix(ry, (0, 1, 0))
-                #  Rz = transformations.rotation_matrix(rz, (1, 0, 0))
-                #  #  R = transformations.euler_matrix(rz, ry, rx, 'rzyx')
-                #  R = transformations.concatenate_matrices(Rx, Ry, Rz)
-                R = transformations.quaternion_matrix(self.q_orientation)
-                T1 = transformations.translation_matrix((cz, cy, cx))
-                M = transformations.concatenate_matrices(T1, R.T, T0)
+            n_image = read_plane(slice_number)
+        return n_image
 
-            if orientation == "AXIAL":
-                tmp_array = np.array(
-                    self.matrix[slice_number : slice_number + number_slices]
-                )
-                if np.any(self.q_orientation[1::]):
-                    transforms.apply_view_matrix_transform(
-                        self.matrix,
-                        self.spacing,
-                        M,
-                        slice_number,
-                        orientation,
-                        self.interp_method,
-                        self.matrix.min(),
+    def _get_cache_key(self, slice_number, number_slices, inverted, border_size):
+        if self._type_projection == const.PROJECTION_NORMAL:
+            return (slice_number, 1, False, 1.0)
+        return (slice_number, number_slices, inverted, border_size)
+
+    def _get_mask_cache_key(self, slice_number):
+        return (
+            slice_number,
+            self.current_mask.index,
+            self.current_mask.threshold_generation,
+        )
+
+    def _get_image_slice(
+        self,
+        orientation,
+        slice_number,
+        number_slices=1,
+        inverted=False,
+        border_size=1.0,
+    ):
+        """
+        Slices the matrix (and projects it if a projection is set). It
+        doesn't use nor change the slice buffers, so it's also used by the
+        prefetch thread.
+        """
+        dz, dy, dx = self.matrix.shape
+        if self._type_projection == const.PROJECTION_NORMAL:
+            number_slices = 1
+
+        M = self._get_view_matrix()
+
+        if orientation == "AXIAL":
+            tmp_array = self._read_slab(orientation, slice_number, number_slices, M)
+            if self._type_projection == const.PROJECTION_NORMAL:
+                n_image = tmp_array.reshape(dy, dx)
+            else:
+                if inverted:
+                    tmp_array = tmp_array[::-1]
+
+                if self._type_projection == const.PROJECTION_MaxIP:
+                    n_image = np.array(tmp_array).max(0)
+                elif self._type_projection == const.PROJECTION_MinIP:
+                    n_image = np.array(tmp_array).min(0)
+                elif self._type_projection == const.PROJECTION_MeanIP:
+                    n_image = np.array(tmp_array).mean(0)
+                elif self._type_projection == const.PROJECTION_LMIP:
+                    n_image = np.empty(
+                        shape=(tmp_array.shape[1], tmp_array.shape[2]),
+                        dtype=tmp_array.dtype,
+                    )
+                    mips.lmip(
+                        tmp_array, 0, self.window_level, self.window_level, n_image
+                    )
+                elif self._type_projection == const.PROJECTION_MIDA:
+                    n_image = np.empty(
+                        shape=(tmp_array.shape[1], tmp_array.shape[2]),
+                        dtype=tmp_array.dtype,
+                    )
+                    mips.mida(
+                        tmp_array, 0, self.window_level, self.window_level, n_image
+                    )
+                elif self._type_projection == const.PROJECTION_CONTOUR_MIP:
+                    n_image = np.empty(
+                        shape=(tmp_array.shape[1], tmp_array.shape[2]),
+                        dtype=tmp_array.dtype,
+                    )
+                    mips.fast_countour_mip(
+                        tmp_array,
+                        border_size,
+                        0,
+                        self.window_level,
+                        self.window_level,
+                        0,
+                        n_image,
+                    )
+                elif self._type_projection == const.PROJECTION_CONTOUR_LMIP:
+                    n_image = np.empty(
+                        shape=(tmp_array.shape[1], tmp_array.shape[2]),
+                        dtype=tmp_array.dtype,
+                    )
+                    mips.fast_countour_mip(
+                        tmp_array,
+                        border_size,
+                        0,
+                        self.window_level,
+                        self.window_level,
+                        1,
+                        n_image,
+                    )
+                elif self._type_projection == const.PROJECTION_CONTOUR_MIDA:
+                    n_image = np.empty(
+                        shape=(tmp_array.shape[1], tmp_array.shape[2]),
+                        dtype=tmp_array.dtype,
+                    )
+                    mips.fast_countour_mip(
                         tmp_array,
+                        border_size,
+                        0,
+                        self.window_level,
+                        self.window_level,
+                        2,
+                        n_image,
                     )
-                if self._type_projection == const.PROJECTION_NORMAL:
-                    n_image = tmp_array.reshape(dy, dx)
                 else:
-                    if inverted:
-                        tmp_array = tmp_array[::-1]
-
-                    if self._type_projection == const.PROJECTION_MaxIP:
-                        n_image = np.array(tmp_array).max(0)
-                    elif self._type_projection == const.PROJECTION_MinIP:
-                        n_image = np.array(tmp_array).min(0)
-                    elif self._type_projection == const.PROJECTION_MeanIP:
-                        n_image = np.array(tmp_array).mean(0)
-                    elif self._type_projection == const.PROJECTION_LMIP:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[1], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.lmip(
-                            tmp_array, 0, self.window_level, self.window_level, n_image
-                        )
-                    elif self._type_projection == const.PROJECTION_MIDA:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[1], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.mida(
-                            tmp_array, 0, self.window_level, self.window_level, n_image
-                        )
-                    elif self._type_projection == const.PROJECTION_CONTOUR_MIP:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[1], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.fast_countour_mip(
-                            tmp_array,
-                            border_size,
-                            0,
-                            self.window_level,
-                            self.window_level,
-                            0,
-                            n_image,
-                        )
-                    elif self._type_projection == const.PROJECTION_CONTOUR_LMIP:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[1], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.fast_countour_mip(
-                            tmp_array,
-                            border_size,
-                            0,
-                            self.window_level,
-                            self.window_level,
-                            1,
-                            n_image,
-                        )
-                    elif self._type_projection == const.PROJECTION_CONTOUR_MIDA:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[1], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.fast_countour_mip(
-                            tmp_array,
-                            border_size,
-                            0,
-                            self.window_level,
-                            self.window_level,
-                            2,
-                            n_image,
-                        )
-                    else:
-                        n_image = np.array(self.matrix[slice_number])
+                    n_image = np.array(self.matrix[slice_number])
 
-            elif orientation == "CORONAL":
-                tmp_array = np.array(
-                    self.matrix[:, slice_number : slice_number + number_slices, :]
-                )
-                if np.any(self.q_orientation[1::]):
-                    transforms.apply_view_matrix_transform(
-                        self.matrix,
-                        self.spacing,
-                        M,
-                        slice_number,
-                        orientation,
-                        self.interp_method,
-                        self.matrix.min(),
+        elif orientation == "CORONAL":
+            tmp_array = self._read_slab(orientation, slice_number, number_slices, M)
+            if self._type_projection == const.PROJECTION_NORMAL:
+                n_image = tmp_array.reshape(dz, dx)
+            else:
+                # if slice_number == 0:
+                # slice_number = 1
+                # if slice_number - number_slices < 0:
+                # number_slices = slice_number
+                if inverted:
+                    tmp_array = tmp_array[:, ::-1, :]
+                if self._type_projection == const.PROJECTION_MaxIP:
+                    n_image = np.array(tmp_array).max(1)
+                elif self._type_projection == const.PROJECTION_MinIP:
+                    n_image = np.array(tmp_array).min(1)
+                elif self._type_projection == const.PROJECTION_MeanIP:
+                    n_image = np.array(tmp_array).mean(1)
+                elif self._type_projection == const.PROJECTION_LMIP:
+                    n_image = np.empty(
+                        shape=(tmp_array.shape[0], tmp_array.shape[2]),
+                        dtype=tmp_array.dtype,
+                    )
+                    mips.lmip(
+                        tmp_array, 1, self.window_level, self.window_level, n_image
+                    )
+                elif self._type_projection == const.PROJECTION_MIDA:
+                    n_image = np.empty(
+                        shape=(tmp_array.shape[0], tmp_array.shape[2]),
+                        dtype=tmp_array.dtype,
+                    )
+                    mips.mida(
+                        tmp_array, 1, self.window_level, self.window_level, n_image
+                    )
+                elif self._type_projection == const.PROJECTION_CONTOUR_MIP:
+                    n_image = np.empty(
+                        shape=(tmp_array.shape[0], tmp_array.shape[2]),
+                        dtype=tmp_array.dtype,
+                    )
+                    mips.fast_countour_mip(
                         tmp_array,
+                        border_size,
+                        1,
+                        self.window_level,
+                        self.window_level,
+                        0,
+                        n_image,
                     )
-
-                if self._type_projection == const.PROJECTION_NORMAL:
-                    n_image = tmp_array.reshape(dz, dx)
-                else:
-                    # if slice_number == 0:
-                    # slice_number = 1
-                    # if slice_number - number_slices < 0:
-                    # number_slices = slice_number
-                    if inverted:
-                        tmp_array = tmp_array[:, ::-1, :]
-                    if self._type_projection == const.PROJECTION_MaxIP:
-                        n_image = np.array(tmp_array).max(1)
-                    elif self._type_projection == const.PROJECTION_MinIP:
-                        n_image = np.array(tmp_array).min(1)
-                    elif self._type_projection == const.PROJECTION_MeanIP:
-                        n_image = np.array(tmp_array).mean(1)
-                    elif self._type_projection == const.PROJECTION_LMIP:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.lmip(
-                            tmp_array, 1, self.window_level, self.window_level, n_image
-                        )
-                    elif self._type_projection == const.PROJECTION_MIDA:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.mida(
-                            tmp_array, 1, self.window_level, self.window_level, n_image
-                        )
-                    elif self._type_projection == const.PROJECTION_CONTOUR_MIP:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.fast_countour_mip(
-                            tmp_array,
-                            border_size,
-                            1,
-                            self.window_level,
-                            self.window_level,
-                            0,
-                            n_image,
-                        )
-                    elif self._type_projection == const.PROJECTION_CONTOUR_LMIP:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.fast_countour_mip(
-                            tmp_array,
-                            border_size,
-                            1,
-                            self.window_level,
-                            self.window_level,
-                            1,
-                            n_image,
-                        )
-                    elif self._type_projection == const.PROJECTION_CONTOUR_MIDA:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.fast_countour_mip(
-                            tmp_array,
-                            border_size,
-                            1,
-                            self.window_level,
-                            self.window_level,
-                            2,
-                            n_image,
-                        )
-                    else:
-                        n_image = np.array(self.matrix[:, slice_number, :])
-            elif orientation == "SAGITAL":
-                tmp_array = np.array(
-                    self.matrix[:, :, slice_number : slice_number + number_slices]
-                )
-                if np.any(self.q_orientation[1::]):
-                    transforms.apply_view_matrix_transform(
-                        self.matrix,
-                        self.spacing,
-                        M,
-                        slice_number,
-                        orientation,
-                        self.interp_method,
-                        self.matrix.min(),
+                elif self._type_projection == const.PROJECTION_CONTOUR_LMIP:
+                    n_image = np.empty(
+                        shape=(tmp_array.shape[0], tmp_array.shape[2]),
+                        dtype=tmp_array.dtype,
+                    )
+                    mips.fast_countour_mip(
+                        tmp_array,
+                        border_size,
+                        1,
+                        self.window_level,
+                        self.window_level,
+                        1,
+                        n_image,
+                    )
+                elif self._type_projection == const.PROJECTION_CONTOUR_MIDA:
+                    n_image = np.empty(
+                        shape=(tmp_array.shape[0], tmp_array.shape[2]),
+                        dtype=tmp_array.dtype,
+                    )
+                    mips.fast_countour_mip(
                         tmp_array,
+                        border_size,
+                        1,
+                        self.window_level,
+                        self.window_level,
+                        2,
+                        n_image,
+                    )
+                else:
+                    n_image = np.array(self.matrix[:, slice_number, :])
+        elif orientation == "SAGITAL":
+            tmp_array = self._read_slab(orientation, slice_number, number_slices, M)
+            if self._type_projection == const.PROJECTION_NORMAL:
+                n_image = tmp_array.reshape(dz, dy)
+            else:
+                if inverted:
+                    tmp_array = tmp_array[:, :, ::-1]
+                if self._type_projection == const.PROJECTION_MaxIP:
+                    n_image = np.array(tmp_array).max(2)
+                elif self._type_projection == const.PROJECTION_MinIP:
+                    n_image = np.array(tmp_array).min(2)
+                elif self._type_projection == const.PROJECTION_MeanIP:
+                    n_image = np.array(tmp_array).mean(2)
+                elif self._type_projection == const.PROJECTION_LMIP:
+                    n_image = np.empty(
+                        shape=(tmp_array.shape[0], tmp_array.shape[1]),
+                        dtype=tmp_array.dtype,
+                    )
+                    mips.lmip(
+                        tmp_array, 2, self.window_level, self.window_level, n_image
+                    )
+                elif self._type_projection == const.PROJECTION_MIDA:
+                    n_image = np.empty(
+                        shape=(tmp_array.shape[0], tmp_array.shape[1]),
+                        dtype=tmp_array.dtype,
+                    )
+                    mips.mida(
+                        tmp_array, 2, self.window_level, self.window_level, n_image
                     )
 
-                if self._type_projection == const.PROJECTION_NORMAL:
-                    n_image = tmp_array.reshape(dz, dy)
+                elif self._type_projection == const.PROJECTION_CONTOUR_MIP:
+                    n_image = np.empty(
+                        shape=(tmp_array.shape[0], tmp_array.shape[1]),
+                        dtype=tmp_array.dtype,
+                    )
+                    mips.fast_countour_mip(
+                        tmp_array,
+                        border_size,
+                        2,
+                        self.window_level,
+                        self.window_level,
+                        0,
+                        n_image,
+                    )
+                elif self._type_projection == const.PROJECTION_CONTOUR_LMIP:
+                    n_image = np.empty(
+                        shape=(tmp_array.shape[0], tmp_array.shape[1]),
+                        dtype=tmp_array.dtype,
+                    )
+                    mips.fast_countour_mip(
+                        tmp_array,
+                        border_size,
+                        2,
+                        self.window_level,
+                        self.window_level,
+                        1,
+                        n_image,
+                    )
+                elif self._type_projection == const.PROJECTION_CONTOUR_MIDA:
+                    n_image = np.empty(
+                        shape=(tmp_array.shape[0], tmp_array.shape[1]),
+                        dtype=tmp_array.dtype,
+                    )
+                    mips.fast_countour_mip(
+                        tmp_array,
+                        border_size,
+                        2,
+                        self.window_level,
+                        self.window_level,
+                        2,
+                        n_image,
+                    )
                 else:
-                    if inverted:
-                        tmp_array = tmp_array[:, :, ::-1]
-                    if self._type_projection == const.PROJECTION_MaxIP:
-                        n_image = np.array(tmp_array).max(2)
-                    elif self._type_projection == const.PROJECTION_MinIP:
-                        n_image = np.array(tmp_array).min(2)
-                    elif self._type_projection == const.PROJECTION_MeanIP:
-                        n_image = np.array(tmp_array).mean(2)
-                    elif self._type_projection == const.PROJECTION_LMIP:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[1]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.lmip(
-                            tmp_array, 2, self.window_level, self.window_level, n_image
-                        )
-                    elif self._type_projection == const.PROJECTION_MIDA:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[1]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.mida(
-                            tmp_array, 2, self.window_level, self.window_level, n_image
-                        )
-
-                    elif self._type_projection == const.PROJECTION_CONTOUR_MIP:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[1]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.fast_countour_mip(
-                            tmp_array,
-                            border_size,
-                            2,
-                            self.window_level,
-                            self.window_level,
-                            0,
-                            n_image,
-                        )
-                    elif self._type_projection == const.PROJECTION_CONTOUR_LMIP:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[1]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.fast_countour_mip(
-                            tmp_array,
-                            border_size,
-                            2,
-                            self.window_level,
-                            self.window_level,
-                            1,
-                            n_image,
-                        )
-                    elif self._type_projection == const.PROJECTION_CONTOUR_MIDA:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[1]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.fast_countour_mip(
-                            tmp_array,
-                            border_size,
-                            2,
-                            self.window_level,
-                            self.window_level,
-                            2,
-                            n_image,
-                        )
-                    else:
-                        n_image = np.array(self.matrix[:, :, slice_number])
-
-            self.buffer_slices[orientation].image = n_image
+                    n_image = np.array(self.matrix[:, :, slice_number])
+
         return n_image
 
     def get_mask_slice(self, orientation, slice_number):
@@ -1033,7 +1442,9 @@ class Slice(metaclass=utils.Singleton):
             if self.current_mask.matrix[n, 0, 0] == 0:
                 mask = self.current_mask.matrix[n, 1:, 1:]
                 mask[:] = self.do_threshold_to_a_slice(
-                    self.get_image_slice(orientation, slice_number), mask
+                    self.get_image_slice(orientation, slice_number),
+                    mask,
+                    fresh=self.current_mask.get_fresh_voxels(orientation),
                 )
                 self.current_mask.matrix[n, 0, 0] = 1
             n_mask = np.array(
@@ -1045,7 +1456,9 @@ class Slice(metaclass=utils.Singleton):
             if self.current_mask.matrix[0, n, 0] == 0:
                 mask = self.current_mask.matrix[1:, n, 1:]
                 mask[:] = self.do_threshold_to_a_slice(
-                    self.get_image_slice(orientation, slice_number), mask
+                    self.get_image_slice(orientation, slice_number),
+                    mask,
+                    fresh=self.current_mask.get_fresh_voxels(orientation),
                 )
                 self.current_mask.matrix[0, n, 0] = 1
             n_mask = np.array(
@@ -1057,7 +1470,9 @@ class Slice(metaclass=utils.Singleton):
             if self.current_mask.matrix[0, 0, n] == 0:
                 mask = self.current_mask.matrix[1:, 1:, n]
                 mask[:] = self.do_threshold_to_a_slice(
-                    self.get_image_slice(orientation, slice_number), mask
+                    self.get_image_slice(orientation, slice_number),
+                    mask,
+                    fresh=self.current_mask.get_fresh_voxels(orientation),
                 )
                 self.current_mask.matrix[0, 0, n] = 1
             n_mask = np.array(
@@ -1270,12 +1685,13 @@ class Slice(metaclass=utils.Singleton):
         self.window_level = level
 
         for buffer_ in self.buffer_slices.values():
+            # The LMIP is computed with the window and level, the cached
+            # projections are discarded like the other ones depending on it.
             if self._type_projection in (
                 const.PROJECTION_NORMAL,
                 const.PROJECTION_MaxIP,
                 const.PROJECTION_MinIP,
                 const.PROJECTION_MeanIP,
-                const.PROJECTION_LMIP,
             ):
                 buffer_.discard_vtk_image()
             else:
@@ -1305,12 +1721,13 @@ class Slice(metaclass=utils.Singleton):
         self.nodes = nodes
         self.from_ = WIDGET
         for buffer_ in self.buffer_slices.values():
+            # The LMIP is computed with the window and level, the cached
+            # projections are discarded like the other ones depending on it.
             if self._type_projection in (
                 const.PROJECTION_NORMAL,
                 const.PROJECTION_MaxIP,
                 const.PROJECTION_MinIP,
                 const.PROJECTION_MeanIP,
-                const.PROJECTION_LMIP,
             ):
                 buffer_.discard_vtk_image()
             else:
@@ -1326,7 +1743,14 @@ class Slice(metaclass=utils.Singleton):
         Publisher.sendMessage("Reload actual slice")
 
     def UpdateSlice3D(self, widget, orientation):
-        img = self.buffer_slices[orientation].vtk_image
+        buffer_ = self.buffer_slices[orientation]
+        img = converters.to_vtk(
+            buffer_.vtk_image,
+            self.spacing,
+            buffer_.index,
+            orientation,
+            components=3,
+        )
         original_orientation = Project().original_orientation
         cast = vtkImageCast()
         cast.SetInputData(img)
@@ -1482,22 +1906,18 @@ class Slice(metaclass=utils.Singleton):
                 else:
                     node.value += shiftWW * factor
 
-    def do_threshold_to_a_slice(self, slice_matrix, mask, threshold=None):
+    def do_threshold_to_a_slice(self, slice_matrix, mask, threshold=None, fresh=None):
         """
         Based on the current threshold bounds generates a threshold mask to
-        given slice_matrix.
+        given slice_matrix. The edition values of mask are kept only where
+        fresh is True, if given.
         """
         if threshold:
             thresh_min, thresh_max = threshold
         else:
             thresh_min, thresh_max = self.current_mask.threshold_range
 
-        m = ((slice_matrix >= thresh_min) & (slice_matrix <= thresh_max)) * 255
-        m[mask == 1] = 1
-        m[mask == 2] = 2
-        m[mask == 253] = 253
-        m[mask == 254] = 254
-        return m.astype("uint8")
+        return threshold_array(slice_matrix, mask, thresh_min, thresh_max, fresh)
 
     def do_threshold_to_all_slices(self, mask=None):
         """
@@ -1509,22 +1929,46 @@ class Slice(metaclass=utils.Singleton):
         """
         if mask is None:
             mask = self.current_mask
-        for n in range(1, mask.matrix.shape[0]):
-            if mask.matrix[n, 0, 0] == 0:
-                m = mask.matrix[n, 1:, 1:]
-                mask.matrix[n, 1:, 1:] = self.do_threshold_to_a_slice(
-                    self.matrix[n - 1], m, mask.threshold_range
-                )
+        thresh_min, thresh_max = mask.threshold_range
+
+        # Only the slices not thresholded nor edited yet (flag 0), grouped in
+        # blocks of consecutive slices.
+        slices = np.flatnonzero(mask.matrix[1:, 0, 0] == 0) + 1
+        fresh = mask.get_fresh_voxels("AXIAL")
+        dz, dy, dx = self.matrix.shape
+        block_size = max(1, THRESHOLD_BLOCK_VOXELS // (dy * dx))
+        blocks = []
+        for run in np.split(slices, np.flatnonzero(np.diff(slices) != 1) + 1):
+            for i in range(0, len(run), block_size):
+                block = run[i : i + block_size]
+                blocks.append((block[0], block[-1] + 1))
+
+        def threshold_block(block):
+            init, end = block
+            mask.matrix[init:end, 1:, 1:] = threshold_array(
+                self.matrix[init - 1 : end - 1],
+                mask.matrix[init:end, 1:, 1:],
+                thresh_min,
+                thresh_max,
+                fresh,
+            )
+            mask.matrix[init:end, 0, 0] = 1
+
+        with futures.ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+            for _ in executor.map(threshold_block, blocks):
+                pass
 
         mask.matrix.flush()
 
-    def do_colour_image(self, imagedata):
+    def do_colour_image(self, imagedata, scalar_range=None):
         if self.from_ in (PLIST, WIDGET):
             return imagedata
         else:
+            if scalar_range is None:
+                scalar_range = imagedata.GetScalarRange()
             # map scalar values into colors
             lut_bg = vtkLookupTable()
-            lut_bg.SetTableRange(imagedata.GetScalarRange())
+            lut_bg.SetTableRange(scalar_range)
             lut_bg.SetSaturationRange(self.saturation_range)
             lut_bg.SetHueRange(self.hue_range)
             lut_bg.SetValueRange(self.value_range)
@@ -1737,6 +2181,7 @@ class Slice(metaclass=utils.Singleton):
 
         del mcopy
         os.remove(temp_file)
+        self._matrix_min = None
 
         self.q_orientation = np.array((1, 0, 0, 0))
         self.center = [
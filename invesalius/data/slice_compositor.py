@@ -0,0 +1,188 @@
+# --------------------------------------------------------------------------
+# Software:     InVesalius - Software de Reconstrucao 3D de Imagens Medicas
+# Copyright:    (C) 2001  Centro de Pesquisas Renato Archer
+# Homepage:     http://www.softwarepublico.gov.br
+# Contact:      invesalius@cti.gov.br
+# License:      GNU - GPL 2 (LICENSE.txt/LICENCA.txt)
+# --------------------------------------------------------------------------
+#    Este programa e software livre; voce pode redistribui-lo e/ou
+#    modifica-lo sob os termos da Licenca Publica Geral GNU, conforme
+#    publicada pela Free Software Foundation; de acordo com a versao 2
+#    da Licenca.
+#
+#    Este programa eh distribuido na expectativa de ser util, mas SEM
+#    QUALQUER GARANTIA; sem mesmo a garantia implicita de
+#    COMERCIALIZACAO ou de ADEQUACAO A QUALQUER PROPOSITO EM
+#    PARTICULAR. Consulte a Licenca Publica Geral GNU para obter mais
+#    detalhes.
+# --------------------------------------------------------------------------
+import numpy as np
+from vtkmodules.util import numpy_support
+
+import invesalius.data.converters as converters
+
+# Opacity of the layers blended over the image, the same used by do_blend.
+BLEND_OPACITY = 0.8
+
+# Above this number of cached colour tables (one for each range of the
+# window/levelled slices) the cache is emptied.
+MAX_COLOUR_TABLES = 1024
+
+
+def _apply_filter(data, filter_):
+    """
+    Runs filter_ (a Slice.do_* method) over the 2D array data, returning its
+    output as a (number of values, number of components) uint8 array.
+    """
+    output = filter_(converters.to_vtk(data))
+    table = numpy_support.vtk_to_numpy(output.GetPointData().GetScalars())
+    return table.reshape(data.size, -1)
+
+
+class SliceCompositor(object):
+    """
+    Colours the slices and blends them with the mask and the auxiliary
+    layers using numpy lookup tables, instead of creating a chain of VTK
+    filters for each slice shown. The tables are built only when the
+    parameters they come from (window and level, colour presets, mask colour
+    and opacity) change. They're built by running the Slice do_* filters once
+    over all the possible values, so the colours are the same given by them.
+    """
+
+    def __init__(self, slice_):
+        self.slice_ = slice_
+
+        self._image_table_key = None
+        self._image_table = None
+
+        self._colour_tables_key = None
+        self._colour_tables = {}
+
+        self._mask_table_key = None
+        self._mask_table = None
+
+        self._custom_tables = {}
+
+        self._blend_buffer = None
+
+    def _get_image_table_key(self):
+        s = self.slice_
+        key = (s.from_, s.window_width, s.window_level)
+        if s.values is not None:
+            key += (tuple(tuple(v) for v in s.values),)
+        if s.nodes is not None:
+            key += (tuple((n.value, tuple(n.colour)) for n in s.nodes),)
+        return key
+
+    def _get_image_table(self):
+        """
+        Returns the table giving the colour (or the grey value, when the
+        colour is given by do_colour_image) of each int16 value. It's indexed
+        by the value viewed as uint16.
+        """
+        from invesalius.data.slice_ import PLIST, WIDGET
+
+        key = self._get_image_table_key()
+        if key != self._image_table_key:
+            values = np.arange(-32768, 32768, dtype=np.int16).reshape(256, 256)
+            table = _apply_filter(values, self.slice_.do_ww_wl)
+            if self.slice_.from_ not in (PLIST, WIDGET):
+                table = table[:, 0]
+            # The value 0 goes to the index 0 and -1 to the index 65535.
+            self._image_table = np.ascontiguousarray(np.roll(table, -32768, axis=0))
+            self._image_table_key = key
+        return self._image_table
+
+    def _get_colour_table(self, scalar_range):
+        s = self.slice_
+        key = (s.hue_range, s.saturation_range, s.value_range)
+        if (
+            key != self._colour_tables_key
+            or len(self._colour_tables) > MAX_COLOUR_TABLES
+        ):
+            self._colour_tables = {}
+            self._colour_tables_key = key
+        try:
+            return self._colour_tables[scalar_range]
+        except KeyError:
+            values = np.arange(256, dtype=np.uint8).reshape(1, 256)
+            table = _apply_filter(
+                values, lambda image: s.do_colour_image(image, scalar_range)
+            )
+            self._colour_tables[scalar_range] = table
+            return table
+
+    def colour_image(self, n_image, slice_number, orientation):
+        """
+        Returns the slice n_image coloured by the window and level (and the
+        colour preset) as a RGB uint8 array.
+        """
+        s = self.slice_
+        if n_image.dtype != np.int16:
+            # Projections like MeanIP give float slices, they're coloured by
+            # the VTK filters.
+            image = converters.to_vtk(n_image, s.spacing, slice_number, orientation)
+            image = s.do_colour_image(s.do_ww_wl(image))
+            rgb = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())
+            return rgb.reshape(n_image.shape + (3,))
+
+        indexes = np.ascontiguousarray(n_image).view(np.uint16)
+        table = self._get_image_table()
+        if table.ndim == 2:
+            return np.take(table, indexes, axis=0)
+
+        grey = np.take(table, indexes)
+        scalar_range = (int(grey.min()), int(grey.max()))
+        return np.take(self._get_colour_table(scalar_range), grey, axis=0)
+
+    def colour_mask(self, n_mask):
+        """
+        Returns the mask slice n_mask coloured by the current mask colour and
+        the opacity as a RGBA uint8 array.
+        """
+        s = self.slice_
+        key = (tuple(s.current_mask.colour[:3]), s.opacity)
+        if key != self._mask_table_key:
+            values = np.arange(256, dtype=np.uint8).reshape(1, 256)
+            self._mask_table = _apply_filter(
+                values, lambda image: s.do_colour_mask(image, s.opacity)
+            )
+            self._mask_table_key = key
+        return np.take(self._mask_table, n_mask, axis=0)
+
+    def colour_custom(self, n_array, map_colours):
+        """
+        Returns the uint8 slice n_array coloured by map_colours (value: RGBA
+        colour) as a RGBA uint8 array.
+        """
+        key = tuple(sorted(map_colours.items()))
+        try:
+            table = self._custom_tables[key]
+        except KeyError:
+            values = np.arange(256, dtype=np.uint8).reshape(1, 256)
+            table = _apply_filter(
+                values, lambda image: self.slice_.do_custom_colour(image, map_colours)
+            )
+            self._custom_tables[key] = table
+        if n_array.dtype != np.uint8:
+            n_array = np.clip(n_array, 0, 255).astype(np.uint8)
+        return np.take(table, n_array, axis=0)
+
+    def blend(self, image, layer, opacity=BLEND_OPACITY):
+        """
+        Blends the RGBA layer over the RGB image. It's the integer arithmetic
+        vtkImageBlend uses for unsigned char images in normal mode.
+        """
+        o = int(256 * opacity)
+        shape = image.shape
+        if self._blend_buffer is None or self._blend_buffer.shape != shape:
+            self._blend_buffer = np.empty(shape, dtype=np.uint32)
+        out = self._blend_buffer
+
+        # In the range [0, 65280], 65280 = 255 * 256.
+        r = layer[..., 3].astype(np.uint32)
+        r *= o
+        np.multiply(image, (65280 - r)[..., np.newaxis], out=out)
+        out += layer[..., :3] * r[..., np.newaxis]
+        out >>= 16
+        return out.astype(np.uint8)
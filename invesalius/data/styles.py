@@ -1945,9 +1945,29 @@ class WaterShedInteractorStyle(DefaultInteractorStyle):
             tfile = tempfile.mktemp()
             tmp_mask = np.memmap(tfile, shape=mask.shape, dtype=mask.dtype,
                                  mode='w+')
+
+            # The image and the markers are opened by the process from their
+            # files instead of being pickled.
+            tmp_files = []
+            files = []
+            for array in (image, markers):
+                filename = watershed_process.get_memmap_filename(array)
+                if filename is None:
+                    filename = tempfile.mktemp()
+                    tmp_array = np.memmap(filename, shape=array.shape, dtype=array.dtype, mode='w+')
+                    tmp_array[:] = array
+                    tmp_array.flush()
+                    del tmp_array
+                    tmp_files.append(filename)
+                else:
+                    array.flush()
+                files.append(filename)
+            image_file, markers_file = files
+
             q = multiprocessing.Queue()
-            p = multiprocessing.Process(target=watershed_process.do_watershed, args=(image,
-                                        markers, tfile, tmp_mask.shape, bstruct,
+            p = multiprocessing.Process(target=watershed_process.do_watershed, args=(image_file,
+                                        image.shape, image.dtype, markers_file,
+                                        tfile, bstruct,
                                         self.config.algorithm,
                                         self.config.mg_size,
                                         self.config.use_ww_wl, wl, ww, q))
@@ -1970,9 +1990,14 @@ class WaterShedInteractorStyle(DefaultInteractorStyle):
             if flag == wx.HT_WINDOW_INSIDE:
                 self.OnEnterInteractor(None, None)
 
+            for filename in tmp_files:
+                os.remove(filename)
 
             if q.empty():
                 return
+            bbox = q.get()
+            if bbox is None:
+                return
             #do_watershed(image, markers, tmp_mask, bstruct, self.config.algorithm,
                          #self.config.mg_size, self.config.use_ww_wl, wl, ww)
             #if self.config.use_ww_wl:
@@ -1998,12 +2023,16 @@ class WaterShedInteractorStyle(DefaultInteractorStyle):
                     ##tmp_image = ndimage.morphological_gradient((image - image.min()).astype('uint16'), self.config.mg_size)
                     #tmp_mask = watershed_ift(tmp_image, markers.astype('int8'), bstruct)
 
+            # The watershed was only computed inside bbox.
+            tmp_mask = tmp_mask[bbox]
             if self.viewer.overwrite_mask:
                 mask[:] = 0
-                mask[tmp_mask == 1] = 253
+                mask[bbox][tmp_mask == 1] = 253
             else:
-                mask[(tmp_mask==2) & ((mask == 0) | (mask == 2) | (mask == 253))] = 2
-                mask[(tmp_mask==1) & ((mask == 0) | (mask == 2) | (mask == 253))] = 253
+                roi_mask = mask[bbox]
+                editable = (roi_mask == 0) | (roi_mask == 2) | (roi_mask == 253)
+                roi_mask[(tmp_mask == 2) & editable] = 2
+                roi_mask[(tmp_mask == 1) & editable] = 253
 
             self.viewer.slice_.current_mask.modified(True)
 
@@ -2717,7 +2746,7 @@ class FloodFillSegmentInteractorStyle(DefaultInteractorStyle):
             bstruct = np.array(generate_binary_structure(2, CON2D[self.config.con_2d]), dtype='uint8')
             bstruct = bstruct.reshape((1, 3, 3))
 
-            out_mask = self.do_rg_confidence(image, mask, (x, y, 0), bstruct)
+            out_mask, _ = self.do_rg_confidence(image, mask, (x, y, 0), bstruct)
         else:
             if self.config.method == 'threshold':
                 v = image[y, x]
@@ -2799,7 +2828,6 @@ class FloodFillSegmentInteractorStyle(DefaultInteractorStyle):
 
         bstruct = np.array(generate_binary_structure(3, CON3D[self.config.con_3d]), dtype='uint8')
         self.viewer.slice_.do_threshold_to_all_slices()
-        cp_mask = self.viewer.slice_.current_mask.matrix.copy()
 
         if self.config.method == 'confidence':
             with futures.ThreadPoolExecutor(max_workers=1) as executor:
@@ -2813,11 +2841,12 @@ class FloodFillSegmentInteractorStyle(DefaultInteractorStyle):
                     time.sleep(0.1)
                 self.config.dlg.panel_ffill_progress.StopTimer()
                 self.config.dlg.panel_ffill_progress.Disable()
-                out_mask = future.result()
+                out_mask, bbox = future.result()
         else:
-            out_mask = np.zeros_like(mask)
+            # np.zeros only gets the memory of the pages touched by the fill.
+            out_mask = np.zeros(mask.shape, dtype='uint8')
             with futures.ThreadPoolExecutor(max_workers=1) as executor:
-                future = executor.submit(floodfill.floodfill_threshold, image, [[x, y, z]], t0, t1, 1, bstruct, out_mask)
+                future = executor.submit(floodfill.floodfill_threshold_bbox, image, [[x, y, z]], t0, t1, 1, bstruct, out_mask)
 
                 self.config.dlg.panel_ffill_progress.Enable()
                 self.config.dlg.panel_ffill_progress.StartTimer()
@@ -2827,43 +2856,71 @@ class FloodFillSegmentInteractorStyle(DefaultInteractorStyle):
                     time.sleep(0.1)
                 self.config.dlg.panel_ffill_progress.StopTimer()
                 self.config.dlg.panel_ffill_progress.Disable()
+                bbox = future.result()
 
-        mask[out_mask.astype('bool')] = self.config.fill_value
+        if bbox is None:
+            return
+
+        # Only the bounding box of the filled voxels is changed and saved in
+        # the history.
+        cp_mask = mask[bbox].copy()
+        mask[bbox][out_mask[bbox].astype('bool')] = self.config.fill_value
 
-        self.viewer.slice_.current_mask.save_history(0, 'VOLUME', self.viewer.slice_.current_mask.matrix.copy(), cp_mask)
+        index = tuple(slice(i.start + 1, i.stop + 1) for i in bbox)
+        self.viewer.slice_.current_mask.save_history(index, 'VOLUME', mask[bbox].copy(), cp_mask)
 
     def do_rg_confidence(self, image, mask, p, bstruct):
+        """
+        Confidence connected region growing. In each iteration the threshold
+        is given by the mean and standard deviation of the region, and the
+        region grows from its frontier. Returns the region and its bounding
+        box.
+        """
         x, y, z = p
         if self.config.use_ww_wl:
             ww = self.viewer.slice_.window_width
             wl = self.viewer.slice_.window_level
             image = get_LUT_value_255(image, ww, wl)
-        bool_mask = np.zeros_like(mask, dtype='bool')
-        out_mask = np.zeros_like(mask)
-
-        for k in range(int(z-1), int(z+2)):
-            if k < 0 or k >= bool_mask.shape[0]:
-                continue
-            for j in range(int(y-1), int(y+2)):
-                if j < 0 or j >= bool_mask.shape[1]:
-                    continue
-                for i in range(int(x-1), int(x+2)):
-                    if i < 0 or i >= bool_mask.shape[2]:
-                        continue
-                    bool_mask[k, j, i] = True
+        out_mask = np.zeros(mask.shape, dtype='uint8')
+
+        # Voxels around the seed, used to compute the first threshold.
+        neighbours = tuple(slice(max(c - 1, 0), c + 2) for c in (z, y, x))
+        bbox = neighbours
+        seeds = [[x, y, z]]
 
         for i in range(self.config.confid_iters):
-            var = np.std(image[bool_mask])
-            mean = np.mean(image[bool_mask])
+            region = out_mask[bbox] == 1
+            region[tuple(slice(n.start - b.start, n.stop - b.start) for n, b in zip(neighbours, bbox))] = True
+
+            values = image[bbox][region]
+            var = np.std(values)
+            mean = np.mean(values)
 
             t0 = mean - var * self.config.confid_mult
             t1 = mean + var * self.config.confid_mult
 
-            floodfill.floodfill_threshold(image, [[x, y, z]], t0, t1, 1, bstruct, out_mask)
-
-            bool_mask[out_mask == 1] = True
-
-        return out_mask
+            if i > 0:
+                # The voxels just outside the region which are inside the
+                # new threshold.
+                frontier = tuple(slice(max(b.start - 1, 0), b.stop + 1) for b in bbox)
+                filled = out_mask[frontier] == 1
+                candidates = ndimage.binary_dilation(filled, bstruct) & ~filled
+                candidates &= (image[frontier] >= t0) & (image[frontier] <= t1)
+                offset = np.array([frontier[2].start, frontier[1].start, frontier[0].start])
+                seeds = (np.argwhere(candidates)[:, ::-1] + offset).tolist()
+                if not seeds:
+                    break
+
+            filled_bbox = floodfill.floodfill_threshold_bbox(image, seeds, t0, t1, 1, bstruct, out_mask)
+            if filled_bbox is not None:
+                bbox = tuple(
+                    slice(min(b.start, f.start), max(b.stop, f.stop))
+                    for b, f in zip(bbox, filled_bbox)
+                )
+
+        if not out_mask[bbox].any():
+            return out_mask, None
+        return out_mask, bbox
 
 
 
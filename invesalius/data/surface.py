@@ -25,10 +25,12 @@ import random
 import shutil
 import sys
 import tempfile
+import threading
 import time
 import traceback
 import weakref
 import numpy as np
+import psutil
 
 try:
     import queue
@@ -70,7 +72,6 @@ else:
     _has_win32api = False
 
 import invesalius.constants as const
-import invesalius.data.imagedata_utils as iu
 import invesalius.data.slice_ as sl
 import invesalius.data.polydata_utils as pu
 import invesalius.project as prj
@@ -78,7 +79,7 @@ import invesalius.session as ses
 import invesalius.data.surface_process as surface_process
 import invesalius.utils as utl
 import invesalius.data.vtk_utils as vtk_utils
-from invesalius.data.converters import convert_custom_bin_to_vtk
+from invesalius.data.converters import convert_custom_bin_to_vtk, np_to_polydata
 
 from invesalius.gui import dialogs
 from invesalius_cy import cy_mesh
@@ -182,6 +183,9 @@ class SurfaceManager():
         self.actors_dict = {}
         self.last_surface_index = 0
         self.convert_to_inv = None
+        self._pool = None
+        self._manager = None
+        self._msg_queue = None
         self.__bind_events()
 
         self._default_parameters = {
@@ -203,6 +207,32 @@ class SurfaceManager():
         else:
             session.SetConfig('surface', self._default_parameters)
 
+    def _get_pool(self):
+        """
+        Returns the pool of processes used to create the surfaces. It's
+        created once and reused, since spawning the processes and importing
+        VTK in them takes some seconds.
+        """
+        if self._pool is None:
+            ctx = multiprocessing.get_context('spawn')
+            self._pool = ctx.Pool(processes=multiprocessing.cpu_count())
+            self._manager = multiprocessing.Manager()
+            self._msg_queue = self._manager.Queue(1)
+        return self._pool
+
+    def _terminate_pool(self):
+        if self._pool is None:
+            return
+        self._pool.close()
+        try:
+            self._pool.terminate()
+        except AssertionError:
+            pass
+        self._manager.shutdown()
+        self._pool = None
+        self._manager = None
+        self._msg_queue = None
+
     def __bind_events(self):
         Publisher.subscribe(self.AddNewActor, 'Create surface')
         Publisher.subscribe(self.GetActor, 'Get Actor')
@@ -669,15 +699,12 @@ class SurfaceManager():
     #(mask_index, surface_name, quality, fill_holes, keep_largest)
 
     def _on_complete_surface_creation(self, args, overwrite, surface_name, colour, dialog):
-        surface_filename, surface_measures = args
-        wx.CallAfter(self._show_surface, surface_filename, surface_measures, overwrite, surface_name, colour, dialog)
+        surface_data, surface_measures = args
+        wx.CallAfter(self._show_surface, surface_data, surface_measures, overwrite, surface_name, colour, dialog)
 
-    def _show_surface(self, surface_filename, surface_measures, overwrite, surface_name, colour, dialog):
-        print(surface_filename, surface_measures)
-        reader = vtkXMLPolyDataReader()
-        reader.SetFileName(surface_filename)
-        reader.Update()
-        polydata = reader.GetOutput()
+    def _show_surface(self, surface_data, surface_measures, overwrite, surface_name, colour, dialog):
+        print(surface_measures)
+        polydata = np_to_polydata(*surface_data)
 
         # Map polygonal data (vtkPolyData) to graphics primitives.
         mapper = vtkPolyDataMapper()
@@ -804,28 +831,43 @@ class SurfaceManager():
         else:
             flip_image = True
 
+        # The image and the mask are not resampled here, each worker reads
+        # and resamples only its piece from the original memmaps.
         if imagedata_resolution > 0:
             spacing = tuple([s * imagedata_resolution for s in spacing])
-            matrix = iu.resize_image_array(matrix, 1.0/imagedata_resolution, True)
-            mask = iu.resize_image_array(mask.matrix, 1.0/imagedata_resolution, True)
-
-            filename_img = matrix.filename
-            mask_temp_file = mask.filename
-            mask_shape = mask.shape
-            mask_dtype = mask.dtype
+        resampled_shape = surface_process.get_resampled_shape(matrix.shape,
+                                                              imagedata_resolution)
 
         n_processors = multiprocessing.cpu_count()
+        memory_budget = psutil.virtual_memory().available // 2
 
         o_piece = 1
-        piece_size = 20
+        piece_size = surface_process.get_piece_size(resampled_shape,
+                                                    n_processors,
+                                                    memory_budget)
 
-        n_pieces = int(round(matrix.shape[0] / piece_size + 0.5, 0))
+        n_pieces = int(round(resampled_shape[0] / piece_size + 0.5, 0))
+
+        pool = self._get_pool()
+        msg_queue = self._msg_queue
+        # Drops a message left by a cancelled surface creation.
+        try:
+            msg_queue.get_nowait()
+        except queue.Empty:
+            pass
 
-        filenames = []
-        ctx = multiprocessing.get_context('spawn')
-        pool = ctx.Pool(processes=min(n_pieces, n_processors))
-        manager = multiprocessing.Manager()
-        msg_queue = manager.Queue(1)
+        pieces = []
+        errors = []
+        pieces_done = threading.Event()
+
+        def on_piece_done(piece):
+            pieces.append(piece)
+            if len(pieces) == n_pieces:
+                pieces_done.set()
+
+        def on_piece_error(e):
+            errors.append(e)
+            pieces_done.set()
 
         print("Resolution", imagedata_resolution)
 
@@ -845,32 +887,29 @@ class SurfaceManager():
                                              smooth_iterations, language, flip_image,
                                              algorithm != 'Default', algorithm,
                                              imagedata_resolution, fill_border_holes),
-                                     callback=lambda x: filenames.append(x))
+                                     callback=on_piece_done,
+                                     error_callback=on_piece_error)
 
-            while len(filenames) != n_pieces:
-                time.sleep(0.25)
+            pieces_done.wait()
+            if errors:
+                print(_("InVesalius was not able to create the surface"))
+                print(errors[0])
+                return
 
             f = pool.apply_async(surface_process.join_process_surface,
-                                 args=(filenames, algorithm, smooth_iterations,
+                                 args=(pieces, algorithm, smooth_iterations,
                                        smooth_relaxation_factor,
                                        decimate_reduction, keep_largest,
                                        fill_holes, options, msg_queue))
 
-            while not f.ready():
-                time.sleep(0.25)
-
             try:
-                surface_filename, surface_measures = f.get()
+                surface_data, surface_measures = f.get()
             except Exception as e:
                 print(_("InVesalius was not able to create the surface"))
                 print(traceback.print_exc())
                 return
 
-            reader = vtkXMLPolyDataReader()
-            reader.SetFileName(surface_filename)
-            reader.Update()
-
-            polydata = reader.GetOutput()
+            polydata = np_to_polydata(*surface_data)
 
             proj = prj.Project()
             #Create Surface instance
@@ -905,20 +944,21 @@ class SurfaceManager():
                                              smooth_iterations, language, flip_image,
                                              algorithm != 'Default', algorithm,
                                              imagedata_resolution, fill_border_holes),
-                                     callback=lambda x: filenames.append(x),
+                                     callback=on_piece_done,
                                      error_callback=functools.partial(self._on_callback_error,
                                                                       dialog=sp))
 
-            while len(filenames) != n_pieces:
+            # The wait returns as soon as the last piece is done, the timeout
+            # only keeps the GUI responsive.
+            while not pieces_done.wait(0.1):
                 if sp.WasCancelled() or not sp.running:
                     break
-                time.sleep(0.25)
                 sp.Update(_("Creating 3D surface..."))
                 wx.Yield()
 
             if not sp.WasCancelled() or sp.running:
                 f = pool.apply_async(surface_process.join_process_surface,
-                                     args=(filenames, algorithm, smooth_iterations,
+                                     args=(pieces, algorithm, smooth_iterations,
                                            smooth_relaxation_factor,
                                            decimate_reduction, keep_largest,
                                            fill_holes, options, msg_queue),
@@ -933,14 +973,18 @@ class SurfaceManager():
                 while sp.running:
                     if sp.WasCancelled():
                         break
-                    time.sleep(0.25)
                     try:
-                        msg = msg_queue.get_nowait()
+                        msg = msg_queue.get(timeout=0.1)
                         sp.Update(msg)
-                    except:
+                    except queue.Empty:
                         sp.Update(None)
                     wx.Yield()
 
+            # The pieces still running are only stopped terminating the
+            # pool, a new one is created for the next surface.
+            if sp.WasCancelled():
+                self._terminate_pool()
+
             t_end = time.time()
             print("Elapsed time - {}".format(t_end-t_init))
             sp.Close()
@@ -950,14 +994,6 @@ class SurfaceManager():
                                                wx.OK|wx.ICON_ERROR)
                 dlg.ShowModal()
             del sp
-
-        pool.close()
-        try:
-            pool.terminate()
-        except AssertionError:
-            pass
-        del pool
-        del manager
         del msg_queue
         import gc
         gc.collect()
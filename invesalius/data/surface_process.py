@@ -8,9 +8,9 @@ except ImportError:
     import Queue as queue
 
 import numpy
+from scipy import ndimage
 from vtkmodules.vtkCommonCore import vtkFileOutputWindow, vtkOutputWindow
 from vtkmodules.vtkFiltersCore import (
-    vtkAppendPolyData,
     vtkCleanPolyData,
     vtkContourFilter,
     vtkMassProperties,
@@ -21,7 +21,6 @@ from vtkmodules.vtkFiltersCore import (
 from vtkmodules.vtkFiltersModeling import vtkFillHolesFilter
 from vtkmodules.vtkImagingCore import vtkImageFlip, vtkImageResample
 from vtkmodules.vtkImagingGeneral import vtkImageGaussianSmooth
-from vtkmodules.vtkIOXML import vtkXMLPolyDataReader, vtkXMLPolyDataWriter
 
 import invesalius.data.converters as converters
 from invesalius_cy import cy_mesh
@@ -49,6 +48,99 @@ def ResampleImage3D(imagedata, value):
     return resample.GetOutput()
 
 
+# Number of extra slices read around a slab when resampling it, so the
+# spline prefilter gives the same result as when the whole volume is
+# resampled. The influence of a slice on the coefficients falls by about 6x
+# per slice, 8 slices still let the rounding change by 1 in int16 images.
+RESAMPLE_HALO = 16
+
+# Limits of the number of slices of each piece the volume is split into to
+# create a surface, and the memory estimated per voxel of a piece being
+# processed (image, mask, resampling and contour buffers).
+MIN_PIECE_SIZE = 8
+MAX_PIECE_SIZE = 64
+PIECE_BYTES_PER_VOXEL = 32
+
+
+def get_piece_size(shape, n_processors, memory_budget):
+    """
+    Returns the number of slices of each piece the volume (of the given
+    shape, already resampled) is split into. The pieces are sized so each
+    processor gets about two of them (balancing the load) while the pieces
+    being processed at the same time fit in memory_budget bytes.
+    """
+    dz, dy, dx = shape
+    piece_size = int(numpy.ceil(dz / (2.0 * n_processors)))
+
+    slice_bytes = dy * dx * PIECE_BYTES_PER_VOXEL
+    max_size = memory_budget // (n_processors * slice_bytes) - 2 * RESAMPLE_HALO
+    max_size = min(max(max_size, 1), MAX_PIECE_SIZE)
+
+    return int(max(min(piece_size, max_size), min(MIN_PIECE_SIZE, max_size)))
+
+
+def get_resampled_shape(shape, imagedata_resolution):
+    """
+    Returns the shape of an image of the given shape resampled to the
+    surface quality imagedata_resolution, the same as resize_image_array
+    (scipy zoom) gives.
+    """
+    if not imagedata_resolution:
+        return tuple(shape)
+    factor = 1.0 / imagedata_resolution
+    return tuple(int(round(s * factor)) for s in shape)
+
+
+def read_slab(image, zslice, imagedata_resolution):
+    """
+    Returns the slices zslice of image resampled to imagedata_resolution,
+    only the slices of image needed (and a halo) are read. It gives the same
+    result as slicing the image resized by resize_image_array, without
+    resampling nor copying the whole image. If imagedata_resolution is 0 a
+    view of image is returned.
+    """
+    if not imagedata_resolution:
+        return image[zslice]
+
+    out_shape = get_resampled_shape(image.shape, imagedata_resolution)
+    start = max(zslice.start or 0, 0)
+    stop = min(zslice.stop, out_shape[0])
+    if stop <= start:
+        return numpy.empty((0,) + out_shape[1:], dtype=image.dtype)
+
+    # Same mapping between output and input coordinates used by zoom.
+    scales = [
+        (i - 1) / (o - 1) if o > 1 else 1.0 for i, o in zip(image.shape, out_shape)
+    ]
+    z_init = start * scales[0]
+    z_end = (stop - 1) * scales[0]
+    read_init = max(int(numpy.floor(z_init)) - RESAMPLE_HALO, 0)
+    read_end = min(int(numpy.ceil(z_end)) + RESAMPLE_HALO + 1, image.shape[0])
+
+    slab = numpy.array(image[read_init:read_end])
+    # The spline coefficients are computed once for the slab, as zoom does,
+    # then each slice is interpolated from the coordinate zoom gives it,
+    # clamped to the last slice of image. The matrix is given in full, with
+    # only the diagonal affine_transform would divide the offset by the scale
+    # and multiply it back, mapping the last slice a little past the edge of
+    # the image (where it's taken as 0).
+    coeffs = ndimage.spline_filter(slab, order=2, mode="constant", output=numpy.float64)
+    matrix = numpy.diag(scales)
+    out = numpy.empty((stop - start,) + out_shape[1:], dtype=image.dtype)
+    last = image.shape[0] - 1
+    for n, z in enumerate(range(start, stop)):
+        ndimage.affine_transform(
+            coeffs,
+            matrix,
+            offset=(min(z * scales[0], last) - read_init, 0, 0),
+            output_shape=(1,) + out_shape[1:],
+            output=out[n : n + 1],
+            order=2,
+            prefilter=False,
+        )
+    return out
+
+
 def pad_image(image, pad_value, pad_bottom, pad_top):
     dz, dy, dx = image.shape
     z_iadd = 0
@@ -82,22 +174,26 @@ def create_surface_piece(filename, shape, dtype, mask_filename, mask_shape,
     ow.SetInstance(fow)
 
 
+    # shape and mask_shape are the shapes of the original images, each piece
+    # is resampled to imagedata_resolution here.
     pad_bottom = (roi.start == 0)
-    pad_top = (roi.stop >= shape[0])
+    pad_top = (roi.stop >= get_resampled_shape(shape, imagedata_resolution)[0])
 
     if fill_border_holes:
         padding = (1, 1, pad_bottom)
     else:
         padding = (0, 0, 0)
 
+    mask_roi = slice(roi.start + 1, roi.stop + 1)
     if from_binary:
         mask = numpy.memmap(mask_filename, mode='r',
                                  dtype=mask_dtype,
                                  shape=mask_shape)
+        a_mask = read_slab(mask, mask_roi, imagedata_resolution)[:, 1:, 1:]
         if fill_border_holes:
-            a_mask = pad_image(mask[roi.start + 1: roi.stop + 1, 1:, 1:], 0, pad_bottom, pad_top)
+            a_mask = pad_image(a_mask, 0, pad_bottom, pad_top)
         else:
-            a_mask = numpy.array(mask[roi.start + 1: roi.stop + 1, 1:, 1:])
+            a_mask = numpy.array(a_mask)
         image =  converters.to_vtk(a_mask, spacing, roi.start, "AXIAL", padding=padding)
         del a_mask
     else:
@@ -106,17 +202,18 @@ def create_surface_piece(filename, shape, dtype, mask_filename, mask_shape,
         mask = numpy.memmap(mask_filename, mode='r',
                                  dtype=mask_dtype,
                                  shape=mask_shape)
+        a_image = read_slab(image, roi, imagedata_resolution)
         if fill_border_holes:
-            a_image = pad_image(image[roi], numpy.iinfo(image.dtype).min, pad_bottom, pad_top)
+            a_image = pad_image(a_image, numpy.iinfo(image.dtype).min, pad_bottom, pad_top)
         else:
-            a_image = numpy.array(image[roi])
+            a_image = numpy.array(a_image)
         #  if z_iadd:
             #  a_image[0, 1:-1, 1:-1] = image[0]
         #  if z_eadd:
             #  a_image[-1, 1:-1, 1:-1] = image[-1]
 
         if algorithm == u'InVesalius 3.b2':
-            a_mask = numpy.array(mask[roi.start + 1: roi.stop + 1, 1:, 1:])
+            a_mask = numpy.array(read_slab(mask, mask_roi, imagedata_resolution)[:, 1:, 1:])
             a_image[a_mask == 1] = a_image.min() - 1
             a_image[a_mask == 254] = (min_value + max_value) / 2.0
 
@@ -176,18 +273,47 @@ def create_surface_piece(filename, shape, dtype, mask_filename, mask_shape,
     del image
     del contour
 
-    filename = tempfile.mktemp(suffix='_%d_%d.vtp' % (roi.start, roi.stop))
-    writer = vtkXMLPolyDataWriter()
-    writer.SetInputData(polydata)
-    writer.SetFileName(filename)
-    writer.Write()
+    # The piece is sent back as arrays, all the contour cells are triangles.
+    points, polys, _, _ = converters.polydata_to_np(polydata)
+    triangles = polys.reshape(-1, 4)[:, 1:]
 
-    print("Writing piece", roi, "to", filename)
+    print("Created piece", roi, len(triangles), "triangles")
     print("MY PID MC", os.getpid())
-    return filename
+    return points, triangles
 
 
-def join_process_surface(filenames, algorithm, smooth_iterations, smooth_relaxation_factor, decimate_reduction, keep_largest, fill_holes, options, msg_queue):
+def weld_pieces(pieces):
+    """
+    Joins the pieces (points and triangles arrays) created by
+    create_surface_piece, merging the points with the same coordinates (the
+    ones in the slice shared by two pieces) and removing the triangles that
+    become degenerated.
+    """
+    n_points = [len(points) for points, _ in pieces]
+    offsets = numpy.cumsum([0] + n_points[:-1])
+    points = numpy.concatenate([points for points, _ in pieces])
+    triangles = numpy.concatenate(
+        [triangles + offset for (_, triangles), offset in zip(pieces, offsets)]
+    )
+
+    points, inverse = numpy.unique(points, axis=0, return_inverse=True)
+    triangles = inverse.reshape(-1)[triangles]
+
+    degenerated = (
+        (triangles[:, 0] == triangles[:, 1])
+        | (triangles[:, 1] == triangles[:, 2])
+        | (triangles[:, 0] == triangles[:, 2])
+    )
+    triangles = triangles[~degenerated]
+
+    # Removes the points only used by degenerated triangles.
+    used = numpy.zeros(len(points), dtype=bool)
+    used[triangles] = True
+    new_ids = numpy.cumsum(used) - 1
+    return points[used], new_ids[triangles]
+
+
+def join_process_surface(pieces, algorithm, smooth_iterations, smooth_relaxation_factor, decimate_reduction, keep_largest, fill_holes, options, msg_queue):
     def send_message(msg):
         try:
             msg_queue.put_nowait(msg)
@@ -201,40 +327,10 @@ def join_process_surface(filenames, algorithm, smooth_iterations, smooth_relaxat
     ow.SetInstance(fow)
 
     send_message('Joining surfaces ...')
-    polydata_append = vtkAppendPolyData()
-    for f in filenames:
-        reader = vtkXMLPolyDataReader()
-        reader.SetFileName(f)
-        reader.Update()
-
-        polydata = reader.GetOutput()
-
-        polydata_append.AddInputData(polydata)
-        del reader
-        del polydata
-
-    polydata_append.Update()
-    #  polydata_append.GetOutput().ReleaseDataFlagOn()
-    polydata = polydata_append.GetOutput()
-    #polydata.Register(None)
-    #  polydata.SetSource(None)
-    del polydata_append
-
-    send_message('Cleaning surface ...')
-    clean = vtkCleanPolyData()
-    #  clean.ReleaseDataFlagOn()
-    #  clean.GetOutput().ReleaseDataFlagOn()
-    clean_ref = weakref.ref(clean)
-    #  clean_ref().AddObserver("ProgressEvent", lambda obj,evt:
-                    #  UpdateProgress(clean_ref(), _("Creating 3D surface...")))
-    clean.SetInputData(polydata)
-    clean.PointMergingOn()
-    clean.Update()
-
-    del polydata
-    polydata = clean.GetOutput()
-    #  polydata.SetSource(None)
-    del clean
+    points, triangles = weld_pieces(pieces)
+    polydata = converters.np_to_polydata(points, triangles)
+    del points
+    del triangles
 
     if algorithm == 'ca_smoothing':
         send_message('Calculating normals ...')
@@ -423,12 +519,5 @@ def join_process_surface(filenames, algorithm, smooth_iterations, smooth_relaxat
     area =  float(measured_polydata.GetSurfaceArea())
     del measured_polydata
 
-    filename = tempfile.mktemp(suffix='_full.vtp')
-    writer = vtkXMLPolyDataWriter()
-    writer.SetInputData(polydata)
-    writer.SetFileName(filename)
-    writer.Write()
-    del writer
-
     print("MY PID", os.getpid())
-    return filename, {'volume': volume, 'area': area}
+    return converters.polydata_to_np(polydata), {'volume': volume, 'area': area}
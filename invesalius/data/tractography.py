@@ -40,6 +40,7 @@ from invesalius.pubsub import pub as Publisher
 
 import invesalius.constants as const
 import invesalius.data.imagedata_utils as img_utils
+from invesalius.navigation.pipeline import StageStats
 
 # Nice print for arrays
 # np.set_printoptions(precision=2)
@@ -224,16 +225,16 @@ class ComputeTractsThread(threading.Thread):
         bundle, to obtain fast computation and visualization. The bundle dataset is mapped to a single vtkActor.
         Mapper and Actor are computer in the data/viewer_volume.py module for easier handling in the invesalius 3D scene.
 
-        Sleep function in run method is used to avoid blocking GUI and more fluent, real-time navigation
+        The thread waits for the co-registered coordinates, computing the tracts as soon as new ones arrive.
 
         :param inp: List of inputs: trekker instance, affine numpy array, seed_offset, seed_radius, n_threads
         :type inp: list
-        :param queues: Queue list with coord_tracts_queue (Queue instance that manage co-registered coordinates) and
-         tracts_queue (Queue instance that manage the tracts to be visualized)
-        :type queues: list[queue.Queue, queue.Queue]
+        :param queues: Channel list with coord_tracts_queue (channel with the co-registered coordinates) and
+         tracts_queue (channel with the tracts to be visualized)
+        :type queues: list[LatestValueChannel, LatestValueChannel]
         :param event: Threading event to coordinate when tasks as done and allow UI release
         :type event: threading.Event
-        :param sle: Sleep pause in seconds
+        :param sle: Not used, kept for compatibility
         :type sle: float
         """
 
@@ -245,6 +246,7 @@ class ComputeTractsThread(threading.Thread):
         # self.visualization_queue = visualization_queue
         self.event = event
         self.sle = sle
+        self.stats = StageStats(self.name)
 
     def run(self):
 
@@ -261,7 +263,9 @@ class ComputeTractsThread(threading.Thread):
                 # print("Computing tracts")
                 # get from the queue the coordinates, coregistration transformation matrix, and flipped matrix
                 # print("Here")
-                m_img_flip = self.coord_tracts_queue.get_nowait()
+                # wait until the next co-registered coordinate is available
+                m_img_flip, timestamp = self.coord_tracts_queue.wait(const.NAVIGATION_WAIT_TIMEOUT)
+                start = time.perf_counter()
                 # coord, m_img, m_img_flip = self.coord_queue.get_nowait()
                 # print('ComputeTractsThread: get {}'.format(count))
 
@@ -326,24 +330,14 @@ class ComputeTractsThread(threading.Thread):
                 # be more evident in slow computer or for heavier tract computations, it is better slow update
                 # than visualizing old data
                 # self.visualization_queue.put_nowait([coord, m_img, bundle])
-                self.tracts_queue.put_nowait((bundle, affine_vtk, coord_offset))
+                self.tracts_queue.put_nowait((bundle, affine_vtk, coord_offset), timestamp=timestamp)
+                self.stats.add(start, timestamp)
                 # print('ComputeTractsThread: put {}'.format(count))
 
-                self.coord_tracts_queue.task_done()
-                # self.coord_queue.task_done()
-                # print('ComputeTractsThread: done {}'.format(count))
-
             # if no coordinates pass
             except queue.Empty:
                 # print("Empty queue in tractography")
                 pass
-            # if queue is full mark as done (may not be needed in this new "nowait" method)
-            except queue.Full:
-                # self.coord_queue.task_done()
-                self.coord_tracts_queue.task_done()
-
-            # sleep required to prevent user interface from being unresponsive
-            time.sleep(self.sle)
 
 
 class ComputeTractsACTThread(threading.Thread):
@@ -358,18 +352,18 @@ class ComputeTractsACTThread(threading.Thread):
         Mapper and Actor are computer in the data/viewer_volume.py module for easier handling in the
          invesalius 3D scene.
 
-        Sleep function in run method is used to avoid blocking GUI and more fluent, real-time navigation
+        The thread waits for the co-registered coordinates, computing the tracts as soon as new ones arrive.
 
         :param input_list: List of inputs: trekker instance, affine numpy array, seed offset, total number of tracts,
          seed radius, number of threads in computer, ACT data array, affine vtk matrix,
           image shift for vtk to mri transformation
         :type input_list: list
-        :param queues: Queue list with coord_tracts_queue (Queue instance that manage co-registered coordinates) and
-         tracts_queue (Queue instance that manage the tracts to be visualized)
-        :type queues: list[queue.Queue, queue.Queue]
+        :param queues: Channel list with coord_tracts_queue (channel with the co-registered coordinates) and
+         tracts_queue (channel with the tracts to be visualized)
+        :type queues: list[LatestValueChannel, LatestValueChannel]
         :param event: Threading event to coordinate when tasks as done and allow UI release
         :type event: threading.Event
-        :param sleep_thread: Sleep pause in seconds
+        :param sleep_thread: Not used, kept for compatibility
         :type sleep_thread: float
         """
 
@@ -379,6 +373,7 @@ class ComputeTractsACTThread(threading.Thread):
         self.tracts_queue = queues[1]
         self.event = event
         self.sleep_thread = sleep_thread
+        self.stats = StageStats(self.name)
 
     def run(self):
 
@@ -403,7 +398,8 @@ class ComputeTractsACTThread(threading.Thread):
         while not self.event.is_set():
             try:
                 # get from the queue the coordinates, coregistration transformation matrix, and flipped matrix
-                m_img_flip = self.coord_tracts_queue.get_nowait()
+                m_img_flip, timestamp = self.coord_tracts_queue.wait(const.NAVIGATION_WAIT_TIMEOUT)
+                start = time.perf_counter()
 
                 # DEBUG: Uncomment the m_img_flip below so that distance is fixed and tracts keep computing
                 # m_img_flip[:3, -1] = (5., 10., 12.)
@@ -547,18 +543,12 @@ class ComputeTractsACTThread(threading.Thread):
                 # use "nowait" to ensure maximum speed and avoid visualizing old tracts in the queue, this might
                 # be more evident in slow computer or for heavier tract computations, it is better slow update
                 # than visualizing old data
-                self.tracts_queue.put_nowait((bundle, affine_vtk, coord_offset, coord_offset_w))
-                self.coord_tracts_queue.task_done()
+                self.tracts_queue.put_nowait((bundle, affine_vtk, coord_offset, coord_offset_w), timestamp=timestamp)
+                self.stats.add(start, timestamp)
 
             # if no coordinates pass
             except queue.Empty:
                 pass
-            # if queue is full mark as done (may not be needed in this new "nowait" method)
-            except queue.Full:
-                self.coord_tracts_queue.task_done()
-
-            # sleep required to prevent user interface from being unresponsive
-            time.sleep(self.sleep_thread)
 
 def set_trekker_parameters(trekker, params):
     """Set all user-defined parameters for tractography computation using the Trekker library
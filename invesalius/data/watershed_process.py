@@ -1,3 +1,5 @@
+import os
+
 import numpy as np
 from scipy import ndimage
 from scipy.ndimage import watershed_ift, generate_binary_structure
@@ -6,6 +8,14 @@ try:
 except ImportError:
     from skimage.morphology import watershed
 
+# Voxels added around the bounding box of the markers, the watershed is only
+# computed inside it.
+MARGIN = 16
+
+# Number of slices processed at once when computing the gradient.
+CHUNK_SIZE = 32
+
+
 def get_LUT_value(data, window, level):
     shape = data.shape
     data_ = data.ravel()
@@ -17,31 +27,110 @@ def get_LUT_value(data, window, level):
     return data
 
 
-def do_watershed(image, markers,  tfile, shape, bstruct, algorithm, mg_size, use_ww_wl, wl, ww, q):
-    mask = np.memmap(tfile, shape=shape, dtype='uint8', mode='r+')
-                
+def get_memmap_filename(array):
+    """
+    Returns the file of array if it's a memmap which can be opened again by
+    filename (the whole file, in C order), otherwise None.
+    """
+    if (
+        isinstance(array, np.memmap)
+        and array.filename
+        and array.offset == 0
+        and array.flags.c_contiguous
+        and os.path.getsize(array.filename) == array.nbytes
+    ):
+        return array.filename
+    return None
+
+
+def get_markers_bbox(markers, margin=MARGIN):
+    """
+    Returns the bounding box of the non-zero voxels of markers, increased by
+    margin, as a tuple of slices (z, y, x). markers is read in blocks of
+    slices. Returns None if there isn't any marker.
+    """
+    dz, dy, dx = markers.shape
+    slices = []
+    rows = np.zeros(dy, dtype=bool)
+    cols = np.zeros(dx, dtype=bool)
+    for z in range(0, dz, CHUNK_SIZE):
+        block = markers[z : z + CHUNK_SIZE] != 0
+        slices.append(block.any(axis=(1, 2)))
+        rows |= block.any(axis=(0, 2))
+        cols |= block.any(axis=(0, 1))
+    slices = np.concatenate(slices)
+
+    if not slices.any():
+        return None
+
+    bbox = []
+    for flags, size in zip((slices, rows, cols), (dz, dy, dx)):
+        indexes = np.flatnonzero(flags)
+        bbox.append(slice(max(int(indexes[0]) - margin, 0), min(int(indexes[-1]) + margin + 1, size)))
+    return tuple(bbox)
+
+
+def get_uint16_image(image, use_ww_wl, wl, ww):
+    """
+    Returns image as uint16. With use_ww_wl it's the value given by
+    get_LUT_value, taken from a table computed once for each value of
+    image, otherwise it's image shifted to start at 0.
+    """
+    if use_ww_wl and not np.issubdtype(image.dtype, np.integer):
+        return get_LUT_value(image, ww, wl).astype('uint16')
+
+    _min = image.min()
+    shifted = (image - _min).astype('uint16')
     if use_ww_wl:
-        if algorithm == 'Watershed':
-            tmp_image = ndimage.morphological_gradient(
-                           get_LUT_value(image, ww, wl).astype('uint16'),
-                           mg_size)
-            tmp_mask = watershed(tmp_image, markers.astype('int16'), bstruct)
-        else:
-            tmp_image = get_LUT_value(image, ww, wl).astype('uint16')
-            #tmp_image = ndimage.gaussian_filter(tmp_image, self.config.mg_size)
-            #tmp_image = ndimage.morphological_gradient(
-                           #get_LUT_value(image, ww, wl).astype('uint16'),
-                           #self.config.mg_size)
-            tmp_mask = watershed_ift(tmp_image, markers.astype('int16'), bstruct)
+        values = np.arange(int(shifted.max()) + 1, dtype='float64') + int(_min)
+        table = get_LUT_value(values, ww, wl).astype('uint16')
+        return np.take(table, shifted)
+    return shifted
+
+
+def morphological_gradient(image, size):
+    """
+    ndimage.morphological_gradient of the uint16 image computed in blocks
+    of slices.
+    """
+    halo = size // 2
+    gradient = np.empty_like(image)
+    dz = image.shape[0]
+    for z in range(0, dz, CHUNK_SIZE):
+        init = max(z - halo, 0)
+        end = min(z + CHUNK_SIZE + halo, dz)
+        block = ndimage.morphological_gradient(image[init:end], size)
+        gradient[z : z + CHUNK_SIZE] = block[z - init : z - init + CHUNK_SIZE]
+    return gradient
+
+
+def do_watershed(image_file, image_shape, image_dtype, markers_file, tfile, bstruct, algorithm, mg_size, use_ww_wl, wl, ww, q):
+    """
+    Computes the watershed of the image given the markers, both opened from
+    their files, and writes it in the memmap tfile. Only the bounding box of
+    the markers (plus a margin) is computed, it's put in q when done.
+    """
+    image = np.memmap(image_file, shape=image_shape, dtype=image_dtype, mode='r')
+    markers = np.memmap(markers_file, shape=image_shape, dtype='uint8', mode='r')
+    mask = np.memmap(tfile, shape=image_shape, dtype='uint8', mode='r+')
+
+    bbox = get_markers_bbox(markers)
+    if bbox is None:
+        q.put(None)
+        return
+
+    tmp_image = get_uint16_image(np.asarray(image[bbox]), use_ww_wl, wl, ww)
+    tmp_markers = np.asarray(markers[bbox])
+
+    if algorithm == 'Watershed':
+        tmp_image = morphological_gradient(tmp_image, mg_size)
+        tmp_mask = watershed(tmp_image, tmp_markers.astype('int16'), bstruct)
     else:
-        if algorithm == 'Watershed':
-            tmp_image = ndimage.morphological_gradient((image - image.min()).astype('uint16'), mg_size)
-            tmp_mask = watershed(tmp_image, markers.astype('int16'), bstruct)
+        #tmp_image = ndimage.gaussian_filter(tmp_image, self.config.mg_size)
+        if use_ww_wl:
+            tmp_mask = watershed_ift(tmp_image, tmp_markers.astype('int16'), bstruct)
         else:
-            tmp_image = (image - image.min()).astype('uint16')
-            #tmp_image = ndimage.gaussian_filter(tmp_image, self.config.mg_size)
-            #tmp_image = ndimage.morphological_gradient((image - image.min()).astype('uint16'), self.config.mg_size)
-            tmp_mask = watershed_ift(tmp_image, markers.astype('int8'), bstruct)
-    mask[:] = tmp_mask
+            tmp_mask = watershed_ift(tmp_image, tmp_markers.astype('int8'), bstruct)
+    mask[bbox] = tmp_mask
     mask.flush()
-    q.put(1)
+    q.put(bbox)
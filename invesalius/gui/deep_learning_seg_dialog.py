@@ -20,6 +20,7 @@ from invesalius.segmentation.deep_learning import segment, utils
 
 HAS_THEANO = bool(importlib.util.find_spec("theano"))
 HAS_PLAIDML = bool(importlib.util.find_spec("plaidml"))
+HAS_ONNXRUNTIME = bool(importlib.util.find_spec("onnxruntime"))
 PLAIDML_DEVICES = {}
 TORCH_DEVICES = {}
 
@@ -58,6 +59,7 @@ class DeepLearningSegmenterDialog(wx.Dialog):
         has_torch=True,
         has_plaidml=True,
         has_theano=True,
+        has_onnx=True,
         segmenter=None
     ):
         wx.Dialog.__init__(
@@ -70,6 +72,10 @@ class DeepLearningSegmenterDialog(wx.Dialog):
         backends = []
         if HAS_TORCH and has_torch:
             backends.append("Pytorch")
+        # Pytorch is needed to export the model to ONNX, without it only a
+        # model already exported can be used.
+        if HAS_ONNXRUNTIME and has_onnx and (HAS_TORCH or self._has_onnx_model(segmenter)):
+            backends.append("ONNX")
         if HAS_PLAIDML and has_plaidml:
             backends.append("PlaidML")
         if HAS_THEANO and has_theano:
@@ -96,6 +102,8 @@ class DeepLearningSegmenterDialog(wx.Dialog):
         w, h = self.CalcSizeFromTextSize("MM" * (1 + max(len(i) for i in backends)))
         self.cb_backends.SetMinClientSize((w, -1))
         self.chk_use_gpu = wx.CheckBox(self, wx.ID_ANY, _("Use GPU"))
+        self.chk_quantize = wx.CheckBox(self, wx.ID_ANY, _("Quantize model (INT8)"))
+        self.chk_quantize.SetValue(False)
         if HAS_TORCH or HAS_PLAIDML:
             if HAS_TORCH:
                 choices = list(self.torch_devices.keys())
@@ -153,6 +161,7 @@ class DeepLearningSegmenterDialog(wx.Dialog):
         sizer_backends.Add(self.cb_backends, 1, wx.LEFT, 5)
         main_sizer.Add(sizer_backends, 0, wx.ALL | wx.EXPAND, 5)
         main_sizer.Add(self.chk_use_gpu, 0, wx.ALL, 5)
+        main_sizer.Add(self.chk_quantize, 0, wx.ALL, 5)
         sizer_devices = wx.BoxSizer(wx.HORIZONTAL)
         if HAS_TORCH or HAS_PLAIDML:
             sizer_devices.Add(self.lbl_device, 0, wx.ALIGN_CENTER, 0)
@@ -210,6 +219,23 @@ class DeepLearningSegmenterDialog(wx.Dialog):
             slc.Slice().discard_all_buffers()
             Publisher.sendMessage("Reload actual slice")
 
+    @staticmethod
+    def _has_onnx_model(segmenter, quantize=None):
+        """
+        Returns if the ONNX model of segmenter was already exported, quantized
+        or not (either if quantize is None).
+        """
+        if segmenter is None or not segmenter.TORCH_WEIGHTS_FILE_NAME:
+            return False
+        if quantize is None:
+            options = (False, True)
+        else:
+            options = (quantize,)
+        return any(
+            segment.get_onnx_model_file(segmenter.TORCH_WEIGHTS_FILE_NAME, q).exists()
+            for q in options
+        )
+
     def CalcSizeFromTextSize(self, text):
         dc = wx.WindowDC(self)
         dc.SetFont(self.GetFont())
@@ -217,6 +243,11 @@ class DeepLearningSegmenterDialog(wx.Dialog):
         return width, height
 
     def OnSetBackend(self, evt=None):
+        if self.cb_backends.GetValue().lower() == "onnx":
+            self.chk_quantize.Show()
+        else:
+            self.chk_quantize.Hide()
+
         if self.cb_backends.GetValue().lower() == "pytorch":
             if HAS_TORCH:
                 choices = list(self.torch_devices.keys())
@@ -235,6 +266,12 @@ class DeepLearningSegmenterDialog(wx.Dialog):
                 self.lbl_device.Show()
                 self.cb_devices.Show()
             self.chk_use_gpu.Hide()
+        elif self.cb_backends.GetValue().lower() == "onnx":
+            # Only runs on CPU.
+            if HAS_TORCH or HAS_PLAIDML:
+                self.lbl_device.Hide()
+                self.cb_devices.Hide()
+            self.chk_use_gpu.Hide()
         else:
             if HAS_PLAIDML:
                 self.lbl_device.Hide()
@@ -264,16 +301,34 @@ class DeepLearningSegmenterDialog(wx.Dialog):
             self.apply_segment_threshold()
 
     def OnSegment(self, evt):
+        backend = self.cb_backends.GetValue()
+        quantize = self.chk_quantize.GetValue()
+        if (
+            backend.lower() == "onnx"
+            and not HAS_TORCH
+            and not self._has_onnx_model(self.segmenter, quantize)
+        ):
+            if quantize:
+                msg = _("The quantized ONNX model was not exported yet. Pytorch is needed to export it, or "
+                        "uncheck the quantize option to use the model already exported.")
+            else:
+                msg = _("The ONNX model was not exported yet. Pytorch is needed to export it, or check the "
+                        "quantize option to use the quantized model already exported.")
+            dlg = dialogs.ErrorMessageBox(None, _("ONNX model not found"), msg)
+            dlg.ShowModal()
+            return
+
         self.ShowProgress()
         self.t0 = time.time()
         self.elapsed_time_timer.Start(1000)
         image = slc.Slice().matrix
-        backend = self.cb_backends.GetValue()
         if backend.lower() == "pytorch":
             try:
                 device_id = self.torch_devices[self.cb_devices.GetValue()]
             except (KeyError, AttributeError):
                 device_id = "cpu"
+        elif backend.lower() == "onnx":
+            device_id = "cpu"
         else:
             try:
                 device_id = self.plaidml_devices[self.cb_devices.GetValue()]
@@ -304,6 +359,7 @@ class DeepLearningSegmenterDialog(wx.Dialog):
                 apply_wwwl,
                 window_width,
                 window_level,
+                quantize=quantize,
             )
             self.ps.start()
         except (multiprocessing.ProcessError, OSError, ValueError) as err:
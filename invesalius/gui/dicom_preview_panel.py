@@ -551,16 +551,15 @@ class DicomPreviewSlice(wx.Panel):
         dicom_files = group.GetHandSortedList()
         n = 0
         for dicom in dicom_files:
-            if isinstance(dicom.image.thumbnail_path, list):
-                _slice = 0
-                for thumbnail in dicom.image.thumbnail_path:
-                    print(thumbnail)
+            # The thumbnails are only created when shown, the number of
+            # frames comes from the header.
+            if dicom.image.number_of_frames > 1:
+                for _slice in range(dicom.image.number_of_frames):
                     info = DicomInfo(n, dicom,
                                      _("Image %d") % (n),
                                      "%.2f" % (dicom.image.position[2]), _slice)
                     self.files.append(info)
                     n+=1
-                    _slice += 1
             else:
                 info = DicomInfo(n, dicom,
                                  _("Image %d") % (dicom.image.number),
@@ -583,16 +582,15 @@ class DicomPreviewSlice(wx.Panel):
         dicom_files = group.GetHandSortedList()
         n = 0
         for dicom in dicom_files:
-            if isinstance(dicom.image.thumbnail_path, list):
-                _slice = 0
-                for thumbnail in dicom.image.thumbnail_path:
-                    print(thumbnail)
+            # The thumbnails are only created when shown, the number of
+            # frames comes from the header.
+            if dicom.image.number_of_frames > 1:
+                for _slice in range(dicom.image.number_of_frames):
                     info = DicomInfo(n, dicom,
                                      _("Image %d") % int(n),
                                      "%.2f" % (dicom.image.position[2]), _slice)
                     self.files.append(info)
                     n+=1
-                    _slice += 1
             else:
                 info = DicomInfo(n, dicom,
                                  _("Image %d") % int(dicom.image.number),
@@ -895,7 +893,7 @@ class SingleImagePreview(wx.Panel):
                             dicom.acquisition.time)
         self.text_acquisition.SetValue(value)
 
-        if isinstance(dicom.image.thumbnail_path, list):
+        if dicom.image.number_of_frames > 1:
             reader = vtkPNGReader()
             if _has_win32api:
                 reader.SetFileName(win32api.GetShortPathName(dicom.image.thumbnail_path[index]).encode(const.FS_ENCODE))
@@ -982,6 +982,7 @@ class ObjectRegistrationPanel(wx.Panel):
         self.obj_ref_mode = None
         self.obj_name = None
         self.timestamp = const.TIMESTAMP
+        self.record_filename = None
 
         self.SetAutoLayout(1)
         self.__bind_events()
@@ -1149,13 +1150,28 @@ class ObjectRegistrationPanel(wx.Panel):
     def OnRecordCoords(self, evt, ctrl):
         if ctrl.GetValue() and evt:
             self.spin_timestamp_dist.Enable(0)
-            self.thr_record = rec.Record(ctrl.GetValue(), self.timestamp)
+            # All the samples are recorded, the timestamp interval is only
+            # used when saving them as CSV.
+            self.record_filename = str(inv_paths.USER_NAV_RECORDS_DIR.joinpath(
+                time.strftime("navigation_%Y%m%d_%H%M%S") + "." + rec.RECORD_EXTENSION))
+            Publisher.sendMessage('Start navigation recording', filename=self.record_filename)
         elif (not ctrl.GetValue() and evt) or (ctrl.GetValue() and not evt) :
             self.spin_timestamp_dist.Enable(1)
-            self.thr_record.stop()
+            Publisher.sendMessage('Stop navigation recording')
+            self.SaveRecordedCoords()
         elif not ctrl.GetValue() and not evt:
             None
 
+    def SaveRecordedCoords(self):
+        if self.record_filename is None or not os.path.exists(self.record_filename):
+            return
+        filename = dlg.ShowLoadSaveDialog(message=_(u"Save coords as..."),
+                                          wildcard=_("Coordinates files (*.csv)|*.csv"),
+                                          style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT,
+                                          default_filename="coords.csv", save_ext="csv")
+        if filename:
+            rec.export_csv(self.record_filename, filename, self.timestamp)
+
     # 'Track object' checkbox
 
     def EnableTrackObjectCheckbox(self, enabled):
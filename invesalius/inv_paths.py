@@ -28,6 +28,8 @@ USER_INV_DIR = CONF_DIR.joinpath("invesalius")
 USER_PRESET_DIR = USER_INV_DIR.joinpath("presets")
 USER_LOG_DIR = USER_INV_DIR.joinpath("logs")
 USER_DL_WEIGHTS = USER_INV_DIR.joinpath("deep_learning/weights/")
+USER_DICOM_INDEX = USER_INV_DIR.joinpath("dicom_index.sqlite")
+USER_NAV_RECORDS_DIR = USER_INV_DIR.joinpath("navigation_records")
 USER_RAYCASTING_PRESETS_DIRECTORY = USER_PRESET_DIR.joinpath("raycasting")
 TEMP_DIR = tempfile.gettempdir()
 
@@ -99,6 +101,7 @@ def create_conf_folders():
     USER_PRESET_DIR.mkdir(parents=True, exist_ok=True)
     USER_LOG_DIR.mkdir(parents=True, exist_ok=True)
     USER_DL_WEIGHTS.mkdir(parents=True, exist_ok=True)
+    USER_NAV_RECORDS_DIR.mkdir(parents=True, exist_ok=True)
     USER_PLUGINS_DIRECTORY.mkdir(parents=True, exist_ok=True)
 
 
@@ -0,0 +1,323 @@
+#--------------------------------------------------------------------------
+# Software:     InVesalius - Software de Reconstrucao 3D de Imagens Medicas
+# Copyright:    (C) 2001  Centro de Pesquisas Renato Archer
+# Homepage:     http://www.softwarepublico.gov.br
+# Contact:      invesalius@cti.gov.br
+# License:      GNU - GPL 2 (LICENSE.txt/LICENCA.txt)
+#--------------------------------------------------------------------------
+#    Este programa e software livre; voce pode redistribui-lo e/ou
+#    modifica-lo sob os termos da Licenca Publica Geral GNU, conforme
+#    publicada pela Free Software Foundation; de acordo com a versao 2
+#    da Licenca.
+#
+#    Este programa eh distribuido na expectativa de ser util, mas SEM
+#    QUALQUER GARANTIA; sem mesmo a garantia implicita de
+#    COMERCIALIZACAO ou de ADEQUACAO A QUALQUER PROPOSITO EM
+#    PARTICULAR. Consulte a Licenca Publica Geral GNU para obter mais
+#    detalhes.
+#--------------------------------------------------------------------------
+
+"""
+Headless benchmark of the navigation pipeline.
+
+Runs the tracker (one of the debug trackers or the replay of a navigation
+recording), the co-registration and the scene update stages like in a
+navigation, with the GUI replaced by HeadlessGUI, and reports the
+throughput, the latencies (see StageStats) and the samples dropped by each
+stage. Example:
+
+    python -m invesalius.navigation.benchmark --duration 10 --rate 200
+    python -m invesalius.navigation.benchmark --recording navigation.nrec --speed 0 --lossless
+"""
+
+import argparse
+import collections
+import json
+import queue
+import sys
+import threading
+import time
+import types
+
+import numpy as np
+
+import invesalius.constants as const
+import invesalius.data.bases as db
+import invesalius.data.coordinates as dco
+import invesalius.data.coregistration as dcr
+import invesalius.data.record_coords as rec
+# Imported before the navigation, which imports invesalius.project, that can
+# only be imported after slice_ (they import each other).
+import invesalius.data.slice_  # noqa: F401
+import invesalius.data.transformations as tr
+from invesalius.navigation.navigation import StageScheduler, UpdateNavigationScene
+from invesalius.navigation.pipeline import FrameDispatcher, LatestValueChannel
+
+# Sampling rate, in Hz, of the debug tracker.
+DEFAULT_RATE = 100.0
+
+# Duration, in seconds, of a benchmark with the debug tracker.
+DEFAULT_DURATION = 10.0
+
+# Object registration (fiducials and orientations of the coil, the last row
+# is the probe fixed on it) used when benchmarking with object tracking.
+OBJECT_FIDUCIALS = np.array([
+    [-30.0, 0.0, 0.0],
+    [30.0, 0.0, 0.0],
+    [0.0, 40.0, 0.0],
+    [0.0, 0.0, 10.0],
+])
+OBJECT_ORIENTATIONS = np.array([
+    [0.0, 0.0, 0.0],
+    [0.0, 0.0, 0.0],
+    [0.0, 0.0, 0.0],
+    [10.0, 20.0, 30.0],
+])
+
+
+class HeadlessGUI(threading.Thread):
+    """
+    Stands for the wx main loop: runs the functions given to call_after and
+    call_later in its own thread and receives the messages sent to the GUI,
+    counting them by topic. Each 'Render volume viewer' takes render_time
+    seconds, simulating the time the GUI takes rendering a frame.
+    """
+
+    def __init__(self, render_time=0.0):
+        threading.Thread.__init__(self, name='HeadlessGUI', daemon=True)
+        self.render_time = render_time
+        self.messages = collections.Counter()
+        self._calls = queue.Queue()
+
+    def call_after(self, func, *args, **kwargs):
+        self._calls.put((func, args, kwargs))
+
+    def call_later(self, milliseconds, func, *args, **kwargs):
+        timer = threading.Timer(milliseconds / 1000.0, self.call_after, (func,) + args, kwargs)
+        timer.daemon = True
+        timer.start()
+
+    def send(self, topic, **kwargs):
+        self.messages[topic] += 1
+        if topic == 'Render volume viewer' and self.render_time:
+            time.sleep(self.render_time)
+
+    def get_dispatcher(self):
+        return FrameDispatcher(call_after=self.call_after, call_later=self.call_later, send=self.send)
+
+    def run(self):
+        while True:
+            func, args, kwargs = self._calls.get()
+            if func is None:
+                return
+            func(*args, **kwargs)
+
+    def stop(self):
+        self._calls.put((None, (), {}))
+
+
+def get_coreg_data(track_object, coord_raw):
+    """
+    Returns the co-registration data of a fixed fiducial registration and,
+    with track_object, of the object registration in OBJECT_FIDUCIALS.
+    """
+    m_change = tr.compose_matrix(angles=np.radians([5.0, -10.0, 90.0]), translate=[100.0, -50.0, 20.0])
+    coreg_data = [m_change, 0]
+    if track_object:
+        coreg_data.extend(db.object_registration(OBJECT_FIDUCIALS, OBJECT_ORIENTATIONS, coord_raw, m_change))
+    return coreg_data
+
+
+def run_benchmark(duration=DEFAULT_DURATION, rate=DEFAULT_RATE, recording=None, speed=1.0, lossless=False,
+                  track_object=False, tracker_id=const.DEBUGTRACKRANDOM, tracker_delay=0.0, render_time=0.0,
+                  record=None):
+    """
+    Runs the navigation pipeline for duration seconds (or until the end of
+    the recording, if given) and returns its report, see format_report.
+
+    :param rate: Sampling rate of the debug tracker, in Hz
+    :param recording: Navigation recording replayed instead of the debug tracker
+    :param speed: Replay speed, 0 is as fast as possible
+    :param lossless: The replay waits for each sample to be taken by the co-registration
+    :param track_object: Co-registers with object tracking
+    :param tracker_id: const.DEBUGTRACKRANDOM or const.DEBUGTRACKAPPROACH
+    :param tracker_delay: Time, in seconds, the debug tracker takes to give the coordinates
+    :param render_time: Time, in seconds, the GUI takes rendering a frame
+    :param record: Records the co-registered coordinates to this file
+    """
+    event = threading.Event()
+    gui = HeadlessGUI(render_time)
+    dispatcher = gui.get_dispatcher()
+
+    tracker_coordinates = dco.TrackerCoordinates(ui_dispatcher=gui.get_dispatcher())
+    tracker_coordinates.nav_status = True
+    tracker = types.SimpleNamespace(TrackerCoordinates=tracker_coordinates, tracker_id=tracker_id)
+    icp = types.SimpleNamespace(use_icp=False, m_icp=None)
+
+    if recording is not None:
+        source = rec.ReplayCoordinates(recording, tracker_coordinates, event, speed, lossless)
+        coord_raw = source.records['coord_raw'][0] if len(source.records) else np.zeros((4, 6))
+    else:
+        dco.DEBUG_TRACKER_DELAY = tracker_delay
+        source = dco.ReceiveCoordinates(None, tracker_id, tracker_coordinates, event, period=1.0 / rate)
+        coord_raw = dco.DebugCoordRandom(None, tracker_id, const.DEFAULT_REF_MODE)[0]
+
+    coord_queue = LatestValueChannel('coord')
+    coord_tracts_queue = LatestValueChannel('coord_tracts')
+    icp_queue = LatestValueChannel('icp')
+    object_at_target_queue = LatestValueChannel('object_at_target')
+    efield_queue = LatestValueChannel('efield')
+    vis_queues = [coord_queue, LatestValueChannel('serial_port'), LatestValueChannel('tracts'), icp_queue,
+                  LatestValueChannel('e_field_norms'), LatestValueChannel('e_field_IDs')]
+
+    scheduler = StageScheduler(event)
+    for channel in [tracker_coordinates.channel, coord_tracts_queue, object_at_target_queue, efield_queue] + vis_queues:
+        scheduler.add_channel(channel)
+
+    coreg_data = get_coreg_data(track_object, coord_raw)
+    if track_object:
+        target = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0] if tracker_id == const.DEBUGTRACKAPPROACH else None
+        queues = [coord_queue, coord_tracts_queue, icp_queue, object_at_target_queue, efield_queue]
+        coregistration = dcr.CoordinateCorregistrate(const.DEFAULT_REF_MODE, tracker, coreg_data, False, queues,
+                                                     event, 0, tracker_id, target, icp, False)
+    else:
+        queues = [coord_queue, coord_tracts_queue, icp_queue, efield_queue]
+        coregistration = dcr.CoordinateCorregistrateNoObject(const.DEFAULT_REF_MODE, tracker, coreg_data, False,
+                                                             queues, event, 0, icp, False)
+
+    recorder = None
+    if record is not None:
+        recorder = rec.NavigationRecorder(record)
+        coregistration.recorder = recorder
+        recorder.start()
+
+    scene = UpdateNavigationScene(vis_queues, [False, False, False, False], event, 0, None, ui_dispatcher=dispatcher)
+
+    for stage in (source, coregistration, scene):
+        scheduler.add_stage(stage)
+
+    gui.start()
+    start = time.perf_counter()
+    scheduler.start()
+    if recording is not None:
+        source.join(duration)
+    else:
+        event.wait(duration)
+    # Lets the last sample go through the pipeline.
+    time.sleep(2 * const.NAVIGATION_WAIT_TIMEOUT)
+    scheduler.stop()
+    elapsed = time.perf_counter() - start
+    gui.stop()
+    gui.join()
+
+    if recorder is not None:
+        recorder.stop()
+
+    stages = scheduler.get_latencies()
+    for summary in stages.values():
+        summary['throughput'] = summary['count'] / elapsed
+
+    channel = tracker_coordinates.channel
+    return {
+        'elapsed': elapsed,
+        'samples': channel.received,
+        'sample_rate': channel.received / elapsed,
+        'stages': stages,
+        'dropped': scheduler.get_dropped(),
+        'frames': dispatcher.get_stats(),
+        'messages': dict(gui.messages),
+        'recorded': recorder.written if recorder is not None else None,
+    }
+
+
+def format_report(report):
+    lines = [
+        "Navigation benchmark: %d tracker samples in %.2f s (%.1f samples/s)"
+        % (report['samples'], report['elapsed'], report['sample_rate']),
+        "",
+        "%-20s %10s %12s %12s %12s %12s %12s"
+        % ("stage", "count", "samples/s", "dur p50 ms", "dur p99 ms", "lat p50 ms", "lat p99 ms"),
+    ]
+    for name, summary in report['stages'].items():
+        lines.append(
+            "%-20s %10d %12.1f %12.3f %12.3f %12.3f %12.3f" % (
+                name, summary['count'], summary['throughput'],
+                summary.get('duration_p50', np.nan), summary.get('duration_p99', np.nan),
+                summary.get('latency_p50', np.nan), summary.get('latency_p99', np.nan),
+            )
+        )
+    dropped = ["%s %d" % (name, n) for name, n in report['dropped'].items() if n]
+    lines.append("")
+    lines.append("Dropped samples: %s" % (", ".join(dropped) or "none"))
+    frames = report['frames']
+    lines.append(
+        "GUI frames: %d dispatched, %d dropped, %d updates coalesced"
+        % (frames['dispatched'], frames['dropped'], frames['coalesced'])
+    )
+    if report['recorded'] is not None:
+        lines.append("Recorded samples: %d" % report['recorded'])
+    return "\n".join(lines)
+
+
+def parse_command_line(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m invesalius.navigation.benchmark",
+        description="Headless benchmark of the navigation pipeline.",
+    )
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION,
+                        help="Duration in seconds (the maximum one when replaying a recording).")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE,
+                        help="Sampling rate of the debug tracker in Hz.")
+    parser.add_argument("--approach", action="store_true",
+                        help="Use the debug tracker approaching a target (with --object).")
+    parser.add_argument("--tracker-delay", type=float, default=0.0,
+                        help="Time in seconds the debug tracker takes to give the coordinates.")
+    parser.add_argument("--recording", help="Replay this navigation recording instead of the debug tracker.")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Replay speed, 0 replays as fast as possible.")
+    parser.add_argument("--lossless", action="store_true",
+                        help="Replay all the samples, each waits for the previous one to be co-registered.")
+    parser.add_argument("--object", action="store_true", dest="track_object",
+                        help="Co-register with object tracking.")
+    parser.add_argument("--render-time", type=float, default=0.0,
+                        help="Time in milliseconds the GUI takes rendering a frame.")
+    parser.add_argument("--record", help="Record the co-registered coordinates to this file.")
+    parser.add_argument("--json", dest="json_file", help="Save the report as JSON to this file.")
+    parser.add_argument("--max-latency", type=float,
+                        help="Fail if the p99 latency of a stage is above this, in milliseconds.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_command_line(argv)
+    report = run_benchmark(
+        duration=args.duration,
+        rate=args.rate,
+        recording=args.recording,
+        speed=args.speed,
+        lossless=args.lossless,
+        track_object=args.track_object,
+        tracker_id=const.DEBUGTRACKAPPROACH if args.approach else const.DEBUGTRACKRANDOM,
+        tracker_delay=args.tracker_delay,
+        render_time=args.render_time / 1000.0,
+        record=args.record,
+    )
+    print(format_report(report))
+
+    if args.json_file:
+        with open(args.json_file, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.max_latency is not None:
+        slow = [
+            name for name, summary in report['stages'].items()
+            if summary.get('latency_p99', 0.0) > args.max_latency
+        ]
+        if slow:
+            print("p99 latency above %.3f ms: %s" % (args.max_latency, ", ".join(slow)))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
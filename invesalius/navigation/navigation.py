@@ -19,7 +19,7 @@
 
 import threading
 import queue
-from time import sleep
+import time
 
 import wx
 import numpy as np
@@ -28,6 +28,7 @@ import invesalius.constants as const
 import invesalius.project as prj
 import invesalius.data.bases as db
 import invesalius.data.coregistration as dcr
+import invesalius.data.record_coords as rec
 import invesalius.data.serial_port_connection as spc
 import invesalius.data.slice_ as sl
 import invesalius.data.tractography as dti
@@ -35,52 +36,97 @@ import invesalius.data.e_field as e_field
 import invesalius.data.transformations as tr
 import invesalius.data.vtk_utils as vtk_utils
 import invesalius.session as ses
+from invesalius.navigation.pipeline import FrameDispatcher, LatestValueChannel, StageStats
 from invesalius.pubsub import pub as Publisher
-from invesalius.utils import Singleton
+from invesalius.utils import Singleton, debug
 
-class QueueCustom(queue.Queue):
+# Maximum time, in seconds, waited for each navigation thread to finish when
+# the navigation stops.
+STAGE_JOIN_TIMEOUT = 1.0
+
+class StageScheduler:
     """
-    A custom queue subclass that provides a :meth:`clear` method.
-    https://stackoverflow.com/questions/6517953/clear-all-items-from-the-queue
-    Modified to a LIFO Queue type (Last-in-first-out). Seems to make sense for the navigation
-    threads, as the last added coordinate should be the first to be processed.
-    In the first tests in a short run, seems to increase the coord queue size considerably,
-    possibly limiting the queue size is good.
+    Runs the navigation stages, the threads connected by LatestValueChannel
+    (tracker coordinates -> co-registration -> tracts, e-field -> scene
+    update). Each stage blocks waiting for the data of its input channel, so
+    it runs as soon as the previous stage outputs and is idle otherwise, no
+    stage polls or sleeps between the tracker sample and the scene update.
+
+    The channels are opened when the navigation starts and closed when it
+    stops, which wakes the stages still waiting so they finish.
     """
 
+    def __init__(self, event):
+        self.event = event
+        self.channels = []
+        self.stages = []
+
+    def add_channel(self, channel):
+        self.channels.append(channel)
+
+    def add_stage(self, stage):
+        self.stages.append(stage)
+
+    def start(self):
+        self.event.clear()
+        for channel in self.channels:
+            channel.open()
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self, timeout=STAGE_JOIN_TIMEOUT):
+        self.event.set()
+        for channel in self.channels:
+            channel.close()
+        for stage in self.stages:
+            if stage.is_alive() and stage is not threading.current_thread():
+                stage.join(timeout)
+
     def clear(self):
         """
-        Clears all items from the queue.
+        Removes the stages of the last navigation.
+        """
+        self.stages = []
+
+    def get_latencies(self):
+        """
+        Returns the StageStats summary of each stage (of the current
+        navigation or the last one), by stage name.
         """
+        return {
+            stage.name: stage.stats.summary()
+            for stage in self.stages
+            if getattr(stage, 'stats', None) is not None
+        }
 
-        with self.mutex:
-            unfinished = self.unfinished_tasks - len(self.queue)
-            if unfinished <= 0:
-                if unfinished < 0:
-                    raise ValueError('task_done() called too many times')
-                self.all_tasks_done.notify_all()
-            self.unfinished_tasks = unfinished
-            self.queue.clear()
-            self.not_full.notify_all()
+    def get_dropped(self):
+        """
+        Returns the number of values replaced before being read in each
+        channel, by channel name.
+        """
+        return {channel.name: channel.dropped for channel in self.channels}
 
 
 class UpdateNavigationScene(threading.Thread):
 
-    def __init__(self, vis_queues, vis_components, event, sle, neuronavigation_api):
+    def __init__(self, vis_queues, vis_components, event, sle, neuronavigation_api, ui_dispatcher=None):
         """Class (threading) to update the navigation scene with all graphical elements.
 
-        Sleep function in run method is used to avoid blocking GUI and more fluent, real-time navigation
+        The thread waits for the co-registered coordinates and updates the scene as soon as they arrive.
 
-        :param affine_vtk: Affine matrix in vtkMatrix4x4 instance to update objects position in 3D scene
-        :type affine_vtk: vtkMatrix4x4
-        :param visualization_queue: Queue instance that manage coordinates to be visualized
-        :type visualization_queue: queue.Queue
+        :param vis_queues: Channels with the coordinates, serial port triggers, tracts, ICP, e-field norms and
+         e-field IDs
+        :type vis_queues: list[LatestValueChannel]
+        :param vis_components: Flags for the serial port, tracts, peel and e-field
+        :type vis_components: list[bool]
         :param event: Threading event to coordinate when tasks as done and allow UI release
         :type event: threading.Event
-        :param sle: Sleep pause in seconds
+        :param sle: Not used, kept for compatibility
         :type sle: float
         :param neuronavigation_api: An API object for communicating the coil position.
         :type neuronavigation_api: invesalius.net.neuronavigation_api.NeuronavigationAPI
+        :param ui_dispatcher: Dispatcher sending the GUI updates in frames
+        :type ui_dispatcher: invesalius.navigation.pipeline.FrameDispatcher
         """
 
         threading.Thread.__init__(self, name='UpdateScene')
@@ -89,63 +135,65 @@ class UpdateNavigationScene(threading.Thread):
         self.sle = sle
         self.event = event
         self.neuronavigation_api = neuronavigation_api
+        self.ui = ui_dispatcher if ui_dispatcher is not None else FrameDispatcher()
+        self.stats = StageStats(self.name)
 
     def run(self):
-        # count = 0
         while not self.event.is_set():
-            got_coords = False
-            object_visible_flag = False
             try:
-                coord, markers_flag, m_img, view_obj = self.coord_queue.get_nowait()
-                got_coords = True
-                object_visible_flag = markers_flag[2]
-
+                # Wakes as soon as there are new co-registered coordinates.
+                (coord, markers_flag, m_img, view_obj), timestamp = self.coord_queue.wait(const.NAVIGATION_WAIT_TIMEOUT)
+            except queue.Empty:
+                continue
+            start = time.perf_counter()
+            object_visible_flag = markers_flag[2]
 
-                # use of CallAfter is mandatory otherwise crashes the wx interface
-                if self.view_tracts:
+            # The GUI is updated by the dispatcher, from the GUI thread, with the latest state when it's free
+            if self.view_tracts:
+                try:
                     bundle, affine_vtk, coord_offset, coord_offset_w = self.tracts_queue.get_nowait()
+                except queue.Empty:
+                    # The tracts of the last coordinates are still being computed.
+                    pass
+                else:
                     #TODO: Check if possible to combine the Remove tracts with Update tracts in a single command
-                    wx.CallAfter(Publisher.sendMessage, 'Remove tracts')
-                    wx.CallAfter(Publisher.sendMessage, 'Update tracts', root=bundle, affine_vtk=affine_vtk,
-                                 coord_offset=coord_offset, coord_offset_w=coord_offset_w)
-                    self.tracts_queue.task_done()
+                    self.ui.update('Remove tracts')
+                    self.ui.update('Update tracts', root=bundle, affine_vtk=affine_vtk,
+                                   coord_offset=coord_offset, coord_offset_w=coord_offset_w)
 
-                if self.serial_port_enabled:
+            if self.serial_port_enabled:
+                try:
                     trigger_on = self.serial_port_queue.get_nowait()
-                    if trigger_on:
-                        wx.CallAfter(Publisher.sendMessage, 'Create marker')
-                    self.serial_port_queue.task_done()
-
-                #TODO: If using the view_tracts substitute the raw coord from the offset coordinate, so the user
-                # see the red cross in the position of the offset marker
-                wx.CallAfter(Publisher.sendMessage, 'Update slices position', position=coord[:3])
-                wx.CallAfter(Publisher.sendMessage, 'Set cross focal point', position=coord)
-                wx.CallAfter(Publisher.sendMessage, 'Sensor ID', markers_flag=markers_flag)
-
-                if self.e_field_loaded and object_visible_flag:
-                    wx.CallAfter(Publisher.sendMessage, 'Update point location for e-field calculation', m_img=m_img,
-                                 coord=coord, queue_IDs=self.e_field_IDs_queue)
-                    if not self.e_field_norms_queue.empty():
-                        try:
-                            enorm = self.e_field_norms_queue.get_nowait()
-                            wx.CallAfter(Publisher.sendMessage, 'Get enorm', enorm=enorm)
-                        finally:
-                            self.e_field_norms_queue.task_done()
-
-                if view_obj:
-                    wx.CallAfter(Publisher.sendMessage, 'Update object matrix', m_img=m_img, coord=coord)
-                    wx.CallAfter(Publisher.sendMessage, 'Update object arrow matrix', m_img=m_img, coord=coord, flag= self.peel_loaded)
-
-                wx.CallAfter(Publisher.sendMessage, 'Render volume viewer')
-                wx.CallAfter(Publisher.sendMessage, 'Update slice viewer')
-                self.coord_queue.task_done()
-                # print('UpdateScene: done {}'.format(count))
-                # count += 1
-            except queue.Empty:
-                if got_coords:
-                    self.coord_queue.task_done()
+                except queue.Empty:
+                    trigger_on = False
+                if trigger_on:
+                    self.ui.post('Create marker')
+
+            #TODO: If using the view_tracts substitute the raw coord from the offset coordinate, so the user
+            # see the red cross in the position of the offset marker
+            self.ui.update('Update slices position', position=coord[:3])
+            self.ui.update('Set cross focal point', position=coord)
+            self.ui.update('Sensor ID', markers_flag=markers_flag)
+
+            if self.e_field_loaded and object_visible_flag:
+                self.ui.update('Update point location for e-field calculation', m_img=m_img,
+                               coord=coord, queue_IDs=self.e_field_IDs_queue)
+                try:
+                    enorm = self.e_field_norms_queue.get_nowait()
+                except queue.Empty:
+                    pass
+                else:
+                    self.ui.update('Get enorm', enorm=enorm)
 
-            sleep(self.sle)
+            if view_obj:
+                self.ui.update('Update object matrix', m_img=m_img, coord=coord)
+                self.ui.update('Update object arrow matrix', m_img=m_img, coord=coord, flag= self.peel_loaded)
+
+            self.ui.update('Render volume viewer')
+            self.ui.update('Update slice viewer')
+            self.ui.flush()
+
+            self.stats.add(start, timestamp)
 
 
 class Navigation(metaclass=Singleton):
@@ -161,16 +209,22 @@ class Navigation(metaclass=Singleton):
         self.obj_data = None
         self.all_fiducials = np.zeros((6, 6))
         self.event = threading.Event()
-        self.coord_queue = QueueCustom(maxsize=1)
-        self.icp_queue = QueueCustom(maxsize=1)
-        self.object_at_target_queue = QueueCustom(maxsize=1)
-        self.efield_queue = QueueCustom(maxsize=1)
-        self.e_field_norms_queue = QueueCustom(maxsize=1)
-        self.e_field_IDs_queue = QueueCustom(maxsize=1)
-        # self.visualization_queue = QueueCustom(maxsize=1)
-        self.serial_port_queue = QueueCustom(maxsize=1)
-        self.coord_tracts_queue = QueueCustom(maxsize=1)
-        self.tracts_queue = QueueCustom(maxsize=1)
+        self.coord_queue = LatestValueChannel('coord')
+        self.icp_queue = LatestValueChannel('icp')
+        self.object_at_target_queue = LatestValueChannel('object_at_target')
+        self.efield_queue = LatestValueChannel('efield')
+        self.e_field_norms_queue = LatestValueChannel('e_field_norms')
+        self.e_field_IDs_queue = LatestValueChannel('e_field_IDs')
+        self.serial_port_queue = LatestValueChannel('serial_port')
+        self.coord_tracts_queue = LatestValueChannel('coord_tracts')
+        self.tracts_queue = LatestValueChannel('tracts')
+
+        self.scheduler = StageScheduler(self.event)
+        for channel in (self.coord_queue, self.icp_queue, self.object_at_target_queue, self.efield_queue,
+                        self.e_field_norms_queue, self.e_field_IDs_queue, self.serial_port_queue,
+                        self.coord_tracts_queue, self.tracts_queue):
+            self.scheduler.add_channel(channel)
+        self.ui_dispatcher = FrameDispatcher()
 
         # Tracker parameters
         self.ref_mode_id = const.DEFAULT_REF_MODE
@@ -200,6 +254,7 @@ class Navigation(metaclass=Singleton):
         # During navigation
         self.lock_to_target = False
         self.coil_at_target = False
+        self.recorder = None
 
         self.LoadState()
 
@@ -210,6 +265,8 @@ class Navigation(metaclass=Singleton):
         Publisher.subscribe(self.UpdateSerialPort, 'Update serial port')
         Publisher.subscribe(self.UpdateObjectRegistration, 'Update object registration')
         Publisher.subscribe(self.TrackObject, 'Track object')
+        Publisher.subscribe(self.StartRecording, 'Start navigation recording')
+        Publisher.subscribe(self.StopRecording, 'Stop navigation recording')
 
     def SaveState(self):
         # XXX: This shouldn't be needed, but task_navigator.py currently calls UpdateObjectRegistration with
@@ -246,6 +303,35 @@ class Navigation(metaclass=Singleton):
     def CoilAtTarget(self, state):
         self.coil_at_target = state
 
+    def GetStageLatencies(self):
+        """
+        Returns the latencies of each navigation stage (see StageStats), of
+        the current navigation or of the last one if it's stopped.
+        """
+        return self.scheduler.get_latencies()
+
+    def __set_stages_recorder(self, recorder):
+        for stage in self.scheduler.stages:
+            if hasattr(stage, 'recorder'):
+                stage.recorder = recorder
+
+    def StartRecording(self, filename):
+        """
+        Starts recording the coordinates of each tracker sample co-registered
+        to filename (see record_coords.NavigationRecorder).
+        """
+        self.StopRecording()
+        self.recorder = rec.NavigationRecorder(filename)
+        self.recorder.start()
+        self.__set_stages_recorder(self.recorder)
+
+    def StopRecording(self):
+        if self.recorder is None:
+            return
+        recorder, self.recorder = self.recorder, None
+        self.__set_stages_recorder(None)
+        recorder.stop()
+
     def UpdateSleep(self, sleep):
         self.sleep_nav = sleep
         # self.serial_port_connection.sleep_nav = sleep
@@ -306,9 +392,9 @@ class Navigation(metaclass=Singleton):
     def StartNavigation(self, tracker, icp):
         # initialize jobs list
         jobs_list = []
-
-        if self.event.is_set():
-            self.event.clear()
+        self.scheduler.clear()
+        # Discards the coordinates read before the navigation, the co-registration waits for new ones.
+        tracker.TrackerCoordinates.channel.clear()
 
         vis_components = [self.serial_port_in_use, self.view_tracts, self.peel_loaded, self.e_field_loaded]
         vis_queues = [self.coord_queue, self.serial_port_queue, self.tracts_queue, self.icp_queue, self.e_field_norms_queue, self.e_field_IDs_queue]
@@ -400,13 +486,15 @@ class Navigation(metaclass=Singleton):
                     event=self.event,
                     sle=self.sleep_nav,
                     neuronavigation_api=self.neuronavigation_api,
+                    ui_dispatcher=self.ui_dispatcher,
                 )
             )
+            self.ui_dispatcher.clear()
 
             for jobs in jobs_list:
-                # jobs.daemon = True
-                jobs.start()
-                # del jobs
+                self.scheduler.add_stage(jobs)
+            self.__set_stages_recorder(self.recorder)
+            self.scheduler.start()
 
             if self.pedal_connection is not None:
                 self.pedal_connection.add_callback(name='navigation', callback=self.PedalStateChanged)
@@ -423,33 +511,10 @@ class Navigation(metaclass=Singleton):
         if self.neuronavigation_api is not None:
             self.neuronavigation_api.remove_pedal_callback(name='navigation')
 
-        self.coord_queue.clear()
-        self.coord_queue.join()
-
-        if self.serial_port_connection is not None:
-            self.serial_port_connection.join()
-
-        if self.serial_port_in_use:
-            self.serial_port_queue.clear()
-            self.serial_port_queue.join()
-
-        if self.view_tracts:
-            self.coord_tracts_queue.clear()
-            self.coord_tracts_queue.join()
-
-            self.tracts_queue.clear()
-            self.tracts_queue.join()
-
-        if self.e_field_loaded:
-            self.efield_queue.clear()
-            self.efield_queue.join()
-
-            self.e_field_norms_queue.clear()
-            self.e_field_norms_queue.join()
-
-            self.e_field_IDs_queue.clear()
-            self.e_field_IDs_queue.join()
-
+        self.scheduler.stop()
+        for name, latency in self.scheduler.get_latencies().items():
+            debug("Navigation stage {}: {}".format(name, latency))
+        debug("Navigation GUI frames: {}".format(self.ui_dispatcher.get_stats()))
 
         vis_components = [self.serial_port_in_use, self.view_tracts,  self.peel_loaded, self.e_field_loaded]
         Publisher.sendMessage("Navigation status", nav_status=False, vis_status=vis_components)
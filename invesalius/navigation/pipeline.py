@@ -0,0 +1,308 @@
+#--------------------------------------------------------------------------
+# Software:     InVesalius - Software de Reconstrucao 3D de Imagens Medicas
+# Copyright:    (C) 2001  Centro de Pesquisas Renato Archer
+# Homepage:     http://www.softwarepublico.gov.br
+# Contact:      invesalius@cti.gov.br
+# License:      GNU - GPL 2 (LICENSE.txt/LICENCA.txt)
+#--------------------------------------------------------------------------
+#    Este programa e software livre; voce pode redistribui-lo e/ou
+#    modifica-lo sob os termos da Licenca Publica Geral GNU, conforme
+#    publicada pela Free Software Foundation; de acordo com a versao 2
+#    da Licenca.
+#
+#    Este programa eh distribuido na expectativa de ser util, mas SEM
+#    QUALQUER GARANTIA; sem mesmo a garantia implicita de
+#    COMERCIALIZACAO ou de ADEQUACAO A QUALQUER PROPOSITO EM
+#    PARTICULAR. Consulte a Licenca Publica Geral GNU para obter mais
+#    detalhes.
+#--------------------------------------------------------------------------
+
+import collections
+import queue
+import threading
+import time
+
+import numpy as np
+
+from invesalius.pubsub import pub as Publisher
+
+# Number of samples kept by StageStats to compute the latency percentiles.
+STATS_SIZE = 1000
+
+# Minimum time, in seconds, between two frames of GUI updates sent by
+# FrameDispatcher, about the display refresh.
+FRAME_INTERVAL = 1.0 / 60.0
+
+
+class LatestValueChannel:
+    """
+    Channel between two navigation stages keeping only the latest value put
+    in it. Putting never blocks, a value not taken yet is replaced (and
+    counted in dropped), so the consumer always gets the most recent
+    coordinate instead of a queue of old ones. Getting blocks on a condition
+    variable until a value is put, so the consumer wakes as soon as there's
+    data instead of polling.
+
+    Each value carries the timestamp (time.perf_counter) of the tracker
+    sample it comes from, so the stages can measure the latency since the
+    sample was read. It's meant to have one consumer.
+
+    It has the methods of queue.Queue used by the navigation threads, get
+    raises queue.Empty on timeout and when the channel is closed.
+    """
+
+    _empty = object()
+
+    def __init__(self, name=None):
+        self.name = name
+        self._cond = threading.Condition()
+        self._value = self._empty
+        self._timestamp = None
+        self._closed = False
+        self.received = 0
+        self.dropped = 0
+
+    def put(self, item, block=True, timeout=None, timestamp=None):
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        with self._cond:
+            if self._value is not self._empty:
+                self.dropped += 1
+            self._value = item
+            self._timestamp = timestamp
+            self.received += 1
+            self._cond.notify_all()
+
+    def put_nowait(self, item, timestamp=None):
+        self.put(item, timestamp=timestamp)
+
+    def wait(self, timeout=None):
+        """
+        Returns the latest value and its timestamp, waiting up to timeout
+        seconds (forever if None) for it. Raises queue.Empty if there's no
+        value after timeout or if the channel is closed.
+        """
+        with self._cond:
+            if not self._cond.wait_for(
+                lambda: self._value is not self._empty or self._closed, timeout
+            ):
+                raise queue.Empty
+            if self._value is self._empty:
+                raise queue.Empty
+            item, timestamp = self._value, self._timestamp
+            self._value = self._empty
+            self._timestamp = None
+            self._cond.notify_all()
+            return item, timestamp
+
+    def wait_empty(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for the value put to be
+        taken by the consumer, so a producer can put values without dropping
+        any. Returns False on timeout.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._value is self._empty or self._closed, timeout)
+
+    def get(self, block=True, timeout=None):
+        if not block:
+            timeout = 0
+        return self.wait(timeout)[0]
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def empty(self):
+        with self._cond:
+            return self._value is self._empty
+
+    def clear(self):
+        with self._cond:
+            self._value = self._empty
+            self._timestamp = None
+            self._cond.notify_all()
+
+    def open(self):
+        with self._cond:
+            self._closed = False
+            self._value = self._empty
+            self._timestamp = None
+            self.received = 0
+            self.dropped = 0
+
+    def close(self):
+        """
+        Wakes the consumer waiting for a value, the next gets raise
+        queue.Empty until it's opened again.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    # Kept so the channel can be used where a queue.Queue was, there are no
+    # tasks to wait for.
+    def task_done(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class StageStats:
+    """
+    Latencies of a navigation stage. For each value processed it keeps the
+    time the stage took processing it and the latency since the tracker
+    sample it comes from was read, the latter is the age of the value when
+    the stage outputs it.
+    """
+
+    def __init__(self, name, size=STATS_SIZE):
+        self.name = name
+        self._lock = threading.Lock()
+        self._durations = collections.deque(maxlen=size)
+        self._latencies = collections.deque(maxlen=size)
+        self.count = 0
+
+    def add(self, start, timestamp=None):
+        """
+        Adds a value whose processing started at start (time.perf_counter)
+        and which comes from a sample read at timestamp.
+        """
+        now = time.perf_counter()
+        with self._lock:
+            self._durations.append(now - start)
+            if timestamp is not None:
+                self._latencies.append(now - timestamp)
+            self.count += 1
+
+    def clear(self):
+        with self._lock:
+            self._durations.clear()
+            self._latencies.clear()
+            self.count = 0
+
+    def summary(self):
+        """
+        Returns a dict with the number of values processed and the mean, p50
+        and p99 of the durations and latencies, in milliseconds, of the last
+        ones.
+        """
+        with self._lock:
+            durations = np.array(self._durations) * 1000.0
+            latencies = np.array(self._latencies) * 1000.0
+            summary = {'count': self.count}
+        for key, values in (('duration', durations), ('latency', latencies)):
+            if len(values):
+                summary[key + '_mean'] = float(values.mean())
+                summary[key + '_p50'] = float(np.percentile(values, 50))
+                summary[key + '_p99'] = float(np.percentile(values, 99))
+        return summary
+
+
+class FrameDispatcher:
+    """
+    Sends the pubsub messages updating the GUI during the navigation
+    coalesced in frames, instead of one wx.CallAfter for each message of
+    each coordinate. The navigation threads set the messages of a frame and
+    flush it, only one frame is waiting in the GUI event queue at a time:
+
+    - update(topic, ...) sets the latest state of a message (positions,
+      matrices, renders), a state not sent yet is replaced, so only the
+      latest pose is rendered;
+    - post(topic, ...) adds an event (like creating a marker), which is
+      never dropped.
+
+    When the GUI is busy the frames flushed while one is waiting are merged
+    into it and counted as dropped, so the rate of renders follows what the
+    GUI can do instead of queueing old poses. The frames are sent at most
+    once every min_interval seconds.
+
+    call_after and call_later are wx.CallAfter and wx.CallLater by default,
+    and send is Publisher.sendMessage.
+    """
+
+    def __init__(self, call_after=None, call_later=None, send=None, min_interval=FRAME_INTERVAL):
+        if call_after is None or call_later is None:
+            import wx
+            call_after = call_after or wx.CallAfter
+            call_later = call_later or wx.CallLater
+        self.call_after = call_after
+        self.call_later = call_later
+        self.send = send or Publisher.sendMessage
+        self.min_interval = min_interval
+
+        self._lock = threading.Lock()
+        self._events = []
+        self._states = collections.OrderedDict()
+        self._scheduled = False
+        self._last_frame = 0.0
+
+        self.flushed = 0
+        self.dispatched = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def update(self, topic, **kwargs):
+        with self._lock:
+            if topic in self._states:
+                self.coalesced += 1
+                # The messages are sent in the order they were last updated.
+                self._states.move_to_end(topic)
+            self._states[topic] = kwargs
+
+    def post(self, topic, **kwargs):
+        with self._lock:
+            self._events.append((topic, kwargs))
+
+    def flush(self):
+        """
+        Ends the frame of the messages set, it's sent with the next frame
+        dispatched in the GUI thread.
+        """
+        with self._lock:
+            self.flushed += 1
+            if self._scheduled:
+                self.dropped += 1
+                return
+            self._scheduled = True
+        self.call_after(self._dispatch)
+
+    def _dispatch(self):
+        # Runs in the GUI thread.
+        wait = self._last_frame + self.min_interval - time.perf_counter()
+        if wait > 0:
+            self.call_later(int(wait * 1000) + 1, self._dispatch)
+            return
+
+        with self._lock:
+            events, self._events = self._events, []
+            states, self._states = self._states, collections.OrderedDict()
+            self._scheduled = False
+            self.dispatched += 1
+        self._last_frame = time.perf_counter()
+
+        for topic, kwargs in events:
+            self.send(topic, **kwargs)
+        for topic, kwargs in states.items():
+            self.send(topic, **kwargs)
+
+    def clear(self):
+        """
+        Discards the messages not sent and resets the counters.
+        """
+        with self._lock:
+            self._events = []
+            self._states = collections.OrderedDict()
+            self.flushed = 0
+            self.dispatched = 0
+            self.dropped = 0
+            self.coalesced = 0
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'flushed': self.flushed,
+                'dispatched': self.dispatched,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+            }
@@ -140,10 +140,11 @@ class Parser:
     # def GetImageData(self):
     #    return None#self.vtkgdcm_reader.GetOutput()
 
-    def SetDataImage(self, data_image, filename, thumbnail_path):
+    def SetDataImage(self, data_image, filename, thumbnail_path, indexed=False):
         self.data_image = data_image
         self.filename = self.filepath = filename
         self.thumbnail_path = thumbnail_path
+        self.indexed = indexed
 
     def __format_time(self, value):
         sp1 = value.split(".")
@@ -1908,9 +1909,34 @@ class Acquisition(object):
 
 
 class Image(object):
+    # Set as the thumbnail path when it was not possible to create the
+    # thumbnail, so the file is not decoded again.
+    _NO_THUMBNAIL = ""
+
     def __init__(self):
         pass
 
+    @property
+    def thumbnail_path(self):
+        # Files scanned in header only mode don't have thumbnails yet, they
+        # are created the first time they are requested.
+        if self._thumbnail_path is None:
+            import invesalius.reader.dicom_reader as dicom_reader
+
+            thumbnail_path = dicom_reader.CreateDicomThumbnails(
+                self.file, self._data_image, self._indexed
+            )
+            if thumbnail_path is None:
+                thumbnail_path = self._NO_THUMBNAIL
+            self._thumbnail_path = thumbnail_path
+        if self._thumbnail_path == self._NO_THUMBNAIL:
+            return None
+        return self._thumbnail_path
+
+    @thumbnail_path.setter
+    def thumbnail_path(self, value):
+        self._thumbnail_path = value
+
     def SetParser(self, parser):
         self.level = parser.GetImageWindowLevel()
         self.window = parser.GetImageWindowWidth()
@@ -1928,7 +1954,9 @@ class Image(object):
         self.size = (parser.GetDimensionX(), parser.GetDimensionY())
         # self.imagedata = parser.GetImageData()
         self.bits_allocad = parser._GetBitsAllocated()
-        self.thumbnail_path = parser.thumbnail_path
+        self._thumbnail_path = parser.thumbnail_path
+        self._data_image = parser.data_image
+        self._indexed = parser.indexed
 
         self.number_of_frames = parser.GetNumberOfFrames()
         self.samples_per_pixel = parser.GetImageSamplesPerPixel()
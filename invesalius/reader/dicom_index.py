@@ -0,0 +1,169 @@
+# --------------------------------------------------------------------------
+# Software:     InVesalius - Software de Reconstrucao 3D de Imagens Medicas
+# Copyright:    (C) 2001  Centro de Pesquisas Renato Archer
+# Homepage:     http://www.softwarepublico.gov.br
+# Contact:      invesalius@cti.gov.br
+# License:      GNU - GPL 2 (LICENSE.txt/LICENCA.txt)
+# --------------------------------------------------------------------------
+#    Este programa e software livre; voce pode redistribui-lo e/ou
+#    modifica-lo sob os termos da Licenca Publica Geral GNU, conforme
+#    publicada pela Free Software Foundation; de acordo com a versao 2
+#    da Licenca.
+#
+#    Este programa eh distribuido na expectativa de ser util, mas SEM
+#    QUALQUER GARANTIA; sem mesmo a garantia implicita de
+#    COMERCIALIZACAO ou de ADEQUACAO A QUALQUER PROPOSITO EM
+#    PARTICULAR. Consulte a Licenca Publica Geral GNU para obter mais
+#    detalhes.
+# --------------------------------------------------------------------------
+import json
+import os
+import sqlite3
+import threading
+
+from invesalius import inv_paths
+from invesalius.utils import Singleton, debug
+
+# Increase it when the content of data_dict created by LoadDicom changes,
+# the entries created by older versions are then discarded.
+INDEX_VERSION = 1
+
+
+class DicomIndex(metaclass=Singleton):
+    """
+    Persistent index of the DICOM files already parsed by LoadDicom. Each
+    entry keeps the parsed data_dict (which includes the orientation label)
+    and the thumbnail path of the file, and is valid while the file path,
+    modification time and size are the same. Files that are not DICOM are
+    also stored (with data_dict None) so they are not parsed again.
+
+    It's used from the scan worker threads, all the access to the database
+    is serialized by a lock.
+    """
+
+    def __init__(self):
+        self.filename = str(inv_paths.USER_DICOM_INDEX)
+        self._lock = threading.Lock()
+        self._conn = None
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            self._conn = sqlite3.connect(self.filename, check_same_thread=False)
+            self._create_tables()
+        except sqlite3.Error as err:
+            debug("Not possible to open the DICOM index %s: %s" % (self.filename, err))
+            self._conn = None
+
+    def _create_tables(self):
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    mtime INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    version INTEGER NOT NULL,
+                    data_dict TEXT,
+                    thumbnail_path TEXT
+                )"""
+            )
+
+    @staticmethod
+    def get_file_key(filepath):
+        """
+        Returns the (mtime, size) of the given file or None if it's not
+        possible to stat it.
+        """
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, filepath, key):
+        """
+        Returns (data_dict, thumbnail_path) of the file if it's in the index
+        and it was not changed since then, otherwise None. thumbnail_path is
+        None if the thumbnail file doesn't exist anymore. The entry of a
+        file changed (or removed) since it was indexed is deleted.
+        """
+        if self._conn is None:
+            return None
+        try:
+            with self._lock:
+                if key is None:
+                    row = None
+                else:
+                    mtime, size = key
+                    row = self._conn.execute(
+                        "SELECT data_dict, thumbnail_path FROM files "
+                        "WHERE path=? AND mtime=? AND size=? AND version=?",
+                        (filepath, mtime, size, INDEX_VERSION),
+                    ).fetchone()
+                if row is None:
+                    self._conn.execute("DELETE FROM files WHERE path=?", (filepath,))
+        except sqlite3.Error as err:
+            debug("Error reading the DICOM index: %s" % err)
+            return None
+
+        if row is None:
+            return None
+
+        data_dict = json.loads(row[0]) if row[0] is not None else None
+        thumbnail_path = json.loads(row[1]) if row[1] is not None else None
+        if isinstance(thumbnail_path, list):
+            if not all(os.path.exists(i) for i in thumbnail_path):
+                thumbnail_path = None
+        elif thumbnail_path is not None and not os.path.exists(thumbnail_path):
+            thumbnail_path = None
+        return data_dict, thumbnail_path
+
+    def set(self, filepath, key, data_dict, thumbnail_path=None):
+        """
+        Adds or replaces the entry of the given file. The changes are only
+        written to disk when commit is called.
+        """
+        if self._conn is None or key is None:
+            return
+        mtime, size = key
+        if data_dict is not None:
+            data_dict = json.dumps(data_dict)
+        if thumbnail_path is not None:
+            thumbnail_path = json.dumps(thumbnail_path)
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO files "
+                    "(path, mtime, size, version, data_dict, thumbnail_path) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (filepath, mtime, size, INDEX_VERSION, data_dict, thumbnail_path),
+                )
+        except sqlite3.Error as err:
+            debug("Error writing the DICOM index: %s" % err)
+
+    def set_thumbnail_path(self, filepath, thumbnail_path):
+        if self._conn is None:
+            return
+        try:
+            with self._lock:
+                with self._conn:
+                    self._conn.execute(
+                        "UPDATE files SET thumbnail_path=? WHERE path=?",
+                        (json.dumps(thumbnail_path), filepath),
+                    )
+        except sqlite3.Error as err:
+            debug("Error writing the DICOM index: %s" % err)
+
+    def commit(self):
+        if self._conn is None:
+            return
+        try:
+            with self._lock:
+                self._conn.commit()
+        except sqlite3.Error as err:
+            debug("Error writing the DICOM index: %s" % err)
+
+    def clear(self):
+        if self._conn is None:
+            return
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM files")
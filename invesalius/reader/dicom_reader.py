@@ -16,10 +16,13 @@
 #    PARTICULAR. Consulte a Licenca Publica Geral GNU para obter mais
 #    detalhes.
 # --------------------------------------------------------------------------
+import functools
 import os
 import sys
 import tempfile
 import threading
+from collections import deque
+from concurrent import futures
 from multiprocessing import cpu_count
 
 import gdcm
@@ -39,6 +42,7 @@ from vtkmodules.vtkCommonCore import vtkFileOutputWindow, vtkOutputWindow
 import invesalius.constants as const
 import invesalius.reader.dicom as dicom
 import invesalius.reader.dicom_grouper as dicom_grouper
+import invesalius.reader.dicom_index as dicom_index
 import invesalius.session as ses
 import invesalius.utils as utils
 from invesalius import inv_paths
@@ -103,35 +107,139 @@ def SortFiles(filelist, dicom):
     return filelist
 
 
-tag_labels = {}
-main_dict = {}
-dict_file = {}
+# Reading stops at this tag when scanning only the headers.
+PIXEL_DATA_TAG = gdcm.Tag(0x7FE0, 0x0010)
+
+
+def _set_reader_filename(reader, filepath):
+    if _has_win32api:
+        try:
+            reader.SetFileName(
+                utils.encode(win32api.GetShortPathName(filepath), const.FS_ENCODE)
+            )
+        except TypeError:
+            reader.SetFileName(win32api.GetShortPathName(filepath))
+    else:
+        try:
+            reader.SetFileName(utils.encode(filepath, const.FS_ENCODE))
+        except TypeError:
+            reader.SetFileName(filepath)
+
+
+def _get_thumbnail_window_level(data_dict):
+    try:
+        data = data_dict[str(0x028)][str(0x1050)]
+        level = [float(value) for value in data.split("\\")][0]
+        data = data_dict[str(0x028)][str(0x1051)]
+        window = [float(value) for value in data.split("\\")][0]
+    except (KeyError, ValueError):
+        level = None
+        window = None
+    return window, level
+
+
+def CreateDicomThumbnails(filepath, data_dict, indexed=False):
+    """
+    Decodes the pixel data of the given DICOM file and creates its
+    thumbnail (or a list of thumbnails if it's a multiframe image). Used to
+    create the thumbnails lazily from files scanned in header only mode.
+    If indexed is True the file was scanned using the DicomIndex and its
+    entry is updated with the thumbnail path.
+    """
+    reader = gdcm.ImageReader()
+    _set_reader_filename(reader, filepath)
+    if not reader.Read():
+        return None
+    window, level = _get_thumbnail_window_level(data_dict)
+    thumbnail_path = imagedata_utils.create_dicom_thumbnails(
+        reader.GetImage(), window, level
+    )
+    if indexed:
+        dicom_index.DicomIndex().set_thumbnail_path(
+            utils.decode(filepath, const.FS_ENCODE), thumbnail_path
+        )
+    return thumbnail_path
 
 
 class LoadDicom:
-    def __init__(self, grouper, filepath):
+    def __init__(self, grouper, filepath, header_only=False, index=None):
         self.grouper = grouper
         self.filepath = utils.decode(filepath, const.FS_ENCODE)
+        self.header_only = header_only
+        self.index = index
+        self.dcm = None
         self.run()
 
+    def _read(self):
+        if self.header_only:
+            # Only the tags are needed to group the files, so the reading
+            # stops before the pixel data.
+            reader = gdcm.Reader()
+            _set_reader_filename(reader, self.filepath)
+            if not reader.ReadUpToTag(PIXEL_DATA_TAG):
+                return None
+            ds = reader.GetFile().GetDataSet()
+            # gdcm.ImageReader refuses files without image, here we
+            # check at least the image dimensions are there.
+            if not (
+                ds.FindDataElement(gdcm.Tag(0x0028, 0x0010))
+                and ds.FindDataElement(gdcm.Tag(0x0028, 0x0011))
+            ):
+                return None
+        else:
+            reader = gdcm.ImageReader()
+            _set_reader_filename(reader, self.filepath)
+            if not reader.Read():
+                return None
+        return reader
+
     def run(self):
-        grouper = self.grouper
-        reader = gdcm.ImageReader()
-        if _has_win32api:
-            try:
-                reader.SetFileName(
-                    utils.encode(
-                        win32api.GetShortPathName(self.filepath), const.FS_ENCODE
-                    )
-                )
-            except TypeError:
-                reader.SetFileName(win32api.GetShortPathName(self.filepath))
+        if self.index is None:
+            data_dict, thumbnail_path = self._parse()
         else:
-            try:
-                reader.SetFileName(utils.encode(self.filepath, const.FS_ENCODE))
-            except TypeError:
-                reader.SetFileName(self.filepath)
-        if reader.Read():
+            # Files not changed since the last scan are not parsed again.
+            key = self.index.get_file_key(self.filepath)
+            cached = self.index.get(self.filepath, key)
+            if cached is None:
+                data_dict, thumbnail_path = self._parse()
+                self.index.set(self.filepath, key, data_dict, thumbnail_path)
+            else:
+                data_dict, thumbnail_path = cached
+
+        if data_dict is None:
+            return
+
+        # ----------  Verify is DICOMDir -------------------------------
+        is_dicom_dir = 1
+        try:
+            if (
+                data_dict[str(0x002)][str(0x002)] != "1.2.840.10008.1.3.10"
+            ):  # DICOMDIR
+                is_dicom_dir = 0
+        except (KeyError):
+            is_dicom_dir = 0
+
+        if not (is_dicom_dir):
+            parser = dicom.Parser()
+            parser.SetDataImage(
+                data_dict, self.filepath, thumbnail_path, self.index is not None
+            )
+
+            dcm = dicom.Dicom()
+            dcm.SetParser(parser)
+            self.dcm = dcm
+            # grouper is None when running inside a scan worker, the
+            # scanner adds the file to the grouper itself.
+            if self.grouper is not None:
+                self.grouper.AddFile(dcm)
+
+    def _parse(self):
+        """
+        Returns the data_dict and thumbnail path of the file, or (None,
+        None) if it's not a DICOM image.
+        """
+        reader = self._read()
+        if reader is not None:
             file = reader.GetFile()
             # Retrieve data set
             dataSet = file.GetDataSet()
@@ -171,13 +279,10 @@ class LoadDicom:
                 if not dataElement.IsUndefinedLength():
                     tag = dataElement.GetTag()
                     data = stf.ToStringPair(tag)
-                    stag = tag.PrintAsPipeSeparatedString()
 
                     group = str(tag.GetGroup())
                     field = str(tag.GetElement())
 
-                    tag_labels[stag] = data[0]
-
                     if not group in data_dict.keys():
                         data_dict[group] = {}
 
@@ -196,13 +301,10 @@ class LoadDicom:
                     #  or (tag.GetGroup() == 0x0043 and tag.GetElement() == 0x1027):
                     #  continue
                     data = stf.ToStringPair(tag)
-                    stag = tag.PrintAsPipeSeparatedString()
 
                     group = str(tag.GetGroup())
                     field = str(tag.GetElement())
 
-                    tag_labels[stag] = data[0]
-
                     if not group in data_dict.keys():
                         data_dict[group] = {}
 
@@ -215,21 +317,20 @@ class LoadDicom:
 
             # -------------- To Create DICOM Thumbnail -----------
 
-            try:
-                data = data_dict[str(0x028)][str(0x1050)]
-                level = [float(value) for value in data.split("\\")][0]
-                data = data_dict[str(0x028)][str(0x1051)]
-                window = [float(value) for value in data.split("\\")][0]
-            except (KeyError, ValueError):
-                level = None
-                window = None
-
-            img = reader.GetImage()
-            thumbnail_path = imagedata_utils.create_dicom_thumbnails(img, window, level)
+            if self.header_only:
+                # Created when the series is shown (dicom.Image.thumbnail_path)
+                thumbnail_path = None
+                direc_cosines = image_helper.GetDirectionCosinesValue(file)
+            else:
+                window, level = _get_thumbnail_window_level(data_dict)
+                img = reader.GetImage()
+                thumbnail_path = imagedata_utils.create_dicom_thumbnails(
+                    img, window, level
+                )
+                direc_cosines = img.GetDirectionCosines()
 
             # ------ Verify the orientation --------------------------------
 
-            direc_cosines = img.GetDirectionCosines()
             orientation = gdcm.Orientation()
             try:
                 _type = orientation.GetType(tuple(direc_cosines))
@@ -240,87 +341,95 @@ class LoadDicom:
             # ----------   Refactory --------------------------------------
             data_dict["invesalius"] = {"orientation_label": label}
 
-            # -------------------------------------------------------------
-            dict_file[self.filepath] = data_dict
-
-            # ----------  Verify is DICOMDir -------------------------------
-            is_dicom_dir = 1
-            try:
-                if (
-                    data_dict[str(0x002)][str(0x002)] != "1.2.840.10008.1.3.10"
-                ):  # DICOMDIR
-                    is_dicom_dir = 0
-            except (KeyError):
-                is_dicom_dir = 0
-
-            if not (is_dicom_dir):
-                parser = dicom.Parser()
-                parser.SetDataImage(
-                    dict_file[self.filepath], self.filepath, thumbnail_path
-                )
-
-                dcm = dicom.Dicom()
-                # self.l.acquire()
-                dcm.SetParser(parser)
-                grouper.AddFile(dcm)
+            return data_dict, thumbnail_path
 
-                # self.l.release()
+        return None, None
 
-        # ==========  used in test =======================================
-        # print dict_file
-        # main_dict = dict(
-        #                data  = dict_file,
-        #                labels  = tag_labels)
-        # print main_dict
-        # print "\n"
-        # plistlib.writePlist(main_dict, ".//teste.plist")
 
-
-def yGetDicomGroups(directory, recursive=True, gui=True):
+def _load_dicom(filepath, header_only=True, index=None):
     """
-    Return all full paths to DICOM files inside given directory.
+    Parses the given file and returns a dicom.Dicom or None if it is not a
+    valid DICOM image. Runs inside the scan worker threads.
     """
-    nfiles = 0
-    # Find total number of files
+    return LoadDicom(None, filepath, header_only, index).dcm
+
+
+def _get_dicom_filepaths(directory, recursive=True):
     if recursive:
+        filepaths = []
         for dirpath, dirnames, filenames in os.walk(directory):
-            nfiles += len(filenames)
+            for name in filenames:
+                filepaths.append(os.path.join(dirpath, name))
+        return filepaths
     else:
-        dirpath, dirnames, filenames = os.walk(directory)
-        nfiles = len(filenames)
+        try:
+            dirpath, dirnames, filenames = next(os.walk(directory))
+        except StopIteration:
+            return []
+        return [str(os.path.join(dirpath, name)) for name in filenames]
+
+
+def yGetDicomGroups(
+    directory,
+    recursive=True,
+    gui=True,
+    nworkers=None,
+    header_only=True,
+    use_index=True,
+):
+    """
+    Return all full paths to DICOM files inside given directory.
+
+    The files are parsed by a pool of worker threads, while the results are
+    added to the grouper in the same order the files were found, so the
+    grouping is the same as a serial scan. Most of the time is spent
+    reading the files (often from network storage) and inside gdcm, so
+    the threads overlap well.
+
+    If header_only is True the pixel data is not read while scanning and
+    the thumbnails are only created when the series is shown.
+
+    If use_index is True the files already parsed in previous scans, and
+    not changed since then, are taken from the DicomIndex.
+    """
+    filepaths = _get_dicom_filepaths(directory, recursive)
+    nfiles = len(filepaths)
+    if nworkers is None:
+        nworkers = min(32, cpu_count() + 4)
+
+    index = dicom_index.DicomIndex() if use_index else None
+    load = functools.partial(_load_dicom, header_only=header_only, index=index)
 
     counter = 0
     grouper = dicom_grouper.DicomPatientGrouper()
-    # q = Queue.Queue()
-    # l = threading.Lock()
-    # threads = []
-    # for i in xrange(cpu_count()):
-    #    t = LoadDicom(grouper, q, l)
-    #    t.start()
-    #    threads.append(t)
-    # Retrieve only DICOM files, splited into groups
-    if recursive:
-        for dirpath, dirnames, filenames in os.walk(directory):
-            for name in filenames:
-                filepath = os.path.join(dirpath, name)
+    # Only a bounded number of files are in flight, so a cancelled scan
+    # doesn't have to wait for the whole directory to be parsed.
+    max_pending = 2 * nworkers
+    pending = deque()
+    files_iter = iter(filepaths)
+    with futures.ThreadPoolExecutor(max_workers=nworkers) as executor:
+        try:
+            for filepath in files_iter:
+                pending.append(executor.submit(load, filepath))
+                if len(pending) >= max_pending:
+                    break
+
+            while pending:
+                future = pending.popleft()
+                filepath = next(files_iter, None)
+                if filepath is not None:
+                    pending.append(executor.submit(load, filepath))
                 counter += 1
                 if gui:
                     yield (counter, nfiles)
-                LoadDicom(grouper, filepath)
-    else:
-        dirpath, dirnames, filenames = os.walk(directory)
-        for name in filenames:
-            filepath = str(os.path.join(dirpath, name))
-            counter += 1
-            if gui:
-                yield (counter, nfiles)
-            # q.put(filepath)
-
-    # for t in threads:
-    #    q.put(0)
-
-    # for t in threads:
-    #    t.join()
+                dcm = future.result()
+                if dcm is not None:
+                    grouper.AddFile(dcm)
+        finally:
+            for future in pending:
+                future.cancel()
+            if index is not None:
+                index.commit()
 
     # TODO: Is this commented update necessary?
     # grouper.Update()
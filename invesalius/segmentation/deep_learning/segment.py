@@ -1,9 +1,12 @@
+import importlib.util
 import itertools
 import multiprocessing
 import os
 import pathlib
+import queue
 import sys
 import tempfile
+import threading
 import traceback
 
 import numpy as np
@@ -18,64 +21,186 @@ from invesalius.utils import new_name_by_pattern
 from . import utils
 
 SIZE = 48
-
-
-def gen_patches(image, patch_size, overlap):
+# Number of patches given at once to the model.
+BATCH_SIZE = 4
+# How the predictions of overlapping patches are blended, "gaussian" or
+# "constant" (the mean).
+BLENDING = "gaussian"
+# Standard deviation of the gaussian importance map, relative to the patch
+# size.
+GAUSSIAN_SIGMA_SCALE = 1.0 / 8.0
+# Patches whose normalized values (0 to 1) are all below it are taken as
+# background and not predicted.
+BACKGROUND_THRESHOLD = 0.01
+# Opset of the ONNX models exported from the pytorch weights. It's part of the
+# name of the cached model, so changing it exports them again.
+ONNX_OPSET = 13
+
+
+def get_patch_step(patch_size, overlap):
     overlap = int(patch_size * overlap / 100)
-    print(f"{overlap=}")
+    return patch_size - overlap
+
+
+def get_importance_map(patch_size, blending=BLENDING):
+    """
+    Returns the weight, along one axis, of the predictions of a patch. With
+    "gaussian" the voxels near the center of the patch weigh more than the
+    ones near its borders, which the model sees with less context. The
+    weight of the patch is the product of the ones of its axes.
+    """
+    if blending == "gaussian":
+        center = (patch_size - 1) / 2.0
+        sigma = patch_size * GAUSSIAN_SIGMA_SCALE
+        weights = np.exp(-0.5 * ((np.arange(patch_size) - center) / sigma) ** 2)
+        weights /= weights.max()
+        # The borders still count, so no voxel is left without weight.
+        return np.maximum(weights, 1e-3).astype(np.float32)
+    return np.ones(patch_size, dtype=np.float32)
+
+
+def get_overlap_weight(size, patch_size, step, importance):
+    """
+    Returns, for each position of an axis of the given size, the sum of the
+    importance of the patches (starting at 0, step, 2 * step, ...) covering
+    it.
+    """
+    weight = np.zeros(size, dtype=np.float32)
+    for start in range(0, size, step):
+        end = min(start + patch_size, size)
+        weight[start:end] += importance[0 : end - start]
+    return weight
+
+
+def gen_patches(image, patch_size, step, batch_size=BATCH_SIZE, background=None):
+    """
+    Yields (completion, batch, patches), batch is a float32 array with up to
+    batch_size patches of image, zero padded to patch_size, and patches
+    their position in image ((iz, ez), (iy, ey), (ix, ex)). If background is
+    given the patches whose values are all <= background are skipped.
+    """
     sz, sy, sx = image.shape
     i_cuts = list(
         itertools.product(
-            range(0, sz, patch_size - overlap),
-            range(0, sy, patch_size - overlap),
-            range(0, sx, patch_size - overlap),
+            range(0, sz, step),
+            range(0, sy, step),
+            range(0, sx, step),
         )
     )
-    sub_image = np.empty(shape=(patch_size, patch_size, patch_size), dtype="float32")
+    batch = np.zeros(
+        shape=(batch_size, patch_size, patch_size, patch_size), dtype="float32"
+    )
+    patches = []
     for idx, (iz, iy, ix) in enumerate(i_cuts):
-        sub_image[:] = 0
         _sub_image = image[
             iz : iz + patch_size, iy : iy + patch_size, ix : ix + patch_size
         ]
-        sz, sy, sx = _sub_image.shape
-        sub_image[0:sz, 0:sy, 0:sx] = _sub_image
-        ez = iz + sz
-        ey = iy + sy
-        ex = ix + sx
-
-        yield (idx + 1.0) / len(i_cuts), sub_image, ((iz, ez), (iy, ey), (ix, ex))
-
-
-def predict_patch(sub_image, patch, nn_model, patch_size):
-    (iz, ez), (iy, ey), (ix, ex) = patch
-    sub_mask = nn_model.predict(
-        sub_image.reshape(1, patch_size, patch_size, patch_size, 1)
+        if background is None or _sub_image.max() > background:
+            sub_image = batch[len(patches)]
+            sz, sy, sx = _sub_image.shape
+            sub_image[0:sz, 0:sy, 0:sx] = _sub_image
+            patches.append(((iz, iz + sz), (iy, iy + sy), (ix, ix + sx)))
+
+        if len(patches) == batch_size or (idx == len(i_cuts) - 1 and patches):
+            yield (idx + 1.0) / len(i_cuts), batch[: len(patches)], patches
+            batch = np.zeros_like(batch)
+            patches = []
+
+
+def gen_in_thread(generator, size=2):
+    """
+    Consumes generator in a thread, keeping up to size items ready, so the
+    next items are prepared while the current one is used.
+    """
+    items = queue.Queue(size)
+    end = object()
+    error = []
+
+    def _produce():
+        try:
+            for item in generator:
+                items.put(item)
+        except Exception as err:
+            error.append(err)
+        finally:
+            items.put(end)
+
+    thread = threading.Thread(target=_produce, daemon=True)
+    thread.start()
+    while True:
+        item = items.get()
+        if item is end:
+            break
+        yield item
+    thread.join()
+    if error:
+        raise error[0]
+
+
+def segment_patches(
+    image,
+    predict,
+    overlap,
+    probability_array,
+    comm_array,
+    patch_size,
+    batch_size,
+    stride=None,
+    blending=BLENDING,
+    background=BACKGROUND_THRESHOLD,
+):
+    """
+    Segments image by a sliding window of patches, predict receives a batch
+    of patches and returns their probabilities. The patches are taken every
+    stride voxels (given by overlap if stride is None) and the overlapping
+    predictions are blended by the weights given by get_importance_map. The
+    patches of background (see gen_patches) are not predicted, their
+    probability is 0.
+    """
+    step = stride or get_patch_step(patch_size, overlap)
+    importance = get_importance_map(patch_size, blending)
+    importance_patch = (
+        importance[:, np.newaxis, np.newaxis]
+        * importance[np.newaxis, :, np.newaxis]
+        * importance[np.newaxis, np.newaxis, :]
     )
-    return sub_mask.reshape(patch_size, patch_size, patch_size)[
-        0 : ez - iz, 0 : ey - iy, 0 : ex - ix
-    ]
-
 
-def predict_patch_torch(sub_image, patch, nn_model, device, patch_size):
-    import torch
+    for completion, batch, patches in gen_in_thread(
+        gen_patches(image, patch_size, step, batch_size, background)
+    ):
+        sub_masks = predict(batch).reshape(-1, patch_size, patch_size, patch_size)
+        for sub_mask, patch in zip(sub_masks, patches):
+            (iz, ez), (iy, ey), (ix, ex) = patch
+            sub_mask *= importance_patch
+            probability_array[iz:ez, iy:ey, ix:ex] += sub_mask[
+                0 : ez - iz, 0 : ey - iy, 0 : ex - ix
+            ]
+        comm_array[0] = completion
 
-    with torch.no_grad():
-        (iz, ez), (iy, ey), (ix, ex) = patch
-        sub_mask = (
-            nn_model(
-                torch.from_numpy(
-                    sub_image.reshape(1, 1, patch_size, patch_size, patch_size)
-                ).to(device)
-            )
-            .cpu()
-            .numpy()
-        )
-        return sub_mask.reshape(patch_size, patch_size, patch_size)[
-            0 : ez - iz, 0 : ey - iy, 0 : ex - ix
-        ]
+    # The weight of the patches is the product of the ones of each axis, so
+    # the sum of the weights of the patches covering each voxel is the
+    # product of the ones covering each of its coordinates.
+    weight_z, weight_y, weight_x = (
+        get_overlap_weight(size, patch_size, step, importance) for size in image.shape
+    )
+    weight_yx = np.outer(weight_y, weight_x)
+    for z in range(image.shape[0]):
+        probability_array[z] /= weight_z[z] * weight_yx
+    comm_array[0] = np.Inf
 
 
-def segment_keras(image, weights_file, overlap, probability_array, comm_array, patch_size):
+def segment_keras(
+    image,
+    weights_file,
+    overlap,
+    probability_array,
+    comm_array,
+    patch_size,
+    batch_size=BATCH_SIZE,
+    stride=None,
+    blending=BLENDING,
+    background=BACKGROUND_THRESHOLD,
+):
     import keras
 
     # Loading model
@@ -84,18 +209,22 @@ def segment_keras(image, weights_file, overlap, probability_array, comm_array, p
     model.load_weights(str(weights_file.parent.joinpath("model.h5")))
     model.compile("Adam", "binary_crossentropy")
 
-    image = imagedata_utils.image_normalize(image, 0.0, 1.0, output_dtype=np.float32)
-    sums = np.zeros_like(image)
-    # segmenting by patches
-    for completion, sub_image, patch in gen_patches(image, patch_size, overlap):
-        comm_array[0] = completion
-        (iz, ez), (iy, ey), (ix, ex) = patch
-        sub_mask = predict_patch(sub_image, patch, model, patch_size)
-        probability_array[iz:ez, iy:ey, ix:ex] += sub_mask
-        sums[iz:ez, iy:ey, ix:ex] += 1
+    def predict(batch):
+        return model.predict(batch[..., np.newaxis], batch_size=len(batch))
 
-    probability_array /= sums
-    comm_array[0] = np.Inf
+    image = imagedata_utils.image_normalize(image, 0.0, 1.0, output_dtype=np.float32)
+    segment_patches(
+        image,
+        predict,
+        overlap,
+        probability_array,
+        comm_array,
+        patch_size,
+        batch_size,
+        stride,
+        blending,
+        background,
+    )
 
 
 def download_callback(comm_array):
@@ -106,13 +235,26 @@ def download_callback(comm_array):
 
 
 def segment_torch(
-    image, weights_file, overlap, device_id, probability_array, comm_array, patch_size
+    image,
+    weights_file,
+    overlap,
+    device_id,
+    probability_array,
+    comm_array,
+    patch_size,
+    batch_size=BATCH_SIZE,
+    num_threads=None,
+    stride=None,
+    blending=BLENDING,
+    background=BACKGROUND_THRESHOLD,
 ):
     import torch
 
     from .model import Unet3D
 
     device = torch.device(device_id)
+    if device.type == "cpu":
+        torch.set_num_threads(num_threads or multiprocessing.cpu_count())
     if weights_file.exists():
         state_dict = torch.load(str(weights_file), map_location=torch.device('cpu'))
     else:
@@ -122,25 +264,153 @@ def segment_torch(
     model.to(device)
     model.eval()
 
+    def predict(batch):
+        with torch.no_grad():
+            return (
+                model(torch.from_numpy(batch[:, np.newaxis]).to(device)).cpu().numpy()
+            )
+
     image = imagedata_utils.image_normalize(image, 0.0, 1.0, output_dtype=np.float32)
-    sums = np.zeros_like(image)
-    # segmenting by patches
-    for completion, sub_image, patch in gen_patches(image, patch_size, overlap):
-        comm_array[0] = completion
-        (iz, ez), (iy, ey), (ix, ex) = patch
-        sub_mask = predict_patch_torch(sub_image, patch, model, device, patch_size)
-        print(sub_mask.shape)
-        probability_array[iz:ez, iy:ey, ix:ex] += sub_mask
-        sums[iz:ez, iy:ey, ix:ex] += 1
+    segment_patches(
+        image,
+        predict,
+        overlap,
+        probability_array,
+        comm_array,
+        patch_size,
+        batch_size,
+        stride,
+        blending,
+        background,
+    )
 
-    probability_array /= sums
-    comm_array[0] = np.Inf
+
+def get_onnx_model_file(torch_weights_file_name, quantize=False):
+    """
+    Returns the file where the ONNX model exported from the pytorch weights
+    torch_weights_file_name is cached.
+    """
+    name = pathlib.Path(torch_weights_file_name).stem
+    if quantize:
+        name += "_int8"
+    return inv_paths.USER_DL_WEIGHTS.joinpath(f"{name}_opset{ONNX_OPSET}.onnx")
+
+
+def get_onnx_model(weights_file, onnx_file, patch_size, quantize=False):
+    """
+    Exports the Unet3D with the pytorch weights of weights_file to the ONNX
+    model onnx_file, with its weights quantized to INT8 if quantize. It's
+    only exported if onnx_file doesn't exist or is older than weights_file.
+    """
+    weights_file = pathlib.Path(weights_file)
+    onnx_file = pathlib.Path(onnx_file)
+    if (
+        onnx_file.exists()
+        and onnx_file.stat().st_mtime >= weights_file.stat().st_mtime
+    ):
+        return onnx_file
+
+    import torch
+
+    from .model import Unet3D
+
+    state_dict = torch.load(str(weights_file), map_location=torch.device("cpu"))
+    model = Unet3D()
+    model.load_state_dict(state_dict["model_state_dict"])
+    model.eval()
+
+    onnx_file.parent.mkdir(parents=True, exist_ok=True)
+    # The model is written to temporary files in the same folder and only
+    # then moved, so a model half written is never used.
+    tmp_files = []
+    for _ in range(2):
+        fd, tmp_file = tempfile.mkstemp(suffix=".onnx", dir=onnx_file.parent)
+        os.close(fd)
+        tmp_files.append(tmp_file)
+    try:
+        dummy = torch.zeros(
+            (1, 1, patch_size, patch_size, patch_size), dtype=torch.float32
+        )
+        with torch.no_grad():
+            torch.onnx.export(
+                model,
+                dummy,
+                tmp_files[0],
+                input_names=["input"],
+                output_names=["output"],
+                dynamic_axes={"input": {0: "batch"}, "output": {0: "batch"}},
+                opset_version=ONNX_OPSET,
+                do_constant_folding=True,
+            )
+        if quantize:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            # ConvInteger, used by the quantized convolutions, only accepts
+            # unsigned weights on CPU.
+            quantize_dynamic(tmp_files[0], tmp_files[1], weight_type=QuantType.QUInt8)
+            os.replace(tmp_files[1], onnx_file)
+        else:
+            os.replace(tmp_files[0], onnx_file)
+    finally:
+        for tmp_file in tmp_files:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    return onnx_file
+
+
+def segment_onnx(
+    image,
+    model_file,
+    overlap,
+    probability_array,
+    comm_array,
+    patch_size,
+    batch_size=BATCH_SIZE,
+    num_threads=None,
+    stride=None,
+    blending=BLENDING,
+    background=BACKGROUND_THRESHOLD,
+):
+    import onnxruntime as ort
+
+    if not pathlib.Path(model_file).exists():
+        raise FileNotFoundError("Model file not found")
+    options = ort.SessionOptions()
+    # Folds the batch normalizations into the convolutions and fuses the
+    # activations.
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = num_threads or multiprocessing.cpu_count()
+    session = ort.InferenceSession(
+        str(model_file), options, providers=["CPUExecutionProvider"]
+    )
+    input_name = session.get_inputs()[0].name
+
+    def predict(batch):
+        return session.run(None, {input_name: batch[:, np.newaxis]})[0]
+
+    image = imagedata_utils.image_normalize(image, 0.0, 1.0, output_dtype=np.float32)
+    segment_patches(
+        image,
+        predict,
+        overlap,
+        probability_array,
+        comm_array,
+        patch_size,
+        batch_size,
+        stride,
+        blending,
+        background,
+    )
 
 
 ctx = multiprocessing.get_context("spawn")
 
 
 class SegmentProcess(ctx.Process):
+    # Name of the pytorch weights file, also used to name the ONNX model
+    # exported from it.
+    TORCH_WEIGHTS_FILE_NAME = ""
+
     def __init__(
         self,
         image,
@@ -152,7 +422,13 @@ class SegmentProcess(ctx.Process):
         apply_wwwl=False,
         window_width=255,
         window_level=127,
-        patch_size=SIZE
+        patch_size=SIZE,
+        batch_size=BATCH_SIZE,
+        num_threads=None,
+        stride=None,
+        blending=BLENDING,
+        background=BACKGROUND_THRESHOLD,
+        quantize=False,
     ):
         multiprocessing.Process.__init__(self)
 
@@ -178,6 +454,13 @@ class SegmentProcess(ctx.Process):
         self.overlap = overlap
 
         self.patch_size = patch_size
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.stride = stride
+        self.blending = blending
+        self.background = background
+        # Only used by the onnx backend.
+        self.quantize = quantize
 
         self.apply_wwwl = apply_wwwl
         self.window_width = window_width
@@ -226,27 +509,7 @@ class SegmentProcess(ctx.Process):
         )
 
         if self.backend.lower() == "pytorch":
-            if not self.torch_weights_file_name:
-                raise FileNotFoundError("Weights file not specified.")
-            folder = inv_paths.MODELS_DIR.joinpath(
-                self.torch_weights_file_name.split(".")[0]
-            )
-            system_state_dict_file = folder.joinpath("brain_mri_t1.pt")
-            user_state_dict_file = inv_paths.USER_DL_WEIGHTS.joinpath(
-                self.torch_weights_file_name
-            )
-            if system_state_dict_file.exists():
-                weights_file = system_state_dict_file
-            elif user_state_dict_file.exists():
-                weights_file = user_state_dict_file
-            else:
-                download_url_to_file(
-                    self.torch_weights_url,
-                    user_state_dict_file,
-                    self.torch_weights_hash,
-                    download_callback(comm_array),
-                )
-                weights_file = user_state_dict_file
+            weights_file = self._get_torch_weights_file(comm_array)
             segment_torch(
                 image,
                 weights_file,
@@ -254,7 +517,38 @@ class SegmentProcess(ctx.Process):
                 self.device_id,
                 probability_array,
                 comm_array,
-                self.patch_size
+                self.patch_size,
+                self.batch_size,
+                self.num_threads,
+                self.stride,
+                self.blending,
+                self.background,
+            )
+        elif self.backend.lower() == "onnx":
+            onnx_file = get_onnx_model_file(self.torch_weights_file_name, self.quantize)
+            # Pytorch is only needed to export the model, without it the model
+            # already exported is used.
+            if importlib.util.find_spec("torch") is not None:
+                weights_file = self._get_torch_weights_file(comm_array)
+                onnx_file = get_onnx_model(
+                    weights_file, onnx_file, self.patch_size, self.quantize
+                )
+            elif not onnx_file.exists():
+                raise FileNotFoundError(
+                    "Pytorch is needed to export the ONNX model the first time."
+                )
+            segment_onnx(
+                image,
+                onnx_file,
+                self.overlap,
+                probability_array,
+                comm_array,
+                self.patch_size,
+                self.batch_size,
+                self.num_threads,
+                self.stride,
+                self.blending,
+                self.background,
             )
         else:
             utils.prepare_ambient(self.backend, self.device_id, self.use_gpu)
@@ -264,8 +558,40 @@ class SegmentProcess(ctx.Process):
                 self.overlap,
                 probability_array,
                 comm_array,
-                self.patch_size
+                self.patch_size,
+                self.batch_size,
+                self.stride,
+                self.blending,
+                self.background,
+            )
+
+    def _get_torch_weights_file(self, comm_array):
+        """
+        Returns the pytorch weights file, the one shipped with InVesalius or
+        the one in the user folder, downloading it if there's none.
+        """
+        if not self.torch_weights_file_name:
+            raise FileNotFoundError("Weights file not specified.")
+        folder = inv_paths.MODELS_DIR.joinpath(
+            self.torch_weights_file_name.split(".")[0]
+        )
+        system_state_dict_file = folder.joinpath("brain_mri_t1.pt")
+        user_state_dict_file = inv_paths.USER_DL_WEIGHTS.joinpath(
+            self.torch_weights_file_name
+        )
+        if system_state_dict_file.exists():
+            weights_file = system_state_dict_file
+        elif user_state_dict_file.exists():
+            weights_file = user_state_dict_file
+        else:
+            download_url_to_file(
+                self.torch_weights_url,
+                user_state_dict_file,
+                self.torch_weights_hash,
+                download_callback(comm_array),
             )
+            weights_file = user_state_dict_file
+        return weights_file
 
     @property
     def exception(self):
@@ -301,6 +627,8 @@ class SegmentProcess(ctx.Process):
 
 
 class BrainSegmentProcess(SegmentProcess):
+    TORCH_WEIGHTS_FILE_NAME = "brain_mri_t1.pt"
+
     def __init__(
         self,
         image,
@@ -312,7 +640,13 @@ class BrainSegmentProcess(SegmentProcess):
         apply_wwwl=False,
         window_width=255,
         window_level=127,
-        patch_size=SIZE
+        patch_size=SIZE,
+        batch_size=BATCH_SIZE,
+        num_threads=None,
+        stride=None,
+        blending=BLENDING,
+        background=BACKGROUND_THRESHOLD,
+        quantize=False,
     ):
         super().__init__(
             image,
@@ -324,9 +658,15 @@ class BrainSegmentProcess(SegmentProcess):
             apply_wwwl=apply_wwwl,
             window_width=window_width,
             window_level=window_level,
-            patch_size=patch_size
+            patch_size=patch_size,
+            batch_size=batch_size,
+            num_threads=num_threads,
+            stride=stride,
+            blending=blending,
+            background=background,
+            quantize=quantize,
         )
-        self.torch_weights_file_name = 'brain_mri_t1.pt'
+        self.torch_weights_file_name = self.TORCH_WEIGHTS_FILE_NAME
         self.torch_weights_url = "https://github.com/tfmoraes/deepbrain_torch/releases/download/v1.1.0/weights.pt"
         self.torch_weights_hash = (
             "194b0305947c9326eeee9da34ada728435a13c7b24015cbd95971097fc178f22"
@@ -338,6 +678,8 @@ class BrainSegmentProcess(SegmentProcess):
 
 
 class TracheaSegmentProcess(SegmentProcess):
+    TORCH_WEIGHTS_FILE_NAME = "trachea_ct.pt"
+
     def __init__(
         self,
         image,
@@ -350,6 +692,12 @@ class TracheaSegmentProcess(SegmentProcess):
         window_width=255,
         window_level=127,
         patch_size=48,
+        batch_size=BATCH_SIZE,
+        num_threads=None,
+        stride=None,
+        blending=BLENDING,
+        background=BACKGROUND_THRESHOLD,
+        quantize=False,
     ):
         super().__init__(
             image,
@@ -361,9 +709,15 @@ class TracheaSegmentProcess(SegmentProcess):
             apply_wwwl=apply_wwwl,
             window_width=window_width,
             window_level=window_level,
-            patch_size=patch_size
+            patch_size=patch_size,
+            batch_size=batch_size,
+            num_threads=num_threads,
+            stride=stride,
+            blending=blending,
+            background=background,
+            quantize=quantize,
         )
-        self.torch_weights_file_name = 'trachea_ct.pt'
+        self.torch_weights_file_name = self.TORCH_WEIGHTS_FILE_NAME
         self.torch_weights_url = "https://github.com/tfmoraes/deep_trachea_torch/releases/download/v1.0/weights.pt"
         self.torch_weights_hash = (
             "6102d16e3c8c07a1c7b0632bc76db4d869c7467724ff7906f87d04f6dc72022e"
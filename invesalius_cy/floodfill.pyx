@@ -6,6 +6,7 @@ cimport cython
 
 from collections import deque
 
+cimport openmp
 from cython.parallel import prange
 from libc.math cimport floor, ceil
 from libcpp cimport bool
@@ -21,6 +22,19 @@ cdef struct s_coord:
 
 ctypedef s_coord coord
 
+# Run of voxels [x0, x1] in the row (z, y).
+cdef struct s_span:
+    int x0
+    int x1
+    int y
+    int z
+
+ctypedef s_span span
+
+# The scanline flood fill splits the volume in slabs (along z) of at least
+# this number of slices, each one filled by a thread.
+cdef int MIN_SLAB_SIZE = 32
+
 
 @cython.boundscheck(False) # turn of bounds-checking for entire function
 @cython.wraparound(False)
@@ -43,85 +57,244 @@ cdef inline void pop_queue(cdeque[int]& stack, int* x, int* y, int* z, int d, in
 
 
 @cython.boundscheck(False) # turn of bounds-checking for entire function
-def floodfill(np.ndarray[image_t, ndim=3] data, int i, int j, int k, int v, int fill, np.ndarray[mask_t, ndim=3] out):
+@cython.wraparound(False)
+@cython.nonecheck(False)
+cdef inline void update_bbox(int* bbox, int x, int y, int z) nogil:
+    if z < bbox[0]:
+        bbox[0] = z
+    if z > bbox[1]:
+        bbox[1] = z
+    if y < bbox[2]:
+        bbox[2] = y
+    if y > bbox[3]:
+        bbox[3] = y
+    if x < bbox[4]:
+        bbox[4] = x
+    if x > bbox[5]:
+        bbox[5] = x
 
-    cdef int to_return = 0
-    if out is None:
-        out = np.zeros_like(data)
-        to_return = 1
 
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+@cython.nonecheck(False)
+cdef void _floodfill_threshold(image_t[:, :, :] data, cdeque[coord]& stack, int t0, int t1, int fill, mask_t[:, :, :] strct, mask_t[:, :, :] out, int* bbox) nogil:
     cdef int x, y, z
-    cdef int w, h, d
+    cdef int dx, dy, dz
+    cdef int odx, ody, odz
+    cdef int xo, yo, zo
+    cdef int i, j, k
+    cdef int offset_x, offset_y, offset_z
+    cdef coord c
 
-    d = data.shape[0]
-    h = data.shape[1]
-    w = data.shape[2]
+    dz = data.shape[0]
+    dy = data.shape[1]
+    dx = data.shape[2]
 
-    stack = [(i, j, k), ]
-    out[k, j, i] = fill
+    odz = strct.shape[0]
+    ody = strct.shape[1]
+    odx = strct.shape[2]
 
-    while stack:
-        x, y, z = stack.pop()
+    offset_z = odz // 2
+    offset_y = ody // 2
+    offset_x = odx // 2
 
-        if z + 1 < d and data[z + 1, y, x] == v and out[z + 1, y, x] != fill:
-            out[z + 1, y, x] =  fill
-            stack.append((x, y, z + 1))
+    while stack.size():
+        c = stack.back()
+        stack.pop_back()
 
-        if z - 1 >= 0 and data[z - 1, y, x] == v and out[z - 1, y, x] != fill:
-            out[z - 1, y, x] = fill
-            stack.append((x, y, z - 1))
+        x = c.x
+        y = c.y
+        z = c.z
 
-        if y + 1 < h and data[z, y + 1, x] == v and out[z, y + 1, x] != fill:
-            out[z, y + 1, x] = fill
-            stack.append((x, y + 1, z))
+        out[z, y, x] = fill
 
-        if y - 1 >= 0 and data[z, y - 1, x] == v and out[z, y - 1, x] != fill:
-            out[z, y - 1, x] = fill
-            stack.append((x, y - 1, z))
+        for k in range(odz):
+            zo = z + k - offset_z
+            for j in range(ody):
+                yo = y + j - offset_y
+                for i in range(odx):
+                    if strct[k, j, i]:
+                        xo = x + i - offset_x
+                        if 0 <= xo < dx and 0 <= yo < dy and 0 <= zo < dz and out[zo, yo, xo] != fill and t0 <= data[zo, yo, xo] <= t1:
+                            out[zo, yo, xo] = fill
+                            update_bbox(bbox, xo, yo, zo)
+                            c.x = xo
+                            c.y = yo
+                            c.z = zo
+                            stack.push_back(c)
 
-        if x + 1 < w and data[z, y, x + 1] == v and out[z, y, x + 1] != fill:
-            out[z, y, x + 1] = fill
-            stack.append((x + 1, y, z))
 
-        if x - 1 >= 0 and data[z, y, x - 1] == v and out[z, y, x - 1] != fill:
-            out[z, y, x - 1] = fill
-            stack.append((x - 1, y, z))
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+@cython.nonecheck(False)
+cdef inline bool is_candidate(image_t[:, :, :] data, mask_t[:, :, :] out, int x, int y, int z, int t0, int t1, int fill) nogil:
+    return out[z, y, x] != fill and t0 <= data[z, y, x] <= t1
 
-    if to_return:
-        return out
+
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+@cython.nonecheck(False)
+cdef void scan_row(image_t[:, :, :] data, mask_t[:, :, :] out, int z, int y, int x0, int x1, int t0, int t1, int fill, cdeque[coord]& stack) nogil:
+    """
+    Pushes to stack one voxel of each run of candidate voxels in the row
+    (z, y) between x0 and x1.
+    """
+    cdef int x
+    cdef bool in_run = False
+    cdef coord c
+
+    if x0 < 0:
+        x0 = 0
+    if x1 > data.shape[2] - 1:
+        x1 = data.shape[2] - 1
+
+    c.y = y
+    c.z = z
+    for x in range(x0, x1 + 1):
+        if is_candidate(data, out, x, y, z, t0, t1, fill):
+            if not in_run:
+                c.x = x
+                stack.push_back(c)
+                in_run = True
+        else:
+            in_run = False
 
 
 @cython.boundscheck(False) # turn of bounds-checking for entire function
 @cython.wraparound(False)
 @cython.nonecheck(False)
-def floodfill_threshold(np.ndarray[image_t, ndim=3] data, list seeds, int t0, int t1, int fill, np.ndarray[mask_t, ndim=3] strct, np.ndarray[mask_t, ndim=3] out):
+cdef void scan_neighbours(image_t[:, :, :] data, mask_t[:, :, :] out, int z, int y, int xl, int xr, int t0, int t1, int fill, int[:, :] rows, int zmin, int zmax, cdeque[coord]& stack, vector[span]& outbox) nogil:
+    """
+    Looks for candidate voxels in the rows connected to the span [xl, xr] of
+    the row (z, y). The rows outside the slab [zmin, zmax) are added to
+    outbox, they're scanned by the thread of their slab.
+    """
+    cdef int r, zo, yo
+    cdef span sp
+
+    for r in range(rows.shape[0]):
+        zo = z + rows[r, 0]
+        yo = y + rows[r, 1]
+        if zo < 0 or zo >= data.shape[0] or yo < 0 or yo >= data.shape[1]:
+            continue
+        if zo < zmin or zo >= zmax:
+            sp.x0 = xl + rows[r, 2]
+            sp.x1 = xr + rows[r, 3]
+            sp.y = yo
+            sp.z = zo
+            outbox.push_back(sp)
+        else:
+            scan_row(data, out, zo, yo, xl + rows[r, 2], xr + rows[r, 3], t0, t1, fill, stack)
 
-    cdef int to_return = 0
-    if out is None:
-        out = np.zeros_like(data)
-        to_return = 1
 
-    cdef int x, y, z
-    cdef int dx, dy, dz
-    cdef int odx, ody, odz
-    cdef int xo, yo, zo
-    cdef int i, j, k
-    cdef int offset_x, offset_y, offset_z
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+@cython.nonecheck(False)
+cdef void _floodfill_span(image_t[:, :, :] data, cdeque[coord]& stack, int t0, int t1, int fill, int[:, :] rows, mask_t[:, :, :] out, int zmin, int zmax, vector[span]& outbox, int* bbox) nogil:
+    """
+    Scanline flood fill of the slab [zmin, zmax): each voxel popped from the
+    stack is extended to the run of candidate voxels along x containing it,
+    which is filled at once, then its neighbour rows are scanned.
+    """
+    cdef int x, y, z, xl, xr
+    cdef coord c
 
-    dz = data.shape[0]
-    dy = data.shape[1]
-    dx = data.shape[2]
+    while stack.size():
+        c = stack.back()
+        stack.pop_back()
+
+        x = c.x
+        y = c.y
+        z = c.z
+
+        if not is_candidate(data, out, x, y, z, t0, t1, fill):
+            continue
+
+        xl = x
+        while xl > 0 and is_candidate(data, out, xl - 1, y, z, t0, t1, fill):
+            xl -= 1
+        xr = x
+        while xr < data.shape[2] - 1 and is_candidate(data, out, xr + 1, y, z, t0, t1, fill):
+            xr += 1
+
+        for x in range(xl, xr + 1):
+            out[z, y, x] = fill
+        update_bbox(bbox, xl, y, z)
+        update_bbox(bbox, xr, y, z)
+
+        scan_neighbours(data, out, z, y, xl, xr, t0, t1, fill, rows, zmin, zmax, stack, outbox)
 
-    odz = strct.shape[0]
-    ody = strct.shape[1]
-    odx = strct.shape[2]
 
+def get_span_rows(np.ndarray[mask_t, ndim=3] strct):
+    """
+    Returns the rows (along x) of strct as an array of (dz, dy, x offset of
+    the first voxel, x offset of the last voxel), without the central row.
+    Returns None if strct can't be used by the scanline fill: the central
+    row must connect the voxels along x and all rows must be contiguous.
+    """
+    offset_z = strct.shape[0] // 2
+    offset_y = strct.shape[1] // 2
+    offset_x = strct.shape[2] // 2
+
+    if strct.shape[2] < 3 or not (strct[offset_z, offset_y, offset_x - 1] and strct[offset_z, offset_y, offset_x + 1]):
+        return None
+
+    rows = []
+    for k in range(strct.shape[0]):
+        for j in range(strct.shape[1]):
+            if k == offset_z and j == offset_y:
+                continue
+            xs = np.flatnonzero(strct[k, j])
+            if not xs.size:
+                continue
+            if xs[-1] - xs[0] + 1 != xs.size:
+                return None
+            rows.append((k - offset_z, j - offset_y, xs[0] - offset_x, xs[-1] - offset_x))
+    return np.array(rows, dtype=np.int32).reshape(-1, 4)
+
+
+cdef inline int get_slab(int z, int dz, int nslabs) nogil:
+    # The slab s is [s * dz // nslabs, (s + 1) * dz // nslabs).
+    cdef int s = (z * nslabs) // dz
+    while s > 0 and z < (s * dz) // nslabs:
+        s -= 1
+    while s < nslabs - 1 and z >= ((s + 1) * dz) // nslabs:
+        s += 1
+    return s
+
+
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def floodfill_threshold_bbox(np.ndarray[image_t, ndim=3] data, list seeds, int t0, int t1, int fill, np.ndarray[mask_t, ndim=3] strct, np.ndarray[mask_t, ndim=3] out):
+    """
+    Fills in out, with fill, the voxels connected (given strct) to the seeds
+    whose values are in [t0, t1]. Returns the bounding box of the voxels
+    filled as a tuple of slices (z, y, x), or None if no voxel was filled.
+
+    If strct allows it's a scanline fill. The volume is split in slabs along
+    z filled in parallel, the runs reaching other slabs are passed to them
+    between the rounds, until there is nothing else to fill.
+    """
+    cdef image_t[:, :, :] vdata = data
+    cdef mask_t[:, :, :] vstrct = strct
+    cdef mask_t[:, :, :] vout = out
+
+    cdef int i, j, k
     cdef cdeque[coord] stack
     cdef coord c
+    cdef int bbox[6]
 
-    offset_z = odz // 2
-    offset_y = ody // 2
-    offset_x = odx // 2
+    span_rows = get_span_rows(strct)
+    if span_rows is not None:
+        return _floodfill_threshold_slabs(data, seeds, t0, t1, fill, span_rows, out)
+
+    bbox[0] = data.shape[0]
+    bbox[1] = -1
+    bbox[2] = data.shape[1]
+    bbox[3] = -1
+    bbox[4] = data.shape[2]
+    bbox[5] = -1
 
     for i, j, k in seeds:
         if data[k, j, i] >= t0 and data[k, j, i] <= t1:
@@ -130,31 +303,106 @@ def floodfill_threshold(np.ndarray[image_t, ndim=3] data, list seeds, int t0, in
             c.z = k
             stack.push_back(c)
             out[k, j, i] = fill
+            update_bbox(bbox, i, j, k)
 
     with nogil:
-        while stack.size():
-            c = stack.back()
-            stack.pop_back()
+        _floodfill_threshold(vdata, stack, t0, t1, fill, vstrct, vout, bbox)
 
-            x = c.x
-            y = c.y
-            z = c.z
+    if bbox[1] < 0:
+        return None
+    return (slice(bbox[0], bbox[1] + 1), slice(bbox[2], bbox[3] + 1), slice(bbox[4], bbox[5] + 1))
 
-            out[z, y, x] = fill
 
-            for k in range(odz):
-                zo = z + k - offset_z
-                for j in range(ody):
-                    yo = y + j - offset_y
-                    for i in range(odx):
-                        if strct[k, j, i]:
-                            xo = x + i - offset_x
-                            if 0 <= xo < dx and 0 <= yo < dy and 0 <= zo < dz and out[zo, yo, xo] != fill and t0 <= data[zo, yo, xo] <= t1:
-                                out[zo, yo, xo] = fill
-                                c.x = xo
-                                c.y = yo
-                                c.z = zo
-                                stack.push_back(c)
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def _floodfill_threshold_slabs(image_t[:, :, :] data, list seeds, int t0, int t1, int fill, int[:, :] rows, mask_t[:, :, :] out):
+    cdef int i, j, k, s, n
+    cdef int dz = data.shape[0]
+    cdef int nslabs = max(1, min(openmp.omp_get_max_threads(), dz // MIN_SLAB_SIZE))
+    cdef bool pending
+    cdef coord c
+    cdef span sp
+
+    cdef vector[cdeque[coord]] stacks = vector[cdeque[coord]](nslabs)
+    cdef vector[vector[span]] outboxes = vector[vector[span]](nslabs)
+    cdef np.ndarray[np.int32_t, ndim=2] bboxes = np.empty((nslabs, 6), dtype=np.int32)
+    cdef int[:, :] vbboxes = bboxes
+
+    bboxes[:, 0::2] = (data.shape[0], data.shape[1], data.shape[2])
+    bboxes[:, 1::2] = -1
+
+    for i, j, k in seeds:
+        if t0 <= data[k, j, i] <= t1:
+            s = get_slab(k, dz, nslabs)
+            if out[k, j, i] == fill:
+                # Already filled, only its neighbours are filled.
+                scan_row(data, out, k, j, i - 1, i + 1, t0, t1, fill, stacks[s])
+                scan_neighbours(data, out, k, j, i, i, t0, t1, fill, rows, (s * dz) // nslabs, ((s + 1) * dz) // nslabs, stacks[s], outboxes[s])
+            else:
+                c.x = i
+                c.y = j
+                c.z = k
+                stacks[s].push_back(c)
+
+    while True:
+        # The runs found by each slab in its neighbours.
+        for s in range(nslabs):
+            for n in range(outboxes[s].size()):
+                sp = outboxes[s][n]
+                k = get_slab(sp.z, dz, nslabs)
+                scan_row(data, out, sp.z, sp.y, sp.x0, sp.x1, t0, t1, fill, stacks[k])
+            outboxes[s].clear()
+
+        pending = False
+        for s in range(nslabs):
+            if stacks[s].size():
+                pending = True
+        if not pending:
+            break
+
+        for s in prange(nslabs, nogil=True, schedule='dynamic', chunksize=1):
+            _floodfill_span(data, stacks[s], t0, t1, fill, rows, out, (s * dz) // nslabs, ((s + 1) * dz) // nslabs, outboxes[s], &vbboxes[s, 0])
+
+    if bboxes[:, 1].max() < 0:
+        return None
+    return (
+        slice(int(bboxes[:, 0].min()), int(bboxes[:, 1].max()) + 1),
+        slice(int(bboxes[:, 2].min()), int(bboxes[:, 3].max()) + 1),
+        slice(int(bboxes[:, 4].min()), int(bboxes[:, 5].max()) + 1),
+    )
+
+
+def floodfill_threshold(np.ndarray[image_t, ndim=3] data, list seeds, int t0, int t1, int fill, np.ndarray[mask_t, ndim=3] strct, np.ndarray[mask_t, ndim=3] out):
+
+    cdef int to_return = 0
+    if out is None:
+        out = np.zeros_like(data, dtype=np.uint8)
+        to_return = 1
+
+    floodfill_threshold_bbox(data, seeds, t0, t1, fill, strct, out)
+
+    if to_return:
+        return out
+
+
+def floodfill(np.ndarray[image_t, ndim=3] data, int i, int j, int k, int v, int fill, np.ndarray[mask_t, ndim=3] out):
+    """
+    Fills in out the voxels 6-connected to (i, j, k) whose value is v.
+    """
+    cdef int to_return = 0
+    if out is None:
+        out = np.zeros_like(data, dtype=np.uint8)
+        to_return = 1
+
+    strct = np.array(
+        [[[0, 0, 0], [0, 1, 0], [0, 0, 0]],
+         [[0, 1, 0], [1, 1, 1], [0, 1, 0]],
+         [[0, 0, 0], [0, 1, 0], [0, 0, 0]]],
+        dtype=np.uint8,
+    )
+    out[k, j, i] = fill
+    floodfill_threshold_bbox(data, [(i, j, k)], v, v, fill, strct, out)
 
     if to_return:
         return out
@@ -75,6 +75,64 @@ cdef image_t coord_transform(image_t[:, :, :] volume, double[:, :] M, int x, int
         return cval
 
 
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.cdivision(True)
+@cython.wraparound(False)
+cdef void transform_line(image_t[:, :, :] volume, double[:, :] M,
+                         int x, int y, int z, int along_y,
+                         image_t[:, :, :] out, int oz, int oy, int ox,
+                         double sx, double sy, double sz,
+                         interp_function f_interp, image_t cval) nogil:
+    """
+    Transforms a line of voxels starting at (x, y, z) and going along the x
+    axis (or the y axis if along_y) and writes it to out starting at (ox, oy,
+    oz). The transformed coordinate is affine along the line, so the matrix
+    is only multiplied once per line.
+    """
+    cdef double coord[4]
+    coord[0] = z*sz
+    coord[1] = y*sy
+    coord[2] = x*sx
+    coord[3] = 1.0
+
+    cdef double base[4]
+    mul_mat4_vec4(M, coord, base)
+
+    cdef double step[4]
+    cdef int k, i, length
+    if along_y:
+        length = volume.shape[1]
+        for k in range(4):
+            step[k] = M[k, 1] * sy
+    else:
+        length = volume.shape[2]
+        for k in range(4):
+            step[k] = M[k, 2] * sx
+
+    cdef int dz, dy, dx
+    dz = volume.shape[0]
+    dy = volume.shape[1]
+    dx = volume.shape[2]
+
+    cdef double w, nz, ny, nx
+    cdef image_t v
+    for i in range(length):
+        w = base[3] + i*step[3]
+        nz = ((base[0] + i*step[0])/w)/sz
+        ny = ((base[1] + i*step[1])/w)/sy
+        nx = ((base[2] + i*step[2])/w)/sx
+
+        if 0 <= nz <= (dz-1) and 0 <= ny <= (dy-1) and 0 <= nx <= (dx-1):
+            v = <image_t>f_interp(volume, nx, ny, nz)
+        else:
+            v = cval
+
+        if along_y:
+            out[oz, oy + i, ox] = v
+        else:
+            out[oz, oy, ox + i] = v
+
+
 @cython.boundscheck(False) # turn of bounds-checking for entire function
 @cython.cdivision(True)
 @cython.wraparound(False)
@@ -85,20 +143,24 @@ def apply_view_matrix_transform(image_t[:, :, :] volume,
                                 int minterpol,
                                 image_t cval,
                                 image_t[:, :, :] out):
+    """
+    Reslices the volume using the view matrix M and writes to out the slices
+    n to n + thickness of out in the given orientation. out may have only
+    one slice of thickness, then only the plane n is computed. The lines of
+    all the output slices are distributed between the threads.
+    """
 
     cdef int dz, dy, dx
-    cdef int z, y, x
+    cdef int i, nlines, ostep
     dz = volume.shape[0]
     dy = volume.shape[1]
     dx = volume.shape[2]
 
-    cdef unsigned int odz, ody, odx
+    cdef int odz, ody, odx
     odz = out.shape[0]
     ody = out.shape[1]
     odx = out.shape[2]
 
-    cdef unsigned int count = 0
-
     cdef double sx, sy, sz
     sx = spacing[0]
     sy = spacing[1]
@@ -115,26 +177,30 @@ def apply_view_matrix_transform(image_t[:, :, :] volume,
     else:
         f_interp = lanczos3
 
+    cdef int _n = n
+
+    # Lines near the border of the rotated volume are cheaper (they're
+    # mostly outside the volume), so the lines are scheduled dynamically.
     if orientation == 'AXIAL':
-        for z in range(n, n+odz):
-            for y in prange(dy, nogil=True):
-                for x in range(dx):
-                    out[count, y, x] = coord_transform(volume, M, x, y, z, sx, sy, sz, f_interp, cval)
-            count += 1
+        nlines = odz * dy
+        for i in prange(nlines, nogil=True, schedule='guided'):
+            transform_line(volume, M, 0, i % dy, _n + i // dy, 0,
+                           out, i // dy, i % dy, 0,
+                           sx, sy, sz, f_interp, cval)
 
     elif orientation == 'CORONAL':
-        for y in range(n, n+ody):
-            for z in prange(dz, nogil=True):
-                for x in range(dx):
-                    out[z, count, x] = coord_transform(volume, M, x, y, z, sx, sy, sz, f_interp, cval)
-            count += 1
+        nlines = ody * dz
+        for i in prange(nlines, nogil=True, schedule='guided'):
+            transform_line(volume, M, 0, _n + i // dz, i % dz, 0,
+                           out, i % dz, i // dz, 0,
+                           sx, sy, sz, f_interp, cval)
 
     elif orientation == 'SAGITAL':
-        for x in range(n, n+odx):
-            for z in prange(dz, nogil=True):
-                for y in range(dy):
-                    out[z, y, count] = coord_transform(volume, M, x, y, z, sx, sy, sz, f_interp, cval)
-            count += 1
+        nlines = odx * dz
+        for i in prange(nlines, nogil=True, schedule='guided'):
+            transform_line(volume, M, _n + i // dz, 0, i % dz, 1,
+                           out, i % dz, 0, i // dz,
+                           sx, sy, sz, f_interp, cval)
 
 
 @cython.boundscheck(False) # turn of bounds-checking for entire function